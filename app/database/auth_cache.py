@@ -0,0 +1,106 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Tuple
+
+from prometheus_client import Counter, Gauge
+
+# Максимальное количество api_key в кэше и время жизни записи в секундах
+AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL: float = float(os.getenv("AUTH_CACHE_TTL", 60))
+
+# Метрики кэша, отдаются через /metrics вместе с метриками Instrumentator
+AUTH_CACHE_HITS: Counter = Counter(
+    "auth_cache_hits", "Number of api_key lookups served from the cache"
+)
+AUTH_CACHE_MISSES: Counter = Counter(
+    "auth_cache_misses", "Number of api_key lookups that went to the database"
+)
+AUTH_CACHE_ENTRIES: Gauge = Gauge(
+    "auth_cache_entries",
+    "Number of api_keys currently cached",
+    multiprocess_mode="livesum",
+)
+
+
+class UserIdentity(NamedTuple):
+    """Минимальная информация о пользователе, нужная для авторизации запроса"""
+
+    id: int
+    name: str
+
+
+class AuthCache:
+    """LRU-кэш с ограниченным временем жизни записей: api_key -> UserIdentity"""
+
+    def __init__(
+        self, maxsize: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL
+    ) -> None:
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        # api_key -> (время истечения записи, пользователь)
+        self._entries: OrderedDict[str, Tuple[float, UserIdentity]] = OrderedDict()
+
+    def get(self, api_key: str) -> UserIdentity | None:
+        """
+        Метод возвращающий пользователя из кэша
+        :param api_key: Api-Key пользователя
+        :type api_key: str
+        :return: Пользователь или None, если записи нет или она устарела
+        :rtype: UserIdentity | None
+        """
+        entry: Tuple[float, UserIdentity] | None = self._entries.get(api_key)
+
+        if entry is None or entry[0] < time.monotonic():
+            # Устаревшую запись удаляем
+            if entry is not None:
+                self.invalidate(api_key)
+            AUTH_CACHE_MISSES.inc()
+
+            return None
+
+        # Отмечаем запись как недавно использованную
+        self._entries.move_to_end(api_key)
+        AUTH_CACHE_HITS.inc()
+
+        return entry[1]
+
+    def set(self, api_key: str, identity: UserIdentity) -> None:
+        """
+        Метод добавляющий пользователя в кэш
+        :param api_key: Api-Key пользователя
+        :type api_key: str
+        :param identity: Пользователь
+        :type identity: UserIdentity
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        self._entries[api_key] = (time.monotonic() + self.ttl, identity)
+        self._entries.move_to_end(api_key)
+
+        # Вытесняем давно не использованные записи
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        AUTH_CACHE_ENTRIES.set(len(self._entries))
+
+    def invalidate(self, api_key: str) -> None:
+        """Удаляет из кэша запись по api_key (например, при смене или отзыве ключа)"""
+        self._entries.pop(api_key, None)
+        AUTH_CACHE_ENTRIES.set(len(self._entries))
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Удаляет из кэша все записи пользователя (при переименовании или удалении)"""
+        for i_api_key, (_, i_identity) in list(self._entries.items()):
+            if i_identity.id == user_id:
+                del self._entries[i_api_key]
+        AUTH_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self) -> None:
+        """Очищает кэш"""
+        self._entries.clear()
+        AUTH_CACHE_ENTRIES.set(0)
+
+
+# Кэш авторизации приложения
+auth_cache: AuthCache = AuthCache()
@@ -0,0 +1,718 @@
+"""
+Массовый импорт и экспорт пользователей, твитов, подписок и лайков
+в NDJSON (одна JSON-строка на запись) или CSV (с заголовком).
+
+Файл читается и пишется потоково, пачками по --batch-size строк,
+каждая пачка загружается через COPY во временную таблицу и переносится
+в основную одним запросом (с пересчётом счётчиков, лент и версий для ETag)
+в своей транзакции. После каждой пачки позиция сохраняется в файл
+контрольной точки (<файл>.checkpoint), повторный запуск продолжает с неё.
+Уже существующие записи пропускаются, поэтому повтор пачки безопасен.
+
+Колонки:
+    users:   id (необязательно), name, api_key
+    tweets:  id (необязательно), content, author_id
+    follows: user_id, following_id
+    likes:   user_id, tweet_id
+
+Запуск из папки app:
+    python -m database.bulk import users users.ndjson
+    python -m database.bulk export follows follows.csv
+"""
+import argparse
+import asyncio
+import csv
+import io
+import os
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+)
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from database.change_counters import (
+    TWEETS_COUNTERS,
+    bump_counters,
+    get_user_counter,
+)
+from database.database import async_session, engine
+from database.models import FANOUT_MAX_FOLLOWERS
+from database.response_cache import response_cache
+from database.timeline import (
+    TIMELINE_INBOX_SIZE,
+    PostgresTimelineStore,
+    timeline_store,
+)
+
+# Количество строк в одной пачке (и в одной транзакции)
+BULK_BATCH_SIZE: int = int(os.getenv("BULK_BATCH_SIZE", 10000))
+
+# Пользователи, твиты которых больше не рассылаются по лентам
+MERGE_ON_READ_QUERY: str = """
+UPDATE users SET merge_on_read = true
+WHERE NOT merge_on_read AND followers_count > :max_followers
+    AND id IN (SELECT {column} FROM {staging})
+"""
+
+USERS_QUERY: str = """
+WITH inserted AS (
+    INSERT INTO users (id, "user", api_key)
+    SELECT coalesce(id, nextval(pg_get_serial_sequence('users', 'id'))),
+        name, api_key
+    FROM bulk_users
+    ON CONFLICT DO NOTHING
+    RETURNING id
+)
+SELECT count(*) FROM inserted
+"""
+
+TWEETS_QUERY: str = """
+WITH inserted AS (
+    INSERT INTO tweets (id, tweet, author_id)
+    SELECT coalesce(b.id, nextval(pg_get_serial_sequence('tweets', 'id'))),
+        b.content, b.author_id
+    FROM bulk_tweets b JOIN users u ON u.id = b.author_id
+    ON CONFLICT DO NOTHING
+    RETURNING id, author_id
+){fan_out}
+SELECT count(*) FROM inserted
+"""
+
+# Рассылка твитов в ленты автора и подписчиков (как fan_out_tweet)
+TWEETS_FAN_OUT: str = """, fan_out AS (
+    INSERT INTO timeline (user_id, tweet_id, author_id)
+    SELECT author_id, id, author_id FROM inserted
+    UNION ALL
+    SELECT f.user_id, i.id, i.author_id
+    FROM inserted i
+    JOIN users u ON u.id = i.author_id AND NOT u.merge_on_read
+    JOIN followers f ON f.following_id = i.author_id
+    ON CONFLICT DO NOTHING
+)"""
+
+FOLLOWS_QUERY: str = """
+WITH inserted AS (
+    INSERT INTO followers (user_id, following_id)
+    SELECT b.user_id, b.following_id
+    FROM bulk_follows b
+    JOIN users f ON f.id = b.user_id
+    JOIN users t ON t.id = b.following_id
+    ON CONFLICT DO NOTHING
+    RETURNING user_id, following_id
+), counts AS (
+    SELECT id, sum(following) AS following, sum(followers) AS followers
+    FROM (
+        SELECT user_id AS id, 1 AS following, 0 AS followers FROM inserted
+        UNION ALL
+        SELECT following_id, 0, 1 FROM inserted
+    ) edges
+    GROUP BY id
+), updated AS (
+    UPDATE users SET
+        following_count = following_count + counts.following,
+        followers_count = followers_count + counts.followers
+    FROM counts WHERE users.id = counts.id
+){backfill}
+SELECT count(*) FROM inserted
+"""
+
+# Последние твиты автора в ленту нового подписчика (как write_following_to_db)
+FOLLOWS_BACKFILL: str = """, backfill AS (
+    INSERT INTO timeline (user_id, tweet_id, author_id)
+    SELECT i.user_id, t.id, t.author_id
+    FROM inserted i
+    JOIN users a ON a.id = i.following_id AND NOT a.merge_on_read
+    CROSS JOIN LATERAL (
+        SELECT id, author_id FROM tweets
+        WHERE author_id = i.following_id
+        ORDER BY id DESC LIMIT :backfill_size
+    ) t
+    ON CONFLICT DO NOTHING
+)"""
+
+LIKES_QUERY: str = """
+WITH inserted AS (
+    INSERT INTO "like" (tweet_id, user_id)
+    SELECT b.tweet_id, b.user_id
+    FROM bulk_likes b
+    JOIN tweets t ON t.id = b.tweet_id
+    JOIN users u ON u.id = b.user_id
+    ON CONFLICT DO NOTHING
+    RETURNING tweet_id
+), updated AS (
+    UPDATE tweets SET like_count = like_count + counts.likes
+    FROM (
+        SELECT tweet_id, count(*) AS likes FROM inserted GROUP BY tweet_id
+    ) counts
+    WHERE tweets.id = counts.tweet_id
+)
+SELECT count(*) FROM inserted
+"""
+
+
+class Entity(NamedTuple):
+    """Вид записей: колонки файла, временная таблица и запросы импорта и экспорта"""
+
+    columns: Tuple[str, ...]
+    # Типы колонок (для разбора CSV и временной таблицы)
+    types: Tuple[type, ...]
+    # Колонки, которые могут отсутствовать в файле
+    optional: Tuple[str, ...]
+    # Запрос переноса из временной таблицы, возвращает количество добавленных
+    import_query: str
+    # Запрос экспорта: колонки файла и ключ сортировки для продолжения
+    export_query: str
+    export_key: Tuple[str, ...]
+
+
+ENTITIES: Dict[str, Entity] = {
+    "users": Entity(
+        columns=("id", "name", "api_key"),
+        types=(int, str, str),
+        optional=("id",),
+        import_query=USERS_QUERY,
+        export_query='SELECT id, "user" AS name, api_key FROM users',
+        export_key=("id",),
+    ),
+    "tweets": Entity(
+        columns=("id", "content", "author_id"),
+        types=(int, str, int),
+        optional=("id",),
+        import_query=TWEETS_QUERY,
+        export_query="SELECT id, tweet AS content, author_id FROM tweets",
+        export_key=("id",),
+    ),
+    "follows": Entity(
+        columns=("user_id", "following_id"),
+        types=(int, int),
+        optional=(),
+        import_query=FOLLOWS_QUERY,
+        export_query="SELECT user_id, following_id FROM followers",
+        export_key=("user_id", "following_id"),
+    ),
+    "likes": Entity(
+        columns=("user_id", "tweet_id"),
+        types=(int, int),
+        optional=(),
+        import_query=LIKES_QUERY,
+        export_query='SELECT user_id, tweet_id FROM "like"',
+        export_key=("tweet_id", "user_id"),
+    ),
+}
+
+# Форматы файлов по расширению
+FORMATS: Dict[str, str] = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "ndjson",
+    ".csv": "csv",
+}
+
+
+class BulkError(Exception):
+    """Ошибка в файле импорта или в контрольной точке"""
+
+
+def get_format(path: str, file_format: str | None) -> str:
+    """
+    Функция определяющая формат файла (явно заданный или по расширению)
+    :param path: Путь к файлу
+    :type path: str
+    :param file_format: ndjson, csv или None
+    :type file_format: str | None
+    :return: ndjson или csv
+    :rtype: str
+    """
+    if file_format:
+        return file_format
+
+    extension: str = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise BulkError("unknown file format, use --format")
+
+    return FORMATS[extension]
+
+
+def load_checkpoint(path: str, expected: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Функция читающая контрольную точку прерванного импорта или экспорта
+    :param path: Путь к файлу контрольной точки
+    :type path: str
+    :param expected: Параметры запуска (должны совпадать с сохранёнными)
+    :type expected: Dict[str, Any]
+    :return: Контрольная точка или пустой словарь
+    :rtype: Dict[str, Any]
+    """
+    if not os.path.exists(path):
+        return dict()
+
+    with open(path, "rb") as f:
+        checkpoint: Dict[str, Any] = orjson.loads(f.read())
+
+    for i_key, i_value in expected.items():
+        if checkpoint.get(i_key) != i_value:
+            raise BulkError(
+                "checkpoint {} belongs to another run ({} = {!r}), "
+                "remove it to start over".format(path, i_key, checkpoint.get(i_key))
+            )
+
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    """Функция атомарно сохраняющая контрольную точку"""
+    tmp_path: str = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(checkpoint))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def convert_row(entity: Entity, row: Dict[str, Any], line: int) -> Tuple:
+    """
+    Функция приводящая запись из файла к строке временной таблицы
+    :param entity: Вид записей
+    :type entity: Entity
+    :param row: Запись из файла
+    :type row: Dict[str, Any]
+    :param line: Номер записи (для сообщения об ошибке)
+    :type line: int
+    :return: Значения колонок
+    :rtype: Tuple
+    """
+    values: List[Any] = list()
+
+    for i_column, i_type in zip(entity.columns, entity.types):
+        i_value: Any = row.get(i_column)
+
+        # Пустое значение в CSV - отсутствующее
+        if i_value is None or i_value == "":
+            if i_column not in entity.optional:
+                raise BulkError("row {}: {} is required".format(line, i_column))
+            values.append(None)
+            continue
+
+        try:
+            values.append(i_type(i_value))
+        except (TypeError, ValueError):
+            raise BulkError(
+                "row {}: {} must be {}".format(line, i_column, i_type.__name__)
+            )
+
+    return tuple(values)
+
+
+class LineReader:
+    """Построчное чтение двоичного файла с подсчётом прочитанных байт"""
+
+    def __init__(self, file: io.BufferedReader) -> None:
+        self.file: io.BufferedReader = file
+        self.offset: int = file.tell()
+
+    def __iter__(self) -> Iterator[str]:
+        for i_line in self.file:
+            self.offset += len(i_line)
+            yield i_line.decode("utf-8")
+
+
+def read_rows(
+    path: str, file_format: str, entity: Entity, offset: int, first_row: int = 1
+) -> Iterator[Tuple[Tuple, int]]:
+    """
+    Генератор записей файла, начиная с байта offset
+    :param path: Путь к файлу
+    :type path: str
+    :param file_format: ndjson или csv
+    :type file_format: str
+    :param entity: Вид записей
+    :type entity: Entity
+    :param offset: Позиция в файле, с которой продолжить (0 - с начала)
+    :type offset: int
+    :param first_row: Номер первой читаемой записи (для сообщений об ошибках)
+    :type first_row: int
+    :return: Пары (значения колонок, позиция в файле после записи)
+    :rtype: Iterator[Tuple[Tuple, int]]
+    """
+    with open(path, "rb") as f:
+        if file_format == "csv":
+            # Заголовок читается всегда, даже при продолжении
+            header: List[str] = next(csv.reader([f.readline().decode("utf-8")]))
+            f.seek(max(offset, f.tell()))
+            reader: LineReader = LineReader(f)
+            # csv.reader читает строки по одной, позиция после записи точная
+            # (в том числе для значений с переводами строк)
+            for i_number, i_values in enumerate(csv.reader(reader), start=first_row):
+                yield convert_row(
+                    entity, dict(zip(header, i_values)), i_number
+                ), reader.offset
+        else:
+            f.seek(offset)
+            reader = LineReader(f)
+            for i_number, i_line in enumerate(reader, start=first_row):
+                if not i_line.strip():
+                    continue
+                try:
+                    row: Dict[str, Any] = orjson.loads(i_line)
+                except orjson.JSONDecodeError:
+                    raise BulkError("row {}: invalid JSON".format(i_number))
+                yield convert_row(entity, row, i_number), reader.offset
+
+
+def get_changed_counters(name: str, batch: List[Tuple]) -> Set[str]:
+    """
+    Функция возвращающая счётчики изменений, затронутые пачкой
+    :param name: Вид записей
+    :type name: str
+    :param batch: Строки пачки
+    :type batch: List[Tuple]
+    :return: Ключи счётчиков
+    :rtype: Set[str]
+    """
+    # Пачка затрагивает твиты всех счётчиков (и ленты подписок)
+    if name in ("tweets", "likes"):
+        return set(TWEETS_COUNTERS)
+
+    if name == "follows":
+        return {
+            get_user_counter(i_user_id) for i_row in batch for i_user_id in i_row
+        }
+
+    # Новые пользователи ещё нигде не показывались
+    return set()
+
+
+async def import_batch(
+    session: AsyncSession, name: str, batch: List[Tuple]
+) -> int:
+    """
+    Корутин загружающий пачку записей в транзакции сессии
+    :param session: Сессия с открытой транзакцией
+    :type session: AsyncSession
+    :param name: Вид записей
+    :type name: str
+    :param batch: Строки пачки
+    :type batch: List[Tuple]
+    :return: Количество добавленных записей
+    :rtype: int
+    """
+    entity: Entity = ENTITIES[name]
+    staging: str = "bulk_{}".format(name)
+    column_types: Dict[type, str] = {int: "bigint", str: "text"}
+    is_postgres_timeline: bool = isinstance(timeline_store, PostgresTimelineStore)
+
+    connection: AsyncConnection = await session.connection()
+    await connection.execute(
+        text(
+            "CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP".format(
+                staging,
+                ", ".join(
+                    "{} {}".format(i_column, column_types[i_type])
+                    for i_column, i_type in zip(entity.columns, entity.types)
+                ),
+            )
+        )
+    )
+
+    # COPY во временную таблицу напрямую через драйвер asyncpg
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        staging, records=batch, columns=list(entity.columns)
+    )
+
+    params: Dict[str, Any] = dict()
+
+    if name == "tweets":
+        # Твиты авторов с большим количеством подписчиков не рассылаются
+        await connection.execute(
+            text(MERGE_ON_READ_QUERY.format(column="author_id", staging=staging)),
+            {"max_followers": FANOUT_MAX_FOLLOWERS},
+        )
+        import_query: str = entity.import_query.format(
+            fan_out=TWEETS_FAN_OUT if is_postgres_timeline else ""
+        )
+    elif name == "follows":
+        import_query = entity.import_query.format(
+            backfill=FOLLOWS_BACKFILL if is_postgres_timeline else ""
+        )
+        if is_postgres_timeline:
+            params["backfill_size"] = TIMELINE_INBOX_SIZE
+    else:
+        import_query = entity.import_query
+
+    inserted: int = await connection.scalar(text(import_query), params)
+
+    if name == "follows":
+        await connection.execute(
+            text(MERGE_ON_READ_QUERY.format(column="following_id", staging=staging)),
+            {"max_followers": FANOUT_MAX_FOLLOWERS},
+        )
+
+    # id из файла могли обогнать последовательность
+    if name in ("users", "tweets"):
+        await connection.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "greatest((SELECT max(id) FROM {0}), 1))".format(name)
+            )
+        )
+
+    await bump_counters(session, get_changed_counters(name, batch))
+
+    return inserted
+
+
+async def import_file(
+    name: str,
+    path: str,
+    file_format: str | None = None,
+    batch_size: int = BULK_BATCH_SIZE,
+    checkpoint_path: str | None = None,
+) -> Tuple[int, int]:
+    """
+    Корутин импортирующий файл пачками с сохранением контрольной точки
+    :param name: Вид записей (users, tweets, follows, likes)
+    :type name: str
+    :param path: Путь к файлу
+    :type path: str
+    :param file_format: ndjson или csv (по умолчанию - по расширению)
+    :type file_format: str | None
+    :param batch_size: Количество строк в пачке
+    :type batch_size: int
+    :param checkpoint_path: Путь к контрольной точке (по умолчанию <файл>.checkpoint)
+    :type checkpoint_path: str | None
+    :return: Количество прочитанных записей и количество добавленных
+    :rtype: Tuple[int, int]
+    """
+    file_format = get_format(path, file_format)
+    checkpoint_path = checkpoint_path or "{}.checkpoint".format(path)
+    checkpoint: Dict[str, Any] = {
+        "operation": "import",
+        "entity": name,
+        "path": os.path.abspath(path),
+        "size": os.path.getsize(path),
+        "offset": 0,
+        "rows": 0,
+        "inserted": 0,
+    }
+    checkpoint.update(
+        load_checkpoint(
+            checkpoint_path,
+            {
+                i_key: checkpoint[i_key]
+                for i_key in ("operation", "entity", "path", "size")
+            },
+        )
+    )
+
+    batch: List[Tuple] = list()
+    offset: int = checkpoint["offset"]
+
+    async def flush() -> None:
+        async with async_session() as session:
+            async with session.begin():
+                checkpoint["inserted"] += await import_batch(session, name, batch)
+
+        await response_cache.invalidate(get_changed_counters(name, batch))
+
+        checkpoint["rows"] += len(batch)
+        checkpoint["offset"] = offset
+        save_checkpoint(checkpoint_path, checkpoint)
+        batch.clear()
+
+    # Продолжаем с контрольной точки (0 - с начала файла)
+    for i_row, offset in read_rows(
+        path,
+        file_format,
+        ENTITIES[name],
+        checkpoint["offset"],
+        first_row=checkpoint["rows"] + 1,
+    ):
+        batch.append(i_row)
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+
+    # Файл загружен полностью
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return checkpoint["rows"], checkpoint["inserted"]
+
+
+async def stream_rows(
+    name: str, after: List[Any] | None, batch_size: int
+) -> AsyncIterator[List[Tuple]]:
+    """
+    Асинхронный генератор пачек записей, отсортированных по ключу экспорта
+    (курсор на стороне сервера, в памяти не больше одной пачки)
+    :param name: Вид записей
+    :type name: str
+    :param after: Ключ последней выгруженной записи (для продолжения)
+    :type after: List[Any] | None
+    :param batch_size: Количество строк в пачке
+    :type batch_size: int
+    :return: Пачки строк
+    :rtype: AsyncIterator[List[Tuple]]
+    """
+    entity: Entity = ENTITIES[name]
+    key: str = ", ".join(entity.export_key)
+    query: str = "SELECT * FROM ({}) exported".format(entity.export_query)
+    params: Dict[str, Any] = dict()
+
+    if after is not None:
+        query += " WHERE ({}) > ({})".format(
+            key, ", ".join(":after_{}".format(i) for i in range(len(after)))
+        )
+        params = {"after_{}".format(i): i_value for i, i_value in enumerate(after)}
+
+    query += " ORDER BY {}".format(key)
+
+    async with engine.connect() as connection:
+        result = await connection.stream(
+            text(query).execution_options(yield_per=batch_size), params
+        )
+        async for i_partition in result.partitions():
+            yield [tuple(i_row) for i_row in i_partition]
+
+
+def format_rows(entity: Entity, file_format: str, rows: List[Tuple]) -> bytes:
+    """Функция форматирующая пачку строк в NDJSON или CSV"""
+    if file_format == "csv":
+        buffer: io.StringIO = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+    return b"".join(
+        orjson.dumps(dict(zip(entity.columns, i_row))) + b"\n" for i_row in rows
+    )
+
+
+async def export_file(
+    name: str,
+    path: str,
+    file_format: str | None = None,
+    batch_size: int = BULK_BATCH_SIZE,
+    checkpoint_path: str | None = None,
+) -> int:
+    """
+    Корутин экспортирующий записи в файл пачками с сохранением контрольной точки
+    :param name: Вид записей (users, tweets, follows, likes)
+    :type name: str
+    :param path: Путь к файлу
+    :type path: str
+    :param file_format: ndjson или csv (по умолчанию - по расширению)
+    :type file_format: str | None
+    :param batch_size: Количество строк в пачке
+    :type batch_size: int
+    :param checkpoint_path: Путь к контрольной точке (по умолчанию <файл>.checkpoint)
+    :type checkpoint_path: str | None
+    :return: Количество выгруженных записей
+    :rtype: int
+    """
+    entity: Entity = ENTITIES[name]
+    file_format = get_format(path, file_format)
+    checkpoint_path = checkpoint_path or "{}.checkpoint".format(path)
+    checkpoint: Dict[str, Any] = {
+        "operation": "export",
+        "entity": name,
+        "path": os.path.abspath(path),
+        "offset": 0,
+        "rows": 0,
+        "after": None,
+    }
+    checkpoint.update(
+        load_checkpoint(
+            checkpoint_path,
+            {i_key: checkpoint[i_key] for i_key in ("operation", "entity", "path")},
+        )
+    )
+    key_indexes: List[int] = [
+        entity.columns.index(i_column) for i_column in entity.export_key
+    ]
+
+    with open(path, "r+b" if checkpoint["offset"] else "wb") as f:
+        # Отбрасываем то, что записано после контрольной точки
+        f.truncate(checkpoint["offset"])
+        f.seek(checkpoint["offset"])
+
+        if file_format == "csv" and not checkpoint["offset"]:
+            f.write(format_rows(entity, file_format, [entity.columns]))
+
+        async for i_batch in stream_rows(name, checkpoint["after"], batch_size):
+            f.write(format_rows(entity, file_format, i_batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+            checkpoint["rows"] += len(i_batch)
+            checkpoint["offset"] = f.tell()
+            checkpoint["after"] = [i_batch[-1][i] for i in key_indexes]
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return checkpoint["rows"]
+
+
+async def run(args: argparse.Namespace) -> None:
+    """Корутин выполняющий команду и печатающий итог"""
+    start: float = time.perf_counter()
+    options: Dict[str, Any] = {
+        "file_format": args.format,
+        "batch_size": args.batch_size,
+        "checkpoint_path": args.checkpoint,
+    }
+
+    try:
+        if args.command == "import":
+            rows, inserted = await import_file(args.entity, args.path, **options)
+            summary: str = "imported {} {}: {} new, {} skipped".format(
+                rows, args.entity, inserted, rows - inserted
+            )
+        else:
+            rows = await export_file(args.entity, args.path, **options)
+            summary = "exported {} {}".format(rows, args.entity)
+    finally:
+        await engine.dispose()
+
+    print("{} in {:.1f}s".format(summary, time.perf_counter() - start))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("entity", choices=ENTITIES)
+    parser.add_argument("path", help="NDJSON or CSV file")
+    parser.add_argument(
+        "--format", choices=("ndjson", "csv"), help="default: by file extension"
+    )
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument(
+        "--checkpoint", help="checkpoint file (default: <path>.checkpoint)"
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except BulkError as exc:
+        parser.exit(1, "error: {}\n".format(exc))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import hashlib
+import os
+from typing import Dict, Iterable, List, Set
+
+from sqlalchemy import BigInteger, Integer, String, cast, literal, union
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine.result import ChunkedIteratorResult
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql.selectable import CompoundSelect, Select, Subquery
+
+from database.database import (
+    ChangeCounters,
+    integration_followers,
+    run_after_commit,
+    run_before_commit,
+)
+from database.response_cache import response_cache
+
+# Количество счётчиков твитов: изменения разных твитов (лайки, удаление,
+# готовность уменьшенных картинок) увеличивают разные строки и не ждут друг друга
+TWEETS_COUNTER_SHARDS: int = int(os.getenv("TWEETS_COUNTER_SHARDS", 16))
+# Ключ в session.info с набором счётчиков, изменённых в транзакции
+CHANGED_COUNTERS_KEY: str = "changed_counters"
+
+
+def get_tweets_counter(tweet_id: int) -> str:
+    """
+    Функция возвращающая счётчик твитов, к которому относится твит
+    :param tweet_id: id твита
+    :type tweet_id: int
+    :return: Ключ счётчика
+    :rtype: str
+    """
+    return "tweets:{}".format(tweet_id % TWEETS_COUNTER_SHARDS)
+
+
+# Все счётчики твитов: версия ленты складывается из них
+TWEETS_COUNTERS: List[str] = [
+    "tweets:{}".format(i_shard) for i_shard in range(TWEETS_COUNTER_SHARDS)
+]
+
+
+def get_timeline_counter(user_id: int) -> str:
+    """
+    Функция возвращающая счётчик ленты подписок пользователя
+    (меняется, когда в ленту рассылается новый твит)
+    :param user_id: id пользователя
+    :type user_id: int
+    :return: Ключ счётчика
+    :rtype: str
+    """
+    return "timeline:{}".format(user_id)
+
+
+def get_user_counter(user_id: int) -> str:
+    """
+    Функция возвращающая счётчик профиля пользователя
+    (меняется при подписках пользователя и подписках на него)
+    :param user_id: id пользователя
+    :type user_id: int
+    :return: Ключ счётчика
+    :rtype: str
+    """
+    return "user:{}".format(user_id)
+
+
+async def bump_counters(session: AsyncSession, keys: Iterable[str]) -> None:
+    """
+    Корутин увеличивающий счётчики одним запросом.
+    Ключи сортируются, чтобы параллельные транзакции блокировали строки
+    в одном порядке
+    :param session: Сессия, в транзакции которой были изменения
+    :type session: AsyncSession
+    :param keys: Ключи счётчиков
+    :type keys: Iterable[str]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    sorted_keys: List[str] = sorted(set(keys))
+
+    if not sorted_keys:
+        return
+
+    bump_query = insert(ChangeCounters).values(
+        [{"key": i_key, "version": 1} for i_key in sorted_keys]
+    )
+    await session.execute(
+        bump_query.on_conflict_do_update(
+            index_elements=[ChangeCounters.key],
+            set_={"version": ChangeCounters.version + 1},
+        )
+    )
+
+
+async def bump_timeline_counters(
+    session: AsyncSession, author_id: int, followers: bool
+) -> None:
+    """
+    Корутин увеличивающий счётчики лент автора и его подписчиков одним
+    запросом INSERT ... SELECT, без выборки подписчиков в приложение
+    :param session: Сессия, в транзакции которой был записан твит
+    :type session: AsyncSession
+    :param author_id: id автора твита
+    :type author_id: int
+    :param followers: Твит разослан подписчикам (иначе - только лента автора)
+    :type followers: bool
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    recipients: Select | CompoundSelect = select(
+        cast(literal(author_id), Integer).label("user_id")
+    )
+
+    if followers:
+        recipients = union(
+            recipients,
+            select(integration_followers.c.user_id).where(
+                integration_followers.c.following_id == author_id
+            ),
+        )
+
+    recipients_subquery: Subquery = recipients.subquery("recipients")
+    # Строки блокируются в порядке ключей, как в bump_counters
+    keys: Select = select(
+        (
+            literal("timeline:") + cast(recipients_subquery.c.user_id, String)
+        ).label("key"),
+        cast(literal(1), BigInteger).label("version"),
+    ).order_by("key")
+
+    bump_query = insert(ChangeCounters).from_select(["key", "version"], keys)
+    await session.execute(
+        bump_query.on_conflict_do_update(
+            index_elements=[ChangeCounters.key],
+            set_={"version": ChangeCounters.version + 1},
+        )
+    )
+
+
+def mark_timelines_changed(
+    session: AsyncSession, author_id: int, followers: bool = True
+) -> None:
+    """
+    Функция отмечающая новый твит в лентах автора и его подписчиков,
+    счётчики увеличиваются в конце транзакции запроса.
+    Кэш ответов не сбрасывается: версия ленты входит в ключ ответа
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param author_id: id автора твита
+    :type author_id: int
+    :param followers: Твит разослан подписчикам (иначе - только лента автора)
+    :type followers: bool
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    run_before_commit(
+        session, lambda: bump_timeline_counters(session, author_id, followers)
+    )
+
+
+def mark_changed(session: AsyncSession, *keys: str) -> None:
+    """
+    Функция отмечающая изменённые счётчики, они увеличиваются один раз
+    в конце транзакции запроса (строка счётчика блокируется только до commit).
+    После commit по тем же ключам сбрасываются ответы в кэше ответов
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param keys: Ключи счётчиков
+    :type keys: str
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    changed: Set[str] | None = session.info.get(CHANGED_COUNTERS_KEY)
+
+    if changed is None:
+        changed = session.info[CHANGED_COUNTERS_KEY] = set()
+        run_before_commit(
+            session,
+            lambda: bump_counters(
+                session, session.info.pop(CHANGED_COUNTERS_KEY, set())
+            ),
+        )
+        # Сброс только после commit: иначе параллельный запрос успеет
+        # закэшировать ещё не изменённые данные под новым поколением
+        run_after_commit(session, lambda: response_cache.invalidate(changed))
+
+    changed.update(keys)
+
+
+async def get_counters(session: AsyncSession, keys: List[str]) -> List[int]:
+    """
+    Корутин возвращающий значения счётчиков одним запросом
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param keys: Ключи счётчиков
+    :type keys: List[str]
+    :return: Значения счётчиков в порядке ключей (0, если счётчика ещё нет)
+    :rtype: List[int]
+    """
+    counters_query: Select = select(
+        ChangeCounters.key, ChangeCounters.version
+    ).where(ChangeCounters.key.in_(keys))
+    counters_result: ChunkedIteratorResult = await session.execute(
+        counters_query
+    )
+    versions: Dict[str, int] = dict(counters_result.tuples().all())
+
+    return [versions.get(i_key, 0) for i_key in keys]
+
+
+def make_etag(*parts) -> str:
+    """
+    Функция строящая слабый ETag из значений счётчиков и параметров запроса
+    :param parts: Значения счётчиков, id пользователя и параметры запроса
+    :return: ETag
+    :rtype: str
+    """
+    digest: str = hashlib.blake2b(
+        ":".join(str(i_part) for i_part in parts).encode(), digest_size=12
+    ).hexdigest()
+
+    return 'W/"{}"'.format(digest)
+
+
+def is_not_modified(if_none_match: str | None, etag: str) -> bool:
+    """
+    Функция проверяющая заголовок If-None-Match
+    :param if_none_match: Значение заголовка
+    :type if_none_match: str | None
+    :param etag: Текущий ETag ресурса
+    :type etag: str
+    :return: True, если у клиента актуальная версия
+    :rtype: bool
+    """
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    # Для GET сравнение слабое: префикс W/ не учитывается
+    return etag.removeprefix("W/") in [
+        i_tag.strip().removeprefix("W/") for i_tag in if_none_match.split(",")
+    ]
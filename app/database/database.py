@@ -1,8 +1,33 @@
+import datetime
+import inspect
 import os
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
 
 from dotenv import load_dotenv
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Computed,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+    false,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import (
     Mapped,
@@ -13,6 +38,8 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
+from database.instrumentation import InstrumentedPool, instrument_engine
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -40,13 +67,134 @@ def get_database_url():
     return database_url
 
 
+def get_engine_options() -> Dict[str, Any]:
+    """
+    Функция получающая настройки пула соединений и движка из переменных окружения
+    :return: Аргументы для create_async_engine
+    :rtype: Dict[str, Any]
+    """
+    # Время выполнения запроса в миллисекундах, 0 - без ограничения
+    statement_timeout: int = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))
+    connect_args: Dict[str, Any] = dict()
+    if statement_timeout > 0:
+        connect_args["server_settings"] = {
+            "statement_timeout": str(statement_timeout)
+        }
+
+    engine_options: Dict[str, Any] = {
+        "echo": os.getenv("DB_ECHO", "false").lower() == "true",
+        "poolclass": InstrumentedPool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+        "connect_args": connect_args,
+    }
+
+    return engine_options
+
+
 DATABASE_URL: str = get_database_url()
 # Создаем асинхронный движок
-engine: AsyncEngine = create_async_engine(DATABASE_URL, echo=True)
+engine: AsyncEngine = create_async_engine(DATABASE_URL, **get_engine_options())
+# Подключаем метрики пула соединений
+instrument_engine(engine)
 # Создаём асинхронную сессию
 async_session: sessionmaker = sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession
 )
+# Ключи в session.info со списками действий перед сохранением транзакции
+# и после него
+BEFORE_COMMIT_KEY: str = "before_commit"
+AFTER_COMMIT_KEY: str = "after_commit"
+
+
+@asynccontextmanager
+async def transaction(
+    session_maker: sessionmaker = async_session,
+) -> AsyncIterator[AsyncSession]:
+    """
+    Контекстный менеджер: сессия с одной транзакцией, с действиями
+    run_before_commit и run_after_commit, как у сессии запроса.
+    Транзакция сохраняется при выходе из блока, при ошибке - откатывается
+    :param session_maker: Фабрика сессий (по умолчанию - основная БД)
+    :type session_maker: sessionmaker
+    :return: Сессия транзакции
+    :rtype: AsyncIterator[AsyncSession]
+    """
+    async with session_maker() as transaction_session:
+        async with transaction_session.begin():
+            yield transaction_session
+
+            # Блок завершился без ошибок: действия перед сохранением
+            for i_callback in transaction_session.info.pop(BEFORE_COMMIT_KEY, []):
+                await i_callback()
+
+        # Транзакция сохранена, выполняем отложенные действия
+        for i_callback in transaction_session.info.pop(AFTER_COMMIT_KEY, []):
+            result: Awaitable[None] | None = i_callback()
+            if inspect.isawaitable(result):
+                await result
+
+
+def run_before_commit(
+    session: AsyncSession, callback: Callable[[], Awaitable[None]]
+) -> None:
+    """
+    Функция откладывающая запрос до конца транзакции сессии запроса
+    (например, обновление общих счётчиков, чтобы блокировка строки
+    удерживалась как можно меньше)
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param callback: Корутин-функция без аргументов
+    :type callback: Callable[[], Awaitable[None]]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    session.info.setdefault(BEFORE_COMMIT_KEY, []).append(callback)
+
+
+def run_after_commit(
+    session: AsyncSession, callback: Callable[[], Awaitable[None] | None]
+) -> None:
+    """
+    Функция откладывающая действие до сохранения транзакции сессии запроса
+    (например, удаление файлов с диска), при откате действие не выполняется
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param callback: Функция или корутин-функция без аргументов
+    :type callback: Callable[[], Awaitable[None] | None]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    session.info.setdefault(AFTER_COMMIT_KEY, []).append(callback)
+
+
+async def release_connection(session: AsyncSession) -> None:
+    """
+    Корутин досрочно сохраняющий транзакцию сессии запроса (с действиями
+    run_before_commit), чтобы вернуть соединение в пул перед долгим ожиданием без запросов
+    (например, записи пачки лайков в другой транзакции, которой нужно
+    своё соединение). После него сессия запроса не используется для запросов,
+    действия run_after_commit выполняются как обычно в конце запроса
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    for i_callback in session.info.pop(BEFORE_COMMIT_KEY, []):
+        await i_callback()
+
+    await session.commit()
+
+
+# Конфигурация полнотекстового поиска: simple - без стемминга,
+# одинаково для русского и английского текста
+SEARCH_CONFIG: str = "simple"
+# Размер списка ожидания полнотекстового индекса, в килобайтах
+SEARCH_PENDING_LIST_LIMIT: int = 4096
+
 # Создаём базу
 Base: DeclarativeMeta = declarative_base()
 # Сессия
@@ -58,6 +206,8 @@ integration_followers = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
     Column("following_id", Integer, ForeignKey("users.id"), primary_key=True),
+    # Обратный индекс, нужен для выборки подписчиков пользователя
+    Index("ix_followers_following_id_user_id", "following_id", "user_id"),
 )
 
 # Таблица для связи Many-to-Many для таблиц Users и Tweets
@@ -66,6 +216,8 @@ integration_like = Table(
     Base.metadata,
     Column("tweet_id", Integer, ForeignKey("tweets.id"), primary_key=True),
     Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
+    # Обратный индекс, нужен для выборки лайков пользователя
+    Index("ix_like_user_id_tweet_id", "user_id", "tweet_id"),
 )
 
 
@@ -73,10 +225,20 @@ class Users(Base):
     """Таблица пользователей"""
 
     __tablename__ = "users"
+    # Авторизация по Api-Key: поиск по индексу, ключи не повторяются
+    __table_args__ = (Index("ix_users_api_key", "api_key", unique=True),)
     # Определяем поля таблицы
     id: Mapped[int] = mapped_column(primary_key=True)
     user: Mapped[str] = mapped_column(String(50), nullable=False)
     api_key: Mapped[str] = mapped_column(String(50), nullable=False)
+    # У пользователя слишком много подписчиков для рассылки твитов по лентам,
+    # его твиты подмешиваются в ленту подписчиков при чтении
+    merge_on_read: Mapped[bool] = mapped_column(
+        default=False, server_default=false()
+    )
+    # Счётчики подписчиков и подписок, обновляются вместе с таблицей followers
+    followers_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    following_count: Mapped[int] = mapped_column(default=0, server_default="0")
 
     # Определяем связь One-to-Many с таблицей Tweets
     tweet: Mapped[List["Tweets"]] = Relationship(back_populates="author")
@@ -109,10 +271,35 @@ class Tweets(Base):
     """Таблица твитов"""
 
     __tablename__ = "tweets"
+    __table_args__ = (
+        # Составной индекс для постраничной выборки твитов конкретных авторов
+        Index("ix_tweets_author_id_id", "author_id", "id"),
+        # Полнотекстовый индекс. Новые записи попадают в список ожидания
+        # индекса (fastupdate) и переносятся в индекс фоновой очисткой,
+        # а не при записи твита
+        Index(
+            "ix_tweets_search_vector",
+            "search_vector",
+            postgresql_using="gin",
+            postgresql_with={
+                "fastupdate": "on",
+                "gin_pending_list_limit": SEARCH_PENDING_LIST_LIMIT,
+            },
+        ),
+    )
     # Определяем поля таблицы
     id: Mapped[int] = mapped_column(primary_key=True)
     tweet: Mapped[str] = mapped_column(nullable=False)
     author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # Счётчик лайков, обновляется вместе с таблицей like
+    like_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    # Слова твита для полнотекстового поиска, вычисляются БД из текста
+    # (загружается только по требованию)
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('{}', tweet)".format(SEARCH_CONFIG), persisted=True),
+        deferred=True,
+    )
 
     # Определяем связь Many-to-One для с таблицей Users
     author: Mapped[List["Users"]] = Relationship(back_populates="tweet")
@@ -134,11 +321,31 @@ class Media(Base):
     """Таблица медиа, содержит путь к картинкам"""
 
     __tablename__ = "media"
+    # Индекс для поиска загрузок, так и не прикреплённых к твиту (см. media_gc.py)
+    __table_args__ = (
+        Index(
+            "ix_media_orphan_created_at",
+            "created_at",
+            postgresql_where=text("tweet_id IS NULL"),
+        ),
+    )
     # Определяем поля таблицы
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    media_path: Mapped[str] = mapped_column(String(64))
+    # Путь к файлу строится из хэша содержимого, одинаковые файлы хранятся один раз.
+    # Количество записей с одним путём - это количество ссылок на файл
+    media_path: Mapped[str] = mapped_column(String(128), index=True)
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    # Уменьшенные варианты картинки, заполняются фоновой обработкой
+    thumbnail_path: Mapped[Optional[str]] = mapped_column(
+        String(128), nullable=True
+    )
+    feed_path: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    large_path: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
     tweet_id: Mapped[Optional[int]] = mapped_column(
-        ForeignKey("tweets.id"), nullable=True
+        ForeignKey("tweets.id"), nullable=True, index=True
+    )
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
     )
 
     # Определяем связь Many-to-One для с таблицей Tweets
@@ -149,3 +356,77 @@ class Media(Base):
     # метод класса для конвертации экземпляра класса в формат json
     def to_json(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class MediaDeletions(Base):
+    """
+    Таблица файлов к удалению с диска, записывается в транзакции удаления
+    записей Media, файлы удаляет фоновая задача (см. media_gc.py)
+    """
+
+    __tablename__ = "media_deletions"
+    # Определяем поля таблицы
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    media_path: Mapped[str] = mapped_column(String(128))
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+    # метод класса для конвертации экземпляра класса в формат json
+    def to_json(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class Timeline(Base):
+    """Таблица лент пользователей (id твитов, разосланных подписчикам при записи)"""
+
+    __tablename__ = "timeline"
+    # Индексы для удаления записей при удалении твита и при отписке от автора
+    __table_args__ = (
+        Index("ix_timeline_tweet_id", "tweet_id"),
+        Index("ix_timeline_user_id_author_id", "user_id", "author_id"),
+    )
+    # Определяем поля таблицы
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id"), primary_key=True
+    )
+    tweet_id: Mapped[int] = mapped_column(
+        ForeignKey("tweets.id"), primary_key=True
+    )
+    author_id: Mapped[int] = mapped_column(Integer)
+
+    # метод класса для конвертации экземпляра класса в формат json
+    def to_json(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class ChangeCounters(Base):
+    """
+    Таблица счётчиков изменений: версии твитов, лент подписок и профилей,
+    по ним строятся ETag для условных GET-запросов
+    """
+
+    __tablename__ = "change_counters"
+    # Определяем поля таблицы
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    # метод класса для конвертации экземпляра класса в формат json
+    def to_json(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class SchemaVersion(Base):
+    """Таблица применённых миграций схемы БД (см. migrations.py)"""
+
+    __tablename__ = "schema_version"
+    # Определяем поля таблицы
+    version: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(200))
+    applied_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+    # метод класса для конвертации экземпляра класса в формат json
+    def to_json(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -0,0 +1,407 @@
+"""
+События для потока GET /api/events (server-sent events).
+Изменения твитов и лайков публикуются в транзакции изменения
+и доставляются подписчикам только после её commit.
+
+Подписка (одно SSE-соединение) получает события о твитах авторов,
+на которых подписан пользователь, и о своих твитах. У каждой подписки
+своя ограниченная очередь: если клиент не успевает читать, накопленные
+события отбрасываются и вместо них отдаётся событие reset - клиент
+должен заново загрузить ленту.
+
+Брокер событий задаётся переменной окружения EVENTS_BROKER:
+memory - доставка внутри процесса (один воркер),
+postgres - через LISTEN/NOTIFY, события доставляются во все воркеры.
+"""
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Set
+
+import asyncpg
+import orjson
+from prometheus_client import Counter, Gauge
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from database.database import engine, run_after_commit, run_before_commit
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Брокер событий: memory или postgres
+EVENTS_BROKER: str = os.getenv("EVENTS_BROKER", "memory")
+# Длина очереди событий одного соединения
+EVENTS_QUEUE_SIZE: int = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+# Максимальное количество одновременных соединений в одном воркере
+EVENTS_MAX_SUBSCRIBERS: int = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 1000))
+# Интервал пустых сообщений, не дающих прокси закрыть соединение, в секундах
+EVENTS_HEARTBEAT: float = float(os.getenv("EVENTS_HEARTBEAT", 15))
+# Канал LISTEN/NOTIFY брокера postgres
+EVENTS_CHANNEL: str = "twitter_events"
+# Максимальный размер одного NOTIFY, в байтах (ограничение Postgres - 8000)
+EVENTS_NOTIFY_PAYLOAD_SIZE: int = 7000
+# Пауза перед повторным подключением брокера postgres, в секундах
+EVENTS_RECONNECT_DELAY: float = 1.0
+# Ключ в session.info со списком событий транзакции
+EVENTS_KEY: str = "events"
+
+# Типы событий: по автору твита доставляются подписчикам автора,
+# подписки и отписки - только самому пользователю
+EVENT_TWEET: str = "tweet"
+EVENT_TWEET_DELETED: str = "tweet_deleted"
+EVENT_LIKE: str = "like"
+EVENT_UNLIKE: str = "unlike"
+EVENT_FOLLOW: str = "follow"
+EVENT_UNFOLLOW: str = "unfollow"
+# Часть событий потеряна, клиенту нужно заново загрузить ленту
+EVENT_RESET: str = "reset"
+
+# Метрики событий, отдаются через /metrics
+EVENTS_SUBSCRIBERS: Gauge = Gauge(
+    "events_subscribers",
+    "Number of open event stream connections",
+    multiprocess_mode="livesum",
+)
+EVENTS_PUBLISHED: Counter = Counter(
+    "events_published", "Number of events received from the broker", ["type"]
+)
+EVENTS_DROPPED: Counter = Counter(
+    "events_dropped",
+    "Number of events dropped because a connection queue was full",
+)
+
+
+class Subscription:
+    """Подписка одного соединения: авторы и очередь событий"""
+
+    def __init__(self, user_id: int, authors: Set[int], queue_size: int) -> None:
+        self.user_id: int = user_id
+        self.authors: Set[int] = authors
+        # None в очереди - подписка закрыта
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, event: Dict | None) -> None:
+        """
+        Функция добавляющая событие в очередь без ожидания.
+        Если очередь заполнена, события в ней заменяются на reset
+        :param event: Событие или None для закрытия подписки
+        :type event: Dict | None
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        try:
+            self.queue.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        EVENTS_DROPPED.inc(self.queue.qsize())
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        self.queue.put_nowait(None if event is None else {"type": EVENT_RESET})
+
+
+class EventHub:
+    """Подписки воркера и доставка им событий"""
+
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE) -> None:
+        self.queue_size: int = queue_size
+        self._by_author: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._by_user: Dict[int, Set[Subscription]] = defaultdict(set)
+
+    @property
+    def subscribers(self) -> int:
+        """Количество открытых подписок"""
+        return sum(len(i_subscriptions) for i_subscriptions in self._by_user.values())
+
+    def subscribe(self, user_id: int, following_ids: List[int]) -> Subscription:
+        """
+        Функция создающая подписку пользователя
+        :param user_id: id пользователя
+        :type user_id: int
+        :param following_ids: id пользователей, на которых он подписан
+        :type following_ids: List[int]
+        :return: Подписка
+        :rtype: Subscription
+        """
+        subscription: Subscription = Subscription(
+            user_id, {user_id, *following_ids}, self.queue_size
+        )
+
+        self._by_user[user_id].add(subscription)
+        for i_author in subscription.authors:
+            self._by_author[i_author].add(subscription)
+
+        EVENTS_SUBSCRIBERS.inc()
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Функция удаляющая подписку (при закрытии соединения)
+        :param subscription: Подписка
+        :type subscription: Subscription
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        self._discard(self._by_user, subscription.user_id, subscription)
+        for i_author in subscription.authors:
+            self._discard(self._by_author, i_author, subscription)
+
+        EVENTS_SUBSCRIBERS.dec()
+
+    @staticmethod
+    def _discard(
+        index: Dict[int, Set[Subscription]], key: int, subscription: Subscription
+    ) -> None:
+        """Функция удаляющая подписку из индекса, пустые наборы не хранятся"""
+        subscriptions: Set[Subscription] | None = index.get(key)
+
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+    def dispatch(self, events: List[Dict]) -> None:
+        """
+        Функция доставляющая события подписанным соединениям
+        :param events: События одной транзакции
+        :type events: List[Dict]
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        for i_event in events:
+            EVENTS_PUBLISHED.labels(i_event["type"]).inc()
+
+            if i_event["type"] in (EVENT_FOLLOW, EVENT_UNFOLLOW):
+                self._update_following(i_event)
+                continue
+
+            for i_subscription in tuple(self._by_author.get(i_event["author_id"], ())):
+                i_subscription.put(i_event)
+
+    def _update_following(self, event: Dict) -> None:
+        """Функция обновляющая авторов подписок пользователя при подписке и отписке"""
+        following_id: int = event["following_id"]
+
+        for i_subscription in tuple(self._by_user.get(event["user_id"], ())):
+            if event["type"] == EVENT_FOLLOW:
+                i_subscription.authors.add(following_id)
+                self._by_author[following_id].add(i_subscription)
+            elif following_id != i_subscription.user_id:
+                i_subscription.authors.discard(following_id)
+                self._discard(self._by_author, following_id, i_subscription)
+
+            i_subscription.put(event)
+
+    def reset(self) -> None:
+        """Функция отправляющая reset всем подпискам (события могли быть потеряны)"""
+        for i_subscriptions in tuple(self._by_user.values()):
+            for i_subscription in tuple(i_subscriptions):
+                i_subscription.put({"type": EVENT_RESET})
+
+    def close(self) -> None:
+        """Функция закрывающая все подписки (при остановке приложения)"""
+        for i_subscriptions in tuple(self._by_user.values()):
+            for i_subscription in tuple(i_subscriptions):
+                i_subscription.put(None)
+
+
+class EventBroker(ABC):
+    """Доставка событий транзакции в EventHub воркеров после commit"""
+
+    def __init__(self, hub: EventHub) -> None:
+        self.hub: EventHub = hub
+
+    @abstractmethod
+    def publish(self, session: AsyncSession, events: List[Dict]) -> None:
+        """
+        Регистрирует список событий транзакции сессии для доставки,
+        список может пополняться до commit
+        """
+
+    async def start(self) -> None:
+        """Начинает получение событий (при запуске приложения)"""
+
+    async def close(self) -> None:
+        """Завершает получение событий (при остановке приложения)"""
+
+
+class InMemoryEventBroker(EventBroker):
+    """Доставка внутри процесса, подходит для одного воркера"""
+
+    def publish(self, session: AsyncSession, events: List[Dict]) -> None:
+        run_after_commit(session, lambda: self.hub.dispatch(events))
+
+
+class PostgresEventBroker(EventBroker):
+    """
+    Доставка через LISTEN/NOTIFY: NOTIFY выполняется в транзакции изменения
+    (Postgres доставляет уведомления только после commit), каждый воркер
+    слушает канал отдельным соединением вне пула
+    """
+
+    def __init__(self, hub: EventHub) -> None:
+        super().__init__(hub)
+        self._listener: asyncio.Task | None = None
+
+    def publish(self, session: AsyncSession, events: List[Dict]) -> None:
+        run_before_commit(session, lambda: self._notify(session, events))
+
+    @staticmethod
+    async def _notify(session: AsyncSession, events: List[Dict]) -> None:
+        """
+        Корутин отправляющий события одним запросом,
+        частями не больше EVENTS_NOTIFY_PAYLOAD_SIZE
+        """
+        payloads: List[str] = list()
+        chunk: List[bytes] = list()
+        chunk_size: int = 0
+
+        for i_event in events:
+            encoded: bytes = orjson.dumps(i_event)
+            if chunk and chunk_size + len(encoded) + 1 > EVENTS_NOTIFY_PAYLOAD_SIZE:
+                payloads.append("[{}]".format(b",".join(chunk).decode()))
+                chunk, chunk_size = list(), 0
+            chunk.append(encoded)
+            chunk_size += len(encoded) + 1
+
+        payloads.append("[{}]".format(b",".join(chunk).decode()))
+
+        await session.execute(
+            select(*(func.pg_notify(EVENTS_CHANNEL, i_payload) for i_payload in payloads))
+        )
+
+    def _on_notification(
+        self, connection: asyncpg.Connection, pid: int, channel: str, payload: str
+    ) -> None:
+        """Функция получающая уведомление канала"""
+        self.hub.dispatch(orjson.loads(payload))
+
+    async def _listen(self) -> None:
+        """
+        Корутин слушающий канал и переподключающийся при потере соединения.
+        После переподключения подпискам отправляется reset
+        """
+        dsn: str = engine.url.set(drivername="postgresql").render_as_string(
+            hide_password=False
+        )
+        reconnect: bool = False
+
+        while True:
+            try:
+                connection: asyncpg.Connection = await asyncpg.connect(dsn)
+                try:
+                    await connection.add_listener(EVENTS_CHANNEL, self._on_notification)
+                    if reconnect:
+                        self.hub.reset()
+
+                    # Проверяем соединение, иначе обрыв сети не будет замечен
+                    while True:
+                        await asyncio.sleep(EVENTS_HEARTBEAT)
+                        await connection.execute("SELECT 1")
+                finally:
+                    await connection.close(timeout=EVENTS_RECONNECT_DELAY)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("event listener connection failed, reconnecting")
+
+            reconnect = True
+            await asyncio.sleep(EVENTS_RECONNECT_DELAY)
+
+    async def start(self) -> None:
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+
+
+def get_event_broker(hub: EventHub) -> EventBroker:
+    """
+    Функция создающая брокер событий, выбранный в переменной окружения EVENTS_BROKER
+    :param hub: Подписки воркера
+    :type hub: EventHub
+    :return: Брокер событий
+    :rtype: EventBroker
+    """
+    if EVENTS_BROKER == "postgres":
+        return PostgresEventBroker(hub)
+
+    return InMemoryEventBroker(hub)
+
+
+def publish_event(session: AsyncSession, event_type: str, **fields: int) -> None:
+    """
+    Функция публикующая событие, оно будет доставлено после commit
+    транзакции сессии (при откате - не будет)
+    :param session: Сессия, в транзакции которой было изменение
+    :type session: AsyncSession
+    :param event_type: Тип события
+    :type event_type: str
+    :param fields: Поля события (author_id - автор твита)
+    :type fields: int
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    events: List[Dict] | None = session.info.get(EVENTS_KEY)
+
+    if events is None:
+        events = session.info[EVENTS_KEY] = list()
+        event_broker.publish(session, events)
+
+    events.append({"type": event_type, **fields})
+
+
+def format_event(event: Dict) -> bytes:
+    """
+    Функция форматирующая событие для потока text/event-stream
+    :param event: Событие
+    :type event: Dict
+    :return: Сообщение SSE
+    :rtype: bytes
+    """
+    return b"event: " + event["type"].encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
+
+
+async def stream_events(user_id: int, following_ids: List[int]) -> AsyncIterator[bytes]:
+    """
+    Асинхронный генератор сообщений SSE для одного соединения.
+    Подписка создаётся при начале отправки и удаляется при закрытии соединения
+    :param user_id: id пользователя
+    :type user_id: int
+    :param following_ids: id пользователей, на которых он подписан
+    :type following_ids: List[int]
+    :return: Сообщения SSE
+    :rtype: AsyncIterator[bytes]
+    """
+    subscription: Subscription = event_hub.subscribe(user_id, following_ids)
+
+    try:
+        while True:
+            try:
+                event: Dict | None = await asyncio.wait_for(
+                    subscription.queue.get(), EVENTS_HEARTBEAT
+                )
+            except asyncio.TimeoutError:
+                # Комментарий SSE, клиент его игнорирует
+                yield b": ping\n\n"
+                continue
+
+            if event is None:
+                return
+
+            yield format_event(event)
+    finally:
+        event_hub.unsubscribe(subscription)
+
+
+# Подписки и брокер событий приложения
+event_hub: EventHub = EventHub()
+event_broker: EventBroker = get_event_broker(event_hub)
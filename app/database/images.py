@@ -0,0 +1,115 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен, варианты картинок не создаются
+    Image = None
+    ImageOps = None
+
+# Количество процессов для обработки картинок (0 - обработка отключена)
+IMAGE_WORKERS: int = int(os.getenv("IMAGE_WORKERS", 2))
+# Качество сжатия вариантов картинок
+IMAGE_VARIANTS_QUALITY: int = int(os.getenv("IMAGE_VARIANTS_QUALITY", 80))
+# Варианты картинок и максимальный размер их большей стороны в пикселях:
+# миниатюра, картинка для ленты и оригинал, ограниченный по размеру
+IMAGE_VARIANTS: Dict[str, int] = {
+    "thumbnail": 320,
+    "feed": 1080,
+    "large": 2048,
+}
+# Формат вариантов картинок
+IMAGE_VARIANTS_FORMAT: str = "webp"
+
+# Пул процессов, создаётся при первой обработке
+_image_pool: ProcessPoolExecutor | None = None
+
+
+def is_image_processing_enabled() -> bool:
+    """Функция проверяющая, можно ли создавать варианты картинок"""
+    return Image is not None and IMAGE_WORKERS > 0
+
+
+def get_variant_path(media_path: str, variant: str) -> str:
+    """
+    Функция строящая путь к варианту картинки рядом с исходным файлом
+    :param media_path: Путь к исходному файлу
+    :type media_path: str
+    :param variant: Название варианта из IMAGE_VARIANTS
+    :type variant: str
+    :return: Путь к варианту картинки
+    :rtype: str
+    """
+    return "{}_{}.{}".format(
+        os.path.splitext(media_path)[0], variant, IMAGE_VARIANTS_FORMAT
+    )
+
+
+def get_variant_paths(media_path: str) -> List[str]:
+    """Функция возвращающая пути ко всем вариантам картинки"""
+    return [
+        get_variant_path(media_path, i_variant) for i_variant in IMAGE_VARIANTS
+    ]
+
+
+def render_variants(media_root: str, media_path: str) -> Dict[str, str]:
+    """
+    Функция создающая варианты картинки, выполняется в пуле процессов
+    :param media_root: Корень медиа
+    :type media_root: str
+    :param media_path: Путь к исходному файлу относительно корня медиа
+    :type media_path: str
+    :return: Словарь вариант -> путь к варианту относительно корня медиа
+    :rtype: Dict[str, str]
+    """
+    variants: Dict[str, str] = dict()
+
+    with Image.open(os.path.join(media_root, media_path)) as source:
+        # Поворачиваем картинку по EXIF, у вариантов метаданных не будет
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        for i_variant, i_max_side in IMAGE_VARIANTS.items():
+            variant_path: str = get_variant_path(media_path, i_variant)
+            variant_file_path: str = os.path.join(media_root, variant_path)
+
+            # Вариант уже создан (файл с таким содержимым загружали раньше)
+            if not os.path.exists(variant_file_path):
+                variant_image = image.copy()
+                variant_image.thumbnail((i_max_side, i_max_side))
+
+                # Пишем во временный файл и атомарно переименовываем
+                tmp_file_path: str = "{}.{}.tmp".format(
+                    variant_file_path, os.getpid()
+                )
+                variant_image.save(
+                    tmp_file_path,
+                    format=IMAGE_VARIANTS_FORMAT,
+                    quality=IMAGE_VARIANTS_QUALITY,
+                )
+                os.replace(tmp_file_path, variant_file_path)
+
+            variants[i_variant] = variant_path
+
+    return variants
+
+
+def get_image_pool() -> ProcessPoolExecutor:
+    """Функция возвращающая пул процессов для обработки картинок"""
+    global _image_pool
+
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+
+    return _image_pool
+
+
+def shutdown_image_pool() -> None:
+    """Функция завершающая пул процессов (дожидается текущих задач)"""
+    global _image_pool
+
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=True, cancel_futures=True)
+        _image_pool = None
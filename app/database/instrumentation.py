@@ -0,0 +1,201 @@
+import contextvars
+import re
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Метрики пула соединений с БД, отдаются через /metrics
+DB_POOL_CHECKED_OUT: Gauge = Gauge(
+    "db_pool_checked_out",
+    "Number of database connections currently checked out",
+    multiprocess_mode="livesum",
+)
+DB_POOL_ACQUIRE_SECONDS: Histogram = Histogram(
+    "db_pool_acquire_seconds",
+    "Time spent waiting for a database connection from the pool",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_POOL_ERRORS: Counter = Counter(
+    "db_pool_errors",
+    "Number of database connection errors",
+    ["reason"],
+)
+
+# Метрики SQL-запросов в рамках HTTP-запроса, по маршрутам
+DB_REQUEST_QUERIES: Histogram = Histogram(
+    "db_request_queries",
+    "Number of SQL statements executed per HTTP request",
+    ["method", "handler"],
+    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 34, 55, 100),
+)
+DB_REQUEST_SECONDS: Histogram = Histogram(
+    "db_request_seconds",
+    "Total time spent in SQL statements per HTTP request",
+    ["method", "handler"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_REQUEST_SLOWEST: Counter = Counter(
+    "db_request_slowest_statement",
+    "How often a statement fingerprint was the slowest one of a request",
+    ["method", "handler", "statement"],
+)
+
+# Максимальная длина отпечатка запроса
+STATEMENT_FINGERPRINT_LENGTH: int = 200
+# Замены, превращающие текст запроса в отпечаток без значений параметров:
+# параметры asyncpg ($1::INTEGER), строки и числа заменяются на ?,
+# списки и наборы VALUES одинаковых параметров сворачиваются
+STATEMENT_FINGERPRINT_RULES = (
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\$\d+(::\w+(\[\])?)?"), "?"),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+\b"), "?"),
+    (re.compile(r"\(\?(, \?)*\)(, \(\?(, \?)*\))+"), "(?), ..."),
+    (re.compile(r"\?(, \?)+"), "?, ..."),
+)
+
+
+class QueryStats:
+    """Статистика SQL-запросов одного HTTP-запроса"""
+
+    __slots__ = ("count", "seconds", "slowest_seconds", "slowest_statement")
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.seconds: float = 0.0
+        self.slowest_seconds: float = 0.0
+        self.slowest_statement: str | None = None
+
+
+# Статистика текущего HTTP-запроса, задаётся в middleware приложения
+REQUEST_QUERY_STATS: contextvars.ContextVar = contextvars.ContextVar(
+    "request_query_stats", default=None
+)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, измеряющий время ожидания соединения и ошибки подключения"""
+
+    def _do_get(self):
+        start: float = time.perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            # Пул исчерпан: все соединения заняты дольше pool_timeout
+            DB_POOL_ERRORS.labels(reason="timeout").inc()
+            raise
+        except Exception:
+            DB_POOL_ERRORS.labels(reason="connect").inc()
+            raise
+        finally:
+            DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+
+        return connection
+
+
+def get_statement_fingerprint(statement: str) -> str:
+    """
+    Функция возвращающая отпечаток запроса: текст без значений параметров,
+    одинаковый для всех вызовов одного и того же запроса
+    :param statement: Текст SQL-запроса
+    :type statement: str
+    :return: Отпечаток запроса
+    :rtype: str
+    """
+    for i_pattern, i_replacement in STATEMENT_FINGERPRINT_RULES:
+        statement = i_pattern.sub(i_replacement, statement)
+
+    return statement.strip()[:STATEMENT_FINGERPRINT_LENGTH]
+
+
+def observe_request_stats(stats: QueryStats, method: str, handler: str) -> None:
+    """
+    Функция записывающая статистику SQL-запросов HTTP-запроса в метрики
+    :param stats: Статистика запроса
+    :type stats: QueryStats
+    :param method: HTTP-метод
+    :type method: str
+    :param handler: Шаблон пути маршрута
+    :type handler: str
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    DB_REQUEST_QUERIES.labels(method=method, handler=handler).observe(
+        stats.count
+    )
+    DB_REQUEST_SECONDS.labels(method=method, handler=handler).observe(
+        stats.seconds
+    )
+    if stats.slowest_statement is not None:
+        DB_REQUEST_SLOWEST.labels(
+            method=method,
+            handler=handler,
+            statement=get_statement_fingerprint(stats.slowest_statement),
+        ).inc()
+
+
+def on_before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+) -> None:
+    """Запоминает время начала SQL-запроса"""
+    if REQUEST_QUERY_STATS.get() is not None:
+        context._request_query_start = time.perf_counter()
+
+
+def on_after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+) -> None:
+    """Добавляет SQL-запрос в статистику текущего HTTP-запроса"""
+    stats: QueryStats | None = REQUEST_QUERY_STATS.get()
+    start: float | None = getattr(context, "_request_query_start", None)
+
+    if stats is None or start is None:
+        return
+
+    elapsed: float = time.perf_counter() - start
+    stats.count += 1
+    stats.seconds += elapsed
+
+    # Отпечаток считаем только при выводе, здесь храним исходный текст
+    if elapsed >= stats.slowest_seconds:
+        stats.slowest_seconds = elapsed
+        stats.slowest_statement = statement
+
+
+def on_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    """Соединение выдано из пула"""
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def on_checkin(dbapi_connection, connection_record) -> None:
+    """Соединение возвращено в пул"""
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def on_invalidate(dbapi_connection, connection_record, exception) -> None:
+    """Соединение признано нерабочим (разрыв или неудачный pre-ping)"""
+    DB_POOL_ERRORS.labels(reason="invalidated").inc()
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Функция подключающая метрики к событиям пула соединений
+    и выполнения SQL-запросов движка
+    :param engine: Асинхронный движок
+    :type engine: AsyncEngine
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    event.listen(engine.sync_engine, "checkout", on_checkout)
+    event.listen(engine.sync_engine, "checkin", on_checkin)
+    event.listen(engine.sync_engine, "invalidate", on_invalidate)
+    event.listen(
+        engine.sync_engine, "before_cursor_execute", on_before_cursor_execute
+    )
+    event.listen(
+        engine.sync_engine, "after_cursor_execute", on_after_cursor_execute
+    )
@@ -0,0 +1,128 @@
+"""
+Выбор ведущего процесса через advisory-блокировки Postgres.
+При запуске в несколько воркеров (gunicorn) и/или контейнеров однократная
+работа при старте выполняется по очереди под блокировкой startup_lock:
+первый процесс выполняет её, остальные дожидаются и только проверяют,
+что она уже сделана.
+
+Фоновые задачи, которым достаточно одного исполнителя (перенос записей
+в поисковый индекс, удаление файлов медиа), запускает только процесс,
+получивший блокировку ведущего (run_as_leader). Блокировка держится,
+пока живо соединение: если ведущий процесс завершился или потерял
+соединение с БД, её получает другой процесс при следующей попытке.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, List
+
+from prometheus_client import Gauge
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from database.database import engine
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Интервал попыток получить блокировку ведущего и проверки соединения, в секундах
+LEADER_RETRY_INTERVAL: float = float(os.getenv("LEADER_RETRY_INTERVAL", 5))
+# Ключи advisory-блокировок (ключ миграций - MIGRATIONS_LOCK_ID)
+STARTUP_LOCK_ID: int = 7_461_002
+LEADER_LOCK_ID: int = 7_461_003
+
+# Метрика, отдаётся через /metrics (при нескольких воркерах - сумма по живым)
+LEADER: Gauge = Gauge(
+    "app_leader",
+    "Whether this process holds the leader lock and runs singleton background tasks",
+    multiprocess_mode="livesum",
+)
+
+
+@asynccontextmanager
+async def startup_lock(lock_engine: AsyncEngine = engine) -> AsyncIterator[None]:
+    """
+    Контекстный менеджер: однократная работа при старте выполняется
+    процессами по очереди
+    :param lock_engine: Движок БД
+    :type lock_engine: AsyncEngine
+    :return: Ничего не возвращает
+    :rtype: AsyncIterator[None]
+    """
+    async with lock_engine.connect() as connection:
+        await connection.execute(
+            text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": STARTUP_LOCK_ID}
+        )
+        # Блокировка сессионная, транзакцию не держим
+        await connection.commit()
+
+        try:
+            yield
+        finally:
+            # Закрываем соединение вместо возврата в пул:
+            # блокировка снимается вместе с ним, даже если unlock не выполнить
+            await connection.invalidate()
+
+
+async def lead(
+    connection: AsyncConnection, tasks: List[Callable[[], Awaitable[None]]]
+) -> None:
+    """
+    Корутин выполняющий фоновые задачи ведущего, пока живо соединение
+    с блокировкой
+    :param connection: Соединение, которое держит блокировку
+    :type connection: AsyncConnection
+    :param tasks: Корутин-функции фоновых задач
+    :type tasks: List[Callable[[], Awaitable[None]]]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    running: List[asyncio.Task] = [asyncio.create_task(i_task()) for i_task in tasks]
+    LEADER.set(1)
+
+    try:
+        while True:
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+            # Ошибка соединения - блокировка потеряна, задачи останавливаются
+            await connection.execute(text("SELECT 1"))
+            await connection.commit()
+    finally:
+        LEADER.set(0)
+        for i_task in running:
+            i_task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+async def run_as_leader(
+    tasks: List[Callable[[], Awaitable[None]]], lock_engine: AsyncEngine = engine
+) -> None:
+    """
+    Корутин запускающий фоновые задачи, если процесс получил блокировку
+    ведущего, иначе повторяющий попытку через LEADER_RETRY_INTERVAL
+    (фоновая задача)
+    :param tasks: Корутин-функции фоновых задач
+    :type tasks: List[Callable[[], Awaitable[None]]]
+    :param lock_engine: Движок БД
+    :type lock_engine: AsyncEngine
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    while True:
+        try:
+            async with lock_engine.connect() as connection:
+                acquired: bool = await connection.scalar(
+                    text("SELECT pg_try_advisory_lock(:lock_id)"),
+                    {"lock_id": LEADER_LOCK_ID},
+                )
+                await connection.commit()
+
+                if acquired:
+                    try:
+                        await lead(connection, tasks)
+                    finally:
+                        # Соединение с блокировкой не возвращается в пул
+                        await connection.invalidate()
+        except Exception:
+            logger.exception("leader election failed")
+
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
@@ -0,0 +1,176 @@
+"""
+Буфер записи лайков.
+Лайки и отмены лайков собираются в течение короткого окна и записываются
+одной транзакцией и одним запросом (write_likes_batch_to_db), вместо
+отдельной транзакции на каждый лайк, которые конкурируют за строку
+популярного твита. Повторные операции одного пользователя над одним твитом
+в окне сворачиваются: записывается только последняя (лайк и его отмена
+в одном окне дают одну отмену).
+
+Запрос ждёт записи своей пачки, поэтому ответ отдаётся после commit
+и при ошибке БД запрос завершается ошибкой, как без буфера.
+Перед ожиданием запрос возвращает своё соединение в пул
+(release_connection), чтобы пачке хватило соединения при всплеске лайков.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from database.database import transaction
+from database.models import write_likes_batch_to_db
+
+# Окно сбора лайков, в секундах (0 - лайки записываются сразу в транзакции запроса)
+LIKE_BUFFER_WINDOW: float = float(os.getenv("LIKE_BUFFER_WINDOW", 0.02))
+# Количество пар твит-пользователь, при котором пачка записывается не дожидаясь окна
+LIKE_BUFFER_MAX_BATCH: int = int(os.getenv("LIKE_BUFFER_MAX_BATCH", 1000))
+
+# Метрики буфера, отдаются через /metrics
+LIKE_BUFFER_BATCH_SIZE: Histogram = Histogram(
+    "like_buffer_batch_size",
+    "Number of like/unlike operations written per flush after coalescing",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000),
+)
+LIKE_BUFFER_FLUSH_SECONDS: Histogram = Histogram(
+    "like_buffer_flush_seconds",
+    "Time spent writing a batch of like/unlike operations",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+LIKE_BUFFER_COALESCED: Counter = Counter(
+    "like_buffer_coalesced",
+    "Number of like/unlike operations superseded by a later one "
+    "of the same user on the same tweet",
+)
+LIKE_BUFFER_ERRORS: Counter = Counter(
+    "like_buffer_errors", "Number of failed like/unlike batch writes"
+)
+
+
+class PendingLike(NamedTuple):
+    """Ожидающая записи операция: итоговое состояние лайка и ждущие запросы"""
+
+    liked: bool
+    waiters: List[asyncio.Future]
+
+
+class LikeBuffer:
+    """Буфер лайков одного процесса"""
+
+    def __init__(self, window: float, max_batch: int) -> None:
+        self.window: float = window
+        self.max_batch: int = max_batch
+        self._pending: Dict[Tuple[int, int], PendingLike] = dict()
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: Set[asyncio.Task] = set()
+        self._closed: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        """Включён ли буфер (иначе лайки пишутся в транзакции запроса)"""
+        return self.window > 0
+
+    async def submit(self, tweet_id: int, user_id: int, liked: bool) -> bool:
+        """
+        Корутин добавляющий лайк или отмену лайка в буфер
+        и ожидающий записи пачки
+        :param tweet_id: id твита
+        :type tweet_id: int
+        :param user_id: id пользователя
+        :type user_id: int
+        :param liked: True - лайк, False - отмена лайка
+        :type liked: bool
+        :return: True, если твит существует
+        :rtype: bool
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        waiter: asyncio.Future = loop.create_future()
+        key: Tuple[int, int] = (tweet_id, user_id)
+        pending: PendingLike | None = self._pending.get(key)
+
+        if pending is None:
+            self._pending[key] = PendingLike(liked, [waiter])
+        else:
+            # Предыдущая операция в окне заменяется последней
+            LIKE_BUFFER_COALESCED.inc()
+            self._pending[key] = PendingLike(liked, pending.waiters + [waiter])
+
+        if self._closed or len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+
+        return await waiter
+
+    def flush(self) -> None:
+        """
+        Функция запускающая запись накопленной пачки в фоне
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._pending:
+            return
+
+        batch: Dict[Tuple[int, int], PendingLike] = self._pending
+        self._pending = dict()
+
+        # Пустой контекст: запросы пачки не попадают в статистику
+        # SQL-запросов HTTP-запроса, который открыл окно
+        task: asyncio.Task = asyncio.create_task(
+            self._write(batch), context=contextvars.Context()
+        )
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: Dict[Tuple[int, int], PendingLike]) -> None:
+        """
+        Корутин записывающий пачку и передающий результат ждущим запросам
+        :param batch: Операции пачки по id твита и id пользователя
+        :type batch: Dict[Tuple[int, int], PendingLike]
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        start: float = time.perf_counter()
+
+        try:
+            async with transaction() as batch_session:
+                authors: Dict[int, int] = await write_likes_batch_to_db(
+                    batch_session,
+                    {i_key: i_pending.liked for i_key, i_pending in batch.items()},
+                )
+        except Exception as exc:
+            LIKE_BUFFER_ERRORS.inc()
+            for i_pending in batch.values():
+                for i_waiter in i_pending.waiters:
+                    # Запрос мог быть отменён (клиент отключился)
+                    if not i_waiter.done():
+                        i_waiter.set_exception(exc)
+            return
+
+        LIKE_BUFFER_FLUSH_SECONDS.observe(time.perf_counter() - start)
+        LIKE_BUFFER_BATCH_SIZE.observe(len(batch))
+
+        for (i_tweet_id, _), i_pending in batch.items():
+            for i_waiter in i_pending.waiters:
+                if not i_waiter.done():
+                    i_waiter.set_result(i_tweet_id in authors)
+
+    async def close(self) -> None:
+        """
+        Корутин записывающий оставшиеся операции при остановке приложения,
+        после него операции записываются без ожидания окна
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        self._closed = True
+        self.flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+like_buffer: LikeBuffer = LikeBuffer(LIKE_BUFFER_WINDOW, LIKE_BUFFER_MAX_BATCH)
@@ -0,0 +1,193 @@
+"""
+Отложенное удаление файлов медиа.
+Файлы не удаляются в запросе: удаление записей Media (вместе с твитом)
+записывает пути в таблицу media_deletions в той же транзакции, а фоновая
+задача пачками удаляет файлы, на которые больше не ссылается ни одна запись
+Media, и затем - строки очереди. Если удаление прервалось, строки остаются
+и обрабатываются повторно (удаление файла идемпотентно).
+
+Та же задача удаляет записи Media, которые так и не прикрепили к твиту
+(загрузки через POST /api/medias без твита) дольше MEDIA_ORPHAN_GRACE секунд,
+и ставит их файлы в очередь на удаление.
+
+Строки выбираются с FOR UPDATE SKIP LOCKED, поэтому задачи нескольких
+воркеров не обрабатывают одни и те же строки. Путь к файлу блокируется
+advisory-блокировкой (как при загрузке): файл, который сейчас загружают
+заново, не удаляется, его строка обрабатывается при следующем запуске.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from typing import List, Set
+
+from prometheus_client import Counter
+from sqlalchemy import delete, func, insert
+from sqlalchemy.engine.cursor import CursorResult
+from sqlalchemy.engine.result import ChunkedIteratorResult
+from sqlalchemy.engine.row import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.selectable import CTE, Select
+
+from database.database import Media, MediaDeletions, transaction
+from database.models import (
+    get_unreferenced_media_paths,
+    remove_images_from_disk,
+    try_lock_media_paths,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Интервал запуска удаления файлов, в секундах (0 - фоновое удаление отключено)
+MEDIA_GC_INTERVAL: float = float(os.getenv("MEDIA_GC_INTERVAL", 10))
+# Количество строк, обрабатываемых в одной транзакции
+MEDIA_GC_BATCH_SIZE: int = int(os.getenv("MEDIA_GC_BATCH_SIZE", 500))
+# Время, после которого неприкреплённая к твиту загрузка удаляется, в секундах
+MEDIA_ORPHAN_GRACE: float = float(os.getenv("MEDIA_ORPHAN_GRACE", 24 * 60 * 60))
+
+# Метрики, отдаются через /metrics
+MEDIA_GC_DELETED_FILES: Counter = Counter(
+    "media_gc_deleted_files",
+    "Number of media files (without variants) removed from disk by the reaper",
+)
+MEDIA_GC_ORPHANS: Counter = Counter(
+    "media_gc_orphans",
+    "Number of media rows removed because they were never attached to a tweet",
+)
+
+
+async def sweep_orphan_media(session: AsyncSession) -> int:
+    """
+    Корутин удаляющий пачку записей Media без твита старше MEDIA_ORPHAN_GRACE
+    и добавляющий их файлы в очередь на удаление (одним запросом)
+    :param session: Сессия в транзакции
+    :type session: AsyncSession
+    :return: Количество удалённых записей
+    :rtype: int
+    """
+    orphans: CTE = (
+        select(Media.id)
+        .where(
+            Media.tweet_id.is_(None),
+            Media.created_at
+            < func.now() - datetime.timedelta(seconds=MEDIA_ORPHAN_GRACE),
+        )
+        .order_by(Media.created_at)
+        .limit(MEDIA_GC_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+        .cte("orphans")
+    )
+    # Запись могли прикрепить к твиту, пока запрос ждал
+    deleted: CTE = (
+        delete(Media)
+        .where(Media.id.in_(select(orphans.c.id)), Media.tweet_id.is_(None))
+        .returning(Media.media_path)
+        .cte("deleted")
+    )
+    enqueue_query: Insert = (
+        insert(MediaDeletions)
+        .from_select(["media_path"], select(deleted.c.media_path))
+        .add_cte(deleted)
+    )
+    enqueue_result: CursorResult = await session.execute(enqueue_query)
+
+    MEDIA_GC_ORPHANS.inc(enqueue_result.rowcount)
+
+    return enqueue_result.rowcount
+
+
+async def reap_media_deletions(session: AsyncSession) -> int:
+    """
+    Корутин удаляющий с диска файлы пачки из очереди (вместе с вариантами)
+    и строки этой пачки. Файлы, на которые снова ссылаются записи Media,
+    не удаляются
+    :param session: Сессия в транзакции
+    :type session: AsyncSession
+    :return: Количество обработанных строк очереди
+    :rtype: int
+    """
+    pending_query: Select = (
+        select(MediaDeletions.id, MediaDeletions.media_path)
+        .order_by(MediaDeletions.id)
+        .limit(MEDIA_GC_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    pending_result: ChunkedIteratorResult = await session.execute(pending_query)
+    pending: List[Row] = pending_result.all()
+
+    if not pending:
+        return 0
+
+    # Пути, которые сейчас загружают заново, пропускаем до следующего запуска,
+    # загрузка с блокировкой ждёт commit этой транзакции
+    locked_paths: Set[str] = set(
+        await try_lock_media_paths(
+            session, media_paths=[i_row.media_path for i_row in pending]
+        )
+    )
+    processed: List[Row] = [
+        i_row for i_row in pending if i_row.media_path in locked_paths
+    ]
+
+    # Ссылки проверяются после блокировки, поэтому видна запись Media
+    # загрузки, сохранённой до неё. Файлы удаляются до commit: если транзакция
+    # не сохранится, строки обработаются повторно
+    file_paths: List[str] = await get_unreferenced_media_paths(
+        session, media_paths=list(locked_paths)
+    )
+    await remove_images_from_disk(file_paths=file_paths)
+
+    await session.execute(
+        delete(MediaDeletions).where(
+            MediaDeletions.id.in_([i_row.id for i_row in processed])
+        )
+    )
+
+    MEDIA_GC_DELETED_FILES.inc(len(file_paths))
+
+    return len(processed)
+
+
+async def collect_media_garbage() -> int:
+    """
+    Корутин удаляющий все неприкреплённые загрузки старше MEDIA_ORPHAN_GRACE
+    и все файлы из очереди, пачками по MEDIA_GC_BATCH_SIZE, каждая пачка
+    в своей транзакции
+    :return: Количество обработанных строк очереди
+    :rtype: int
+    """
+    while True:
+        async with transaction() as gc_session:
+            swept: int = await sweep_orphan_media(gc_session)
+
+        if swept < MEDIA_GC_BATCH_SIZE:
+            break
+
+    reaped: int = 0
+
+    while True:
+        async with transaction() as gc_session:
+            batch: int = await reap_media_deletions(gc_session)
+
+        reaped += batch
+
+        if batch < MEDIA_GC_BATCH_SIZE:
+            return reaped
+
+
+async def run_media_gc() -> None:
+    """
+    Корутин периодически выполняющий collect_media_garbage (фоновая задача)
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(MEDIA_GC_INTERVAL)
+
+        try:
+            await collect_media_garbage()
+        except Exception:
+            # Строки остались в очереди, повторим через интервал
+            logger.exception("media garbage collection failed")
@@ -0,0 +1,111 @@
+"""
+Работа с файлами медиа в пуле потоков.
+Вызовы файловой системы (os.remove, os.makedirs, os.replace, запись файла)
+блокируют поток, поэтому выполняются в отдельном ограниченном пуле,
+а не в цикле событий: медленный (например, сетевой) том не останавливает
+обработку остальных запросов процесса.
+"""
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from prometheus_client import Histogram
+
+# Количество потоков для работы с файлами медиа
+MEDIA_IO_THREADS: int = int(os.getenv("MEDIA_IO_THREADS", 8))
+
+# Метрика, отдаётся через /metrics
+MEDIA_IO_SECONDS: Histogram = Histogram(
+    "media_io_seconds",
+    "Time spent on media filesystem operations, including the wait for a free thread",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# Пул потоков, создаётся при первой операции
+_media_io_pool: ThreadPoolExecutor | None = None
+
+
+def get_media_io_pool() -> ThreadPoolExecutor:
+    """Функция возвращающая пул потоков для работы с файлами медиа"""
+    global _media_io_pool
+
+    if _media_io_pool is None:
+        _media_io_pool = ThreadPoolExecutor(
+            max_workers=MEDIA_IO_THREADS, thread_name_prefix="media-io"
+        )
+
+    return _media_io_pool
+
+
+def shutdown_media_io_pool() -> None:
+    """Функция завершающая пул потоков (дожидается текущих операций)"""
+    global _media_io_pool
+
+    if _media_io_pool is not None:
+        _media_io_pool.shutdown(wait=True)
+        _media_io_pool = None
+
+
+async def run_media_io(
+    operation: str, func: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Any:
+    """
+    Корутин выполняющий функцию в пуле потоков и замеряющий время операции
+    :param operation: Название операции для метрики media_io_seconds
+    :type operation: str
+    :param func: Блокирующая функция
+    :type func: Callable[..., Any]
+    :return: Результат функции
+    :rtype: Any
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    start: float = time.perf_counter()
+
+    try:
+        return await loop.run_in_executor(
+            get_media_io_pool(), functools.partial(func, *args, **kwargs)
+        )
+    finally:
+        MEDIA_IO_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+
+def remove_file(path: str) -> bool:
+    """
+    Функция удаляющая файл, если он есть
+    (без отдельной проверки существования: файл мог удалить другой процесс)
+    :param path: Путь к файлу
+    :type path: str
+    :return: True, если файл был удалён
+    :rtype: bool
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def store_file(tmp_path: str, path: str) -> bool:
+    """
+    Функция перемещающая готовый временный файл на место,
+    если такого файла ещё нет, иначе временный файл удаляется
+    :param tmp_path: Путь к временному файлу
+    :type tmp_path: str
+    :param path: Путь, по которому хранится файл
+    :type path: str
+    :return: True, если файл сохранён, False - если такой файл уже был
+    :rtype: bool
+    """
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+    return True
@@ -0,0 +1,291 @@
+"""
+Версионные миграции схемы БД.
+Применённые версии записываются в таблицу schema_version. При запуске
+воркера проверяется только последняя версия (без блокировок), миграции
+выполняются под advisory-блокировкой, поэтому при одновременном запуске
+нескольких воркеров их применяет один, остальные дожидаются и ничего не делают.
+
+Каждая миграция выполняется в своей транзакции и должна быть идемпотентной
+(IF NOT EXISTS): базовая миграция создаёт таблицы по текущим моделям,
+поэтому в новой БД следующие миграции ничего не меняют.
+
+Запуск вручную (из папки app):
+    python -m database.migrations
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine.result import ChunkedIteratorResult
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.future import select
+
+from database.database import (
+    SEARCH_CONFIG,
+    SEARCH_PENDING_LIST_LIMIT,
+    Base,
+    MediaDeletions,
+    SchemaVersion,
+    engine,
+)
+from database.models import FANOUT_MAX_FOLLOWERS
+from database.timeline import TIMELINE_INBOX_SIZE
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки на время применения миграций
+MIGRATIONS_LOCK_ID: int = 7_461_001
+
+
+class Migration(NamedTuple):
+    """Миграция схемы: версия, описание и корутин-функция изменения схемы"""
+
+    version: int
+    description: str
+    upgrade: Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def execute_all(connection: AsyncConnection, statements: List[str]) -> None:
+    """
+    Корутин выполняющий SQL-запросы миграции по очереди
+    :param connection: Соединение в транзакции миграции
+    :type connection: AsyncConnection
+    :param statements: SQL-запросы
+    :type statements: List[str]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    for i_statement in statements:
+        await connection.execute(text(i_statement))
+
+
+async def create_tables(connection: AsyncConnection) -> None:
+    """Базовая схема: создаёт недостающие таблицы по моделям"""
+    await connection.run_sync(Base.metadata.create_all)
+
+
+async def add_columns(connection: AsyncConnection) -> None:
+    """Колонки, добавленные в модели после первой версии схемы"""
+    await execute_all(
+        connection,
+        [
+            "ALTER TABLE users"
+            " ADD COLUMN IF NOT EXISTS merge_on_read BOOLEAN NOT NULL DEFAULT false,"
+            " ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0,"
+            " ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE tweets"
+            " ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE media"
+            " ALTER COLUMN media_path TYPE VARCHAR(128),"
+            " ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64),"
+            " ADD COLUMN IF NOT EXISTS thumbnail_path VARCHAR(128),"
+            " ADD COLUMN IF NOT EXISTS feed_path VARCHAR(128),"
+            " ADD COLUMN IF NOT EXISTS large_path VARCHAR(128)",
+            # Счётчики по существующим подпискам и лайкам
+            "UPDATE users SET"
+            " followers_count = (SELECT count(*) FROM followers"
+            " WHERE followers.following_id = users.id),"
+            " following_count = (SELECT count(*) FROM followers"
+            " WHERE followers.user_id = users.id)",
+            "UPDATE tweets SET like_count = (SELECT count(*) FROM \"like\""
+            " WHERE \"like\".tweet_id = tweets.id)",
+        ],
+    )
+
+
+async def add_lookup_indexes(connection: AsyncConnection) -> None:
+    """
+    Индексы для поиска по Api-Key, по внешним ключам и в обратную сторону
+    по составным ключам followers и like
+    """
+    await execute_all(
+        connection,
+        [
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_api_key ON users (api_key)",
+            # Также покрывает поиск твитов по автору
+            "CREATE INDEX IF NOT EXISTS ix_tweets_author_id_id"
+            " ON tweets (author_id, id)",
+            "CREATE INDEX IF NOT EXISTS ix_media_tweet_id ON media (tweet_id)",
+            "CREATE INDEX IF NOT EXISTS ix_media_media_path ON media (media_path)",
+            "CREATE INDEX IF NOT EXISTS ix_followers_following_id_user_id"
+            " ON followers (following_id, user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_like_user_id_tweet_id"
+            " ON \"like\" (user_id, tweet_id)",
+            "CREATE INDEX IF NOT EXISTS ix_timeline_tweet_id ON timeline (tweet_id)",
+            "CREATE INDEX IF NOT EXISTS ix_timeline_user_id_author_id"
+            " ON timeline (user_id, author_id)",
+            # Планировщику нужна статистика по новым индексам
+            "ANALYZE users, tweets, media, followers, \"like\", timeline",
+        ],
+    )
+
+
+async def add_search_index(connection: AsyncConnection) -> None:
+    """Полнотекстовый поиск по твитам: вычисляемая колонка и GIN-индекс"""
+    await execute_all(
+        connection,
+        [
+            "ALTER TABLE tweets ADD COLUMN IF NOT EXISTS search_vector tsvector"
+            " GENERATED ALWAYS AS (to_tsvector('{}', tweet)) STORED".format(
+                SEARCH_CONFIG
+            ),
+            "CREATE INDEX IF NOT EXISTS ix_tweets_search_vector"
+            " ON tweets USING gin (search_vector)"
+            " WITH (fastupdate = on, gin_pending_list_limit = {})".format(
+                SEARCH_PENDING_LIST_LIMIT
+            ),
+        ],
+    )
+
+
+async def add_media_gc(connection: AsyncConnection) -> None:
+    """
+    Отложенное удаление файлов медиа: время загрузки Media,
+    индекс неприкреплённых загрузок и таблица файлов к удалению
+    """
+    await execute_all(
+        connection,
+        [
+            "ALTER TABLE media ADD COLUMN IF NOT EXISTS created_at"
+            " TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+            "CREATE INDEX IF NOT EXISTS ix_media_orphan_created_at"
+            " ON media (created_at) WHERE tweet_id IS NULL",
+        ],
+    )
+    await connection.run_sync(MediaDeletions.__table__.create, checkfirst=True)
+
+
+async def backfill_timelines(connection: AsyncConnection) -> None:
+    """
+    Ленты по подпискам, сделанным до появления таблицы timeline:
+    авторы с большим числом подписчиков переводятся на подмешивание
+    при чтении, в ленты попадают последние TIMELINE_INBOX_SIZE твитов
+    самого пользователя и каждого автора, на которого он подписан
+    """
+    await connection.execute(
+        text(
+            "UPDATE users SET merge_on_read = true"
+            " WHERE followers_count > :max_followers AND NOT merge_on_read"
+        ),
+        {"max_followers": FANOUT_MAX_FOLLOWERS},
+    )
+    # Своя лента пользователя - подписка "на себя"
+    await connection.execute(
+        text(
+            "INSERT INTO timeline (user_id, tweet_id, author_id)"
+            " SELECT edges.user_id, t.id, t.author_id"
+            " FROM ("
+            " SELECT f.user_id, f.following_id FROM followers f"
+            " JOIN users a ON a.id = f.following_id AND NOT a.merge_on_read"
+            " UNION ALL"
+            " SELECT id, id FROM users"
+            " ) edges"
+            " CROSS JOIN LATERAL ("
+            " SELECT id, author_id FROM tweets"
+            " WHERE author_id = edges.following_id"
+            " ORDER BY id DESC LIMIT :backfill_size"
+            " ) t"
+            " ON CONFLICT DO NOTHING"
+        ),
+        {"backfill_size": TIMELINE_INBOX_SIZE},
+    )
+
+
+# Миграции по возрастанию версий, новые добавляются в конец
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline tables", create_tables),
+    Migration(2, "columns added after baseline", add_columns),
+    Migration(3, "lookup indexes", add_lookup_indexes),
+    Migration(4, "tweets full-text search", add_search_index),
+    Migration(5, "deferred media deletion", add_media_gc),
+    Migration(6, "timeline backfill for existing follows", backfill_timelines),
+]
+# Версия схемы, которую ожидает код
+SCHEMA_VERSION: int = MIGRATIONS[-1].version
+
+
+async def get_schema_version(connection: AsyncConnection) -> int:
+    """
+    Корутин возвращающий последнюю применённую версию схемы
+    :param connection: Соединение с БД
+    :type connection: AsyncConnection
+    :return: Версия (0, если миграции ещё не применялись)
+    :rtype: int
+    """
+    table_exists: bool = await connection.scalar(
+        text("SELECT to_regclass('schema_version') IS NOT NULL")
+    )
+
+    if not table_exists:
+        return 0
+
+    version: int | None = await connection.scalar(
+        select(SchemaVersion.version).order_by(SchemaVersion.version.desc()).limit(1)
+    )
+
+    return version or 0
+
+
+async def migrate(migrations_engine: AsyncEngine = engine) -> int:
+    """
+    Корутин применяющий недостающие миграции.
+    Если схема актуальна, выполняется только проверка версии
+    :param migrations_engine: Движок БД
+    :type migrations_engine: AsyncEngine
+    :return: Количество применённых миграций
+    :rtype: int
+    """
+    async with migrations_engine.connect() as connection:
+        if await get_schema_version(connection) >= SCHEMA_VERSION:
+            return 0
+
+    applied: int = 0
+
+    for i_migration in MIGRATIONS:
+        async with migrations_engine.begin() as connection:
+            # Блокировка до конца транзакции: другие воркеры ждут здесь
+            await connection.execute(
+                text("SELECT pg_advisory_xact_lock(:lock_id)"),
+                {"lock_id": MIGRATIONS_LOCK_ID},
+            )
+            await connection.run_sync(
+                SchemaVersion.__table__.create, checkfirst=True
+            )
+
+            # Миграцию мог применить другой воркер, пока мы ждали блокировку
+            applied_result: ChunkedIteratorResult = await connection.execute(
+                select(SchemaVersion.version).where(
+                    SchemaVersion.version == i_migration.version
+                )
+            )
+            if applied_result.first() is not None:
+                continue
+
+            logger.info(
+                "applying migration %s: %s",
+                i_migration.version,
+                i_migration.description,
+            )
+            await i_migration.upgrade(connection)
+            await connection.execute(
+                SchemaVersion.__table__.insert().values(
+                    version=i_migration.version,
+                    description=i_migration.description,
+                )
+            )
+            applied += 1
+
+    return applied
+
+
+async def main() -> None:
+    applied: int = await migrate()
+    print("applied {} migrations, schema version {}".format(applied, SCHEMA_VERSION))
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -1,132 +1,462 @@
+import asyncio
+import hashlib
+import logging
+import math
 import os
-import random
-import string
-from typing import Dict, List
+import uuid
+from typing import Dict, List, Set, Tuple
 
 import aiofiles
+from fastapi import UploadFile
+from sqlalchemy import (
+    REAL,
+    Boolean,
+    Integer,
+    String,
+    case,
+    cast,
+    column,
+    delete,
+    exists,
+    func,
+    literal,
+    literal_column,
+    or_,
+    true,
+    tuple_,
+    union_all,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import (
+    ARRAY,
+    JSON,
+    REGCLASS,
+    REGCONFIG,
+    aggregate_order_by,
+    insert,
+)
+from sqlalchemy.engine.cursor import CursorResult
 from sqlalchemy.engine.result import ChunkedIteratorResult
+from sqlalchemy.engine.row import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-from sqlalchemy.sql.selectable import Select
+from sqlalchemy.orm import aliased, selectinload
+from sqlalchemy.sql.selectable import (
+    CTE,
+    Exists,
+    Lateral,
+    ScalarSelect,
+    Select,
+    Subquery,
+)
+
+from database.auth_cache import UserIdentity, auth_cache
+from database.change_counters import (
+    TWEETS_COUNTERS,
+    bump_counters,
+    get_counters,
+    get_timeline_counter,
+    get_tweets_counter,
+    get_user_counter,
+    mark_changed,
+    mark_timelines_changed,
+)
+from database.database import (
+    SEARCH_CONFIG,
+    Media,
+    MediaDeletions,
+    Tweets,
+    Users,
+    async_session,
+    integration_followers,
+    integration_like,
+    run_after_commit,
+)
+from database.events import (
+    EVENT_FOLLOW,
+    EVENT_LIKE,
+    EVENT_TWEET,
+    EVENT_TWEET_DELETED,
+    EVENT_UNFOLLOW,
+    EVENT_UNLIKE,
+    publish_event,
+)
+from database.images import (
+    get_image_pool,
+    get_variant_paths,
+    is_image_processing_enabled,
+    render_variants,
+)
+from database.media_io import (
+    get_media_io_pool,
+    remove_file,
+    run_media_io,
+    store_file,
+)
+from database.replicas import route_user_reads
+from database.response_cache import response_cache
+from database.timeline import TIMELINE_INBOX_SIZE, timeline_store
 
-from database.database import Media, Tweets, Users, async_session
+logger: logging.Logger = logging.getLogger(__name__)
 
-IMAGES_BASE_DIR_PATH: str = os.path.join(
-    os.path.dirname(__file__), "media/user_post_images"
+# Корень медиа, пути к файлам в таблице Media указываются относительно него
+MEDIA_ROOT: str = os.getenv(
+    "MEDIA_ROOT", os.path.join(os.path.dirname(__file__), "media")
+)
+IMAGES_DIR_NAME: str = "user_post_images"
+IMAGES_BASE_DIR_PATH: str = os.path.join(MEDIA_ROOT, IMAGES_DIR_NAME)
+# Папка для временных файлов загрузки, лежит на том же томе, что и картинки,
+# чтобы готовый файл можно было атомарно переместить на место
+UPLOADS_TMP_DIR_PATH: str = os.path.join(IMAGES_BASE_DIR_PATH, ".tmp")
+# Сигнатуры поддерживаемых форматов картинок и их расширения
+IMAGE_SIGNATURES: Tuple[Tuple[bytes, str], ...] = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
 )
-SYMBOLS: str = string.ascii_letters + string.digits
+# Фоновые задачи обработки картинок
+# (храним ссылки, чтобы задачи не удалил сборщик мусора)
+IMAGE_PROCESSING_TASKS: Set[asyncio.Task] = set()
+# Размер страницы ленты по умолчанию и максимально допустимый размер страницы
+TWEETS_PAGE_SIZE: int = int(os.getenv("TWEETS_PAGE_SIZE", 50))
+TWEETS_PAGE_SIZE_MAX: int = int(os.getenv("TWEETS_PAGE_SIZE_MAX", 200))
+# Максимальный id твита (колонка INTEGER), больше - курсор вне диапазона
+TWEET_ID_MAX: int = 2**31 - 1
+# Максимальное количество пользователей в одном запросе GET /api/users
+USERS_BATCH_SIZE_MAX: int = int(os.getenv("USERS_BATCH_SIZE_MAX", 100))
+# Максимальное количество подписчиков, которым твит рассылается при записи,
+# твиты авторов с большим количеством подписчиков подмешиваются в ленту при чтении
+FANOUT_MAX_FOLLOWERS: int = int(os.getenv("FANOUT_MAX_FOLLOWERS", 1000))
+# Максимальный размер загружаемого файла и размер блока, которым файл пишется на диск
+MEDIA_MAX_UPLOAD_SIZE: int = int(
+    os.getenv("MEDIA_MAX_UPLOAD_SIZE", 10 * 1024 * 1024)
+)
+MEDIA_UPLOAD_CHUNK_SIZE: int = int(
+    os.getenv("MEDIA_UPLOAD_CHUNK_SIZE", 64 * 1024)
+)
+# Интервал переноса новых твитов из списка ожидания в полнотекстовый индекс,
+# в секундах (0 - только силами autovacuum)
+SEARCH_INDEX_CLEAN_INTERVAL: float = float(
+    os.getenv("SEARCH_INDEX_CLEAN_INTERVAL", 30)
+)
+
+
+class FileTooLargeError(Exception):
+    """Загружаемый файл больше MEDIA_MAX_UPLOAD_SIZE"""
 
 
-async def generate_random_filename() -> str:
+class UnsupportedMediaTypeError(Exception):
+    """Загружаемый файл не является картинкой поддерживаемого формата"""
+
+
+def detect_image_extension(header: bytes) -> str | None:
     """
-    Корутин генерирующий случайное имя файля
-    :return: Случайное имя файла
-    :rtype: str
+    Функция определяющая формат картинки по первым байтам файла
+    :param header: Начало файла
+    :type header: bytes
+    :return: Расширение файла или None, если формат не поддерживается
+    :rtype: str | None
     """
-    # Генерируем список из случайных символов
-    random_symbols_list: List = [random.choice(SYMBOLS) for _ in range(15)]
-    # Объединяем список в строку
-    random_filename_str: str = "".join(random_symbols_list)
-    # Добавляем расширение файла
-    random_filename: str = "".join([random_filename_str, ".jpg"])
+    for i_signature, i_extension in IMAGE_SIGNATURES:
+        if header.startswith(i_signature):
+            return i_extension
 
-    return random_filename
+    # У webp сигнатура разделена размером файла: RIFF....WEBP
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
 
+    return None
 
-async def write_image_to_disk(
-    file: bytes, file_name: str, user_api_key: str
-) -> None:
+
+def get_media_path(content_hash: str, extension: str) -> str:
+    """
+    Функция строящая путь к файлу по хэшу его содержимого,
+    файлы раскладываются по двум уровням папок,
+    чтобы в одной папке их не было слишком много
+    :param content_hash: sha256 содержимого файла
+    :type content_hash: str
+    :param extension: Расширение файла
+    :type extension: str
+    :return: Путь к файлу относительно MEDIA_ROOT
+    :rtype: str
+    """
+    return "{}/{}/{}/{}.{}".format(
+        IMAGES_DIR_NAME,
+        content_hash[:2],
+        content_hash[2:4],
+        content_hash,
+        extension,
+    )
+
+
+async def lock_media_path(session: AsyncSession, media_path: str) -> None:
     """
-    Корутин записывающий файлы на диск
-    :param file: Байтовый файл
-    :type file: bytes
-    :param file_name: Имя файла
-    :type file_name: str
-    :param user_api_key: Api-Key Пользователя
-    :type user_api_key: str
+    Корутин блокирующий путь к файлу до конца транзакции сессии:
+    пока запись Media о файле не сохранена, фоновая задача его не удаляет
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param media_path: Путь к файлу относительно MEDIA_ROOT
+    :type media_path: str
     :return: Ничего не возвращает
     :rtype: None
     """
-    # Путь до папки пользователя
-    path_dir: str = "{}/{}".format(IMAGES_BASE_DIR_PATH, user_api_key)
+    await session.execute(
+        select(func.pg_advisory_xact_lock(func.hashtext(media_path)))
+    )
 
-    # Проверяем существует папка пользователя или нет, если нет, то создаёт
-    if not os.path.exists(path_dir):
-        os.mkdir(path_dir)
 
-    # Путь до файла в папке пользователя
-    image_path: str = os.path.join(path_dir, file_name)
+async def try_lock_media_paths(
+    session: AsyncSession, media_paths: List[str]
+) -> List[str]:
+    """
+    Корутин блокирующий пути к файлам до конца транзакции сессии без ожидания
+    :param session: Сессия в транзакции
+    :type session: AsyncSession
+    :param media_paths: Пути к файлам
+    :type media_paths: List[str]
+    :return: Заблокированные пути (остальные сейчас загружаются заново)
+    :rtype: List[str]
+    """
+    paths = func.unnest(literal(sorted(set(media_paths)), ARRAY(String))).table_valued(
+        "media_path"
+    )
+    locked_result: ChunkedIteratorResult = await session.execute(
+        select(paths.c.media_path).where(
+            func.pg_try_advisory_xact_lock(func.hashtext(paths.c.media_path))
+        )
+    )
 
-    # Записываем файл на диск, в папку пользователя
-    async with aiofiles.open(image_path, mode="wb") as f:
-        await f.write(file)
+    return list(locked_result.scalars().all())
+
+
+async def write_image_to_disk(
+    session: AsyncSession, file: UploadFile
+) -> Tuple[str, str]:
+    """
+    Корутин записывающий файл на диск блоками по MEDIA_UPLOAD_CHUNK_SIZE,
+    поэтому память на одну загрузку не зависит от размера файла.
+    Файл сохраняется по пути из хэша содержимого, если такой файл уже есть,
+    то повторно он не сохраняется
+    :param session: Сессия запроса, в которой будет записана Media
+    :type session: AsyncSession
+    :param file: Загружаемый файл
+    :type file: UploadFile
+    :return: sha256 содержимого файла и путь к файлу относительно MEDIA_ROOT
+    :rtype: Tuple[str, str]
+    :raises FileTooLargeError: Если файл больше MEDIA_MAX_UPLOAD_SIZE
+    :raises UnsupportedMediaTypeError: Если файл не картинка поддерживаемого формата
+    """
+    # Создаём папку для временных файлов, если её нет
+    await run_media_io("makedirs", os.makedirs, UPLOADS_TMP_DIR_PATH, exist_ok=True)
+
+    # Пишем во временный файл, хэш (а значит и путь) известен только в конце загрузки
+    tmp_path: str = os.path.join(UPLOADS_TMP_DIR_PATH, uuid.uuid4().hex)
+
+    # Хэш содержимого считаем по ходу записи
+    content_hash = hashlib.sha256()
+    file_size: int = 0
+    extension: str | None = None
+
+    try:
+        # Файл пишется в том же пуле потоков, что и остальные операции с медиа
+        async with aiofiles.open(
+            tmp_path, mode="wb", executor=get_media_io_pool()
+        ) as f:
+            while chunk := await file.read(MEDIA_UPLOAD_CHUNK_SIZE):
+                # Формат определяем по первому блоку
+                if extension is None:
+                    extension = detect_image_extension(chunk)
+
+                    if extension is None:
+                        raise UnsupportedMediaTypeError("file is not an image")
+
+                file_size += len(chunk)
+
+                # Прерываем запись, как только файл превысил допустимый размер
+                if file_size > MEDIA_MAX_UPLOAD_SIZE:
+                    raise FileTooLargeError(
+                        "file is larger than {} bytes".format(
+                            MEDIA_MAX_UPLOAD_SIZE
+                        )
+                    )
+
+                content_hash.update(chunk)
+                await f.write(chunk)
+
+        # Пустой файл
+        if extension is None:
+            raise UnsupportedMediaTypeError("file is empty")
+    except (FileTooLargeError, UnsupportedMediaTypeError):
+        # Удаляем недописанный файл
+        await run_media_io("remove", remove_file, tmp_path)
+        raise
+
+    content_hash_hex: str = content_hash.hexdigest()
+    media_path: str = get_media_path(content_hash_hex, extension)
+    image_path: str = os.path.join(MEDIA_ROOT, media_path)
+
+    # Путь блокируется до commit записи Media: иначе фоновая задача может
+    # удалить уже существующий файл между проверкой и сохранением записи
+    try:
+        await lock_media_path(session, media_path)
+    except Exception:
+        await run_media_io("remove", remove_file, tmp_path)
+        raise
+
+    # Если такой файл уже загружали, второй раз его не храним
+    await run_media_io("store", store_file, tmp_path, image_path)
+
+    return content_hash_hex, media_path
 
 
 async def remove_images_from_disk(file_paths: List[str]) -> None:
     """
-    Корутин удаляющий файлы с диска при удалении поста
-    :param file_paths: Список путей для файлов
+    Корутин удаляющий файлы с диска
+    (на которые больше не ссылается ни одна запись Media)
+    :param file_paths: Список путей для файлов относительно MEDIA_ROOT
     :type file_paths: List[str]
     :return: Ничего не возвращает
     :rtype: None
     """
-    # Проходимся по списку и удаляем файлы
-    for i_path in file_paths:
-        # путь к удаляемому файлу
-        file_path = f"{"/app/database/media"}/{i_path}"
-        # Проверяем существует ли файл
-        if os.path.exists(file_path):
-            # удаляем файл
-            os.remove(file_path)
+    # Удаляем файлы вместе с их уменьшенными вариантами одновременно,
+    # количество параллельных удалений ограничено размером пула потоков
+    await asyncio.gather(
+        *[
+            run_media_io("remove", remove_file, os.path.join(MEDIA_ROOT, i_path))
+            for media_path in file_paths
+            for i_path in [media_path, *get_variant_paths(media_path)]
+        ]
+    )
+
+
+async def enqueue_media_deletions(
+    session: AsyncSession, media_paths: List[str]
+) -> None:
+    """
+    Корутин добавляющий файлы в очередь на удаление с диска
+    в транзакции удаления записей Media (см. media_gc.py)
+    :param session: Сессия, в транзакции которой удаляются записи Media
+    :type session: AsyncSession
+    :param media_paths: Пути к файлам относительно MEDIA_ROOT
+    :type media_paths: List[str]
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    if not media_paths:
+        return
+
+    await session.execute(
+        insert(MediaDeletions),
+        [{"media_path": i_path} for i_path in set(media_paths)],
+    )
+
+
+async def get_unreferenced_media_paths(
+    session: AsyncSession, media_paths: List[str]
+) -> List[str]:
+    """
+    Корутин возвращающий пути, на которые больше не ссылается ни одна запись Media
+    :param session: Сессия, в транзакции которой удалялись записи Media
+    :type session: AsyncSession
+    :param media_paths: Пути к файлам
+    :type media_paths: List[str]
+    :return: Пути к файлам без ссылок
+    :rtype: List[str]
+    """
+    referenced_query: Select = (
+        select(Media.media_path)
+        .where(Media.media_path.in_(media_paths))
+        .distinct()
+    )
+    referenced_result: ChunkedIteratorResult = await session.execute(
+        referenced_query
+    )
+    referenced_paths: Set[str] = set(referenced_result.scalars().all())
+
+    return [
+        i_path for i_path in set(media_paths) if i_path not in referenced_paths
+    ]
 
 
-async def get_user_from_api_key(api_key: str) -> Users | None:
+async def get_user_from_api_key(
+    session: AsyncSession, api_key: str
+) -> UserIdentity | None:
     """
-    Корутин возвращающий Users по Api-Key
+    Корутин возвращающий пользователя по Api-Key.
+    Сначала пользователь ищется в кэше авторизации, при промахе - в БД.
+    Найденный пользователь запоминается в сессии для выбора БД чтения
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param api_key: Api-Key пользователя
     :type api_key: str
-    :return: Экземпляр класса Users
-    :rtype: Users | None
+    :return: id и имя пользователя
+    :rtype: UserIdentity | None
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Запрос на получение пользователя по api_key
-            user_query: Select = select(Users).where(Users.api_key == api_key)
-            user_result: ChunkedIteratorResult = await session.execute(
-                user_query
-            )
-            user: Users | None = user_result.scalars().one_or_none()
+    # Ищем пользователя в кэше
+    user: UserIdentity | None = auth_cache.get(api_key)
 
-            return user
+    if user:
+        await route_user_reads(session, user.id)
+        return user
 
+    # Запрос на получение пользователя по api_key
+    user_query: Select = select(Users.id, Users.user).where(
+        Users.api_key == api_key
+    )
+    user_result: ChunkedIteratorResult = await session.execute(user_query)
+    user_row: Row | None = user_result.one_or_none()
 
-async def get_user_from_id(user_id: int) -> Dict | None:
+    # Если пользователь найден, то сохраняем его в кэш
+    if user_row:
+        user = UserIdentity(id=user_row.id, name=user_row.user)
+        auth_cache.set(api_key, user)
+        await route_user_reads(session, user.id)
+
+    return user
+
+
+async def get_user_from_id(
+    session: AsyncSession, user_id: int, compact: bool = False
+) -> Dict | None:
     """
     Корутин возвращающий всю информацию о пользователе по его ID
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param user_id: ИД пользователя
     :type user_id: int
+    :param compact: Вернуть количество подписчиков и подписок вместо их списков
+    :type compact: bool
     :return: Словарь со всей информацией о пользователе
     :rtype: Dict
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Запрос на получение пользователя, так же его подписчиков и на кого он подписан
-            user_query: Select = (
-                select(Users)
-                .filter(Users.id == user_id)
-                .options(
-                    selectinload(Users.following),
-                    selectinload(Users.followers),
-                )
-            )
-            user_result: ChunkedIteratorResult = await session.execute(
-                user_query
-            )
-            user: Users | None = user_result.scalars().one_or_none()
+    # Запрос на получение пользователя
+    user_query: Select = select(Users).filter(Users.id == user_id)
 
-    # Если пользователь найден
-    if user:
-        # Создаём словарь с информацией о пользователе
+    # Подписчиков и на кого он подписан загружаем только для полного ответа
+    if not compact:
+        user_query = user_query.options(
+            selectinload(Users.following),
+            selectinload(Users.followers),
+        )
+
+    user_result: ChunkedIteratorResult = await session.execute(user_query)
+    user: Users | None = user_result.scalars().one_or_none()
+
+    # Если пользователь не найден
+    if not user:
+        return None
+
+    # Создаём словарь с информацией о пользователе
+    if compact:
+        user_data: Dict = {
+            "id": user.id,
+            "name": user.user,
+            "followers_count": user.followers_count,
+            "following_count": user.following_count,
+        }
+    else:
         user_data: Dict = {
             "id": user.id,
             "name": user.user,
@@ -140,48 +470,275 @@ async def get_user_from_id(user_id: int) -> Dict | None:
             ],
         }
 
-        return user_data
+    return user_data
 
-    return None
+
+def get_user_links_subquery(owner_column, linked_column) -> ScalarSelect:
+    """
+    Функция строящая подзапрос со списком подписчиков или подписок
+    пользователя в виде JSON-массива [{"id": ..., "name": ...}]
+    :param owner_column: Колонка followers с id пользователя из внешнего запроса
+    :param linked_column: Колонка followers с id пользователей списка
+    :return: Коррелированный подзапрос
+    :rtype: ScalarSelect
+    """
+    linked_user = aliased(Users)
+
+    return (
+        select(
+            func.coalesce(
+                func.json_agg(
+                    aggregate_order_by(
+                        func.json_build_object(
+                            "id", linked_user.id, "name", linked_user.user
+                        ),
+                        linked_user.id,
+                    ),
+                    type_=JSON,
+                ),
+                literal_column("'[]'::json", JSON),
+            )
+        )
+        .select_from(integration_followers)
+        .join(linked_user, linked_user.id == linked_column)
+        .where(owner_column == Users.id)
+        .scalar_subquery()
+    )
 
 
-async def get_all_tweets_from_db() -> List[Dict]:
+async def get_users_from_ids(
+    session: AsyncSession, user_ids: List[int], compact: bool = False
+) -> List[Dict]:
     """
-    Корутин для получения списка всех твитов
-    :return: Список твитов
+    Корутин возвращающий информацию о нескольких пользователях одним запросом
+    (списки подписчиков и подписок собираются в БД подзапросами)
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_ids: id пользователей
+    :type user_ids: List[int]
+    :param compact: Вернуть количество подписчиков и подписок вместо их списков
+    :type compact: bool
+    :return: Пользователи в порядке user_ids (ненайденные пропускаются)
     :rtype: List[Dict]
     """
-    async with async_session() as sessions:
-        async with sessions.begin():
-            tweets_query: Select = (
-                select(Tweets)
-                .options(
-                    selectinload(Tweets.author),
-                    selectinload(Tweets.medias),
-                    selectinload(Tweets.user_like),
-                )
-                .order_by(Tweets.id.desc())
-            )
-            tweets_result: ChunkedIteratorResult = await sessions.execute(
-                tweets_query
-            )
-            tweets: Tweets = tweets_result.scalars().all()
+    if compact:
+        users_query: Select = select(
+            Users.id,
+            Users.user.label("name"),
+            Users.followers_count,
+            Users.following_count,
+        )
+    else:
+        users_query: Select = select(
+            Users.id,
+            Users.user.label("name"),
+            get_user_links_subquery(
+                integration_followers.c.following_id,
+                integration_followers.c.user_id,
+            ).label("followers"),
+            get_user_links_subquery(
+                integration_followers.c.user_id,
+                integration_followers.c.following_id,
+            ).label("following"),
+        )
+
+    users_result: ChunkedIteratorResult = await session.execute(
+        users_query.where(Users.id.in_(user_ids))
+    )
+    users: Dict[int, Dict] = {
+        i_user["id"]: dict(i_user) for i_user in users_result.mappings()
+    }
+
+    return [users[i_id] for i_id in user_ids if i_id in users]
+
+
+async def get_following_ids(session: AsyncSession, user_id: int) -> List[int]:
+    """
+    Корутин возвращающий id пользователей, на которых подписан пользователь
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_id: id пользователя
+    :type user_id: int
+    :return: Список id
+    :rtype: List[int]
+    """
+    following_query: Select = select(integration_followers.c.following_id).where(
+        integration_followers.c.user_id == user_id
+    )
+    following_result: ChunkedIteratorResult = await session.execute(
+        following_query
+    )
+
+    return list(following_result.scalars().all())
+
+
+def get_following_tweets_query(
+    user_id: int, cursor: int | None, limit: int, merge_on_read_only: bool = True
+) -> Select:
+    """
+    Функция собирающая запрос id последних твитов авторов из подписок пользователя
+    :param user_id: id пользователя
+    :type user_id: int
+    :param cursor: id твита, начиная с которого (не включительно) нужна страница
+    :type cursor: int | None
+    :param limit: Размер страницы
+    :type limit: int
+    :param merge_on_read_only: Только авторы, чьи твиты не рассылаются по лентам
+        при записи (иначе - все авторы из подписок и сам пользователь)
+    :type merge_on_read_only: bool
+    :return: Запрос id твитов
+    :rtype: Select
+    """
+    if merge_on_read_only:
+        # Авторы из подписок пользователя с пометкой merge_on_read
+        authors: Subquery = (
+            select(integration_followers.c.following_id.label("author_id"))
+            .join(Users, Users.id == integration_followers.c.following_id)
+            .where(integration_followers.c.user_id == user_id, Users.merge_on_read)
+            .subquery("authors")
+        )
+    else:
+        # Все авторы из подписок пользователя и он сам
+        authors = union_all(
+            select(integration_followers.c.following_id.label("author_id")).where(
+                integration_followers.c.user_id == user_id
+            ),
+            select(cast(literal(user_id), Integer).label("author_id")),
+        ).subquery("authors")
+
+    # Для каждого автора берём не больше limit последних твитов
+    # по индексу (author_id, id), поэтому стоимость не зависит от размера таблицы
+    author_tweets_query: Select = select(Tweets.id).where(
+        Tweets.author_id == authors.c.author_id
+    )
+    if cursor is not None:
+        author_tweets_query = author_tweets_query.where(Tweets.id < cursor)
+    author_tweets: Lateral = (
+        author_tweets_query.order_by(Tweets.id.desc())
+        .limit(limit)
+        .lateral("author_tweets")
+    )
+
+    # Объединяем твиты всех авторов и оставляем одну страницу
+    merged_ids_query: Select = (
+        select(author_tweets.c.id)
+        .select_from(authors)
+        .join(author_tweets, true())
+        .order_by(author_tweets.c.id.desc())
+        .limit(limit)
+    )
+
+    return merged_ids_query
+
 
+async def fan_out_tweet(
+    session: AsyncSession, tweet_id: int, author_id: int
+) -> None:
+    """
+    Корутин рассылающий новый твит по лентам автора и его подписчиков
+    :param session: Сессия, в транзакции которой записан твит
+    :type session: AsyncSession
+    :param tweet_id: id твита
+    :type tweet_id: int
+    :param author_id: id автора твита
+    :type author_id: int
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    # Считаем подписчиков автора, но не больше порога рассылки
+    followers_query: Select = (
+        select(integration_followers.c.user_id)
+        .where(integration_followers.c.following_id == author_id)
+        .limit(FANOUT_MAX_FOLLOWERS + 1)
+    )
+    followers_count: int = await session.scalar(
+        select(func.count()).select_from(followers_query.subquery())
+    )
+
+    # Если подписчиков слишком много, то твиты автора подмешиваются при чтении,
+    # твит попадает только в ленту самого автора
+    if followers_count > FANOUT_MAX_FOLLOWERS:
+        await session.execute(
+            update(Users)
+            .where(Users.id == author_id, Users.merge_on_read.is_(False))
+            .values(merge_on_read=True)
+        )
+        await timeline_store.push(
+            session, user_ids=[author_id], tweet_id=tweet_id, author_id=author_id
+        )
+        mark_timelines_changed(session, author_id=author_id, followers=False)
+        return
+
+    await timeline_store.push_to_followers(
+        session, tweet_id=tweet_id, author_id=author_id
+    )
+    mark_timelines_changed(session, author_id=author_id)
+
+
+def get_tweets_query(user_id: int, compact: bool) -> Select:
+    """
+    Функция собирающая запрос твитов с авторами, картинками и лайками
+    (общий для ленты и поиска)
+    :param user_id: id пользователя, запрашивающего твиты
+    :type user_id: int
+    :param compact: Вместо списка лайкнувших - отметка "лайкнул ли пользователь"
+    :type compact: bool
+    :return: Запрос без условий и сортировки
+    :rtype: Select
+    """
+    if compact:
+        # Вместо списка лайкнувших - отметка, лайкнул ли твит пользователь
+        liked: Exists = exists().where(
+            integration_like.c.tweet_id == Tweets.id,
+            integration_like.c.user_id == user_id,
+        )
+        return select(Tweets, liked.label("liked")).options(
+            selectinload(Tweets.author),
+            selectinload(Tweets.medias),
+        )
+
+    return select(Tweets).options(
+        selectinload(Tweets.author),
+        selectinload(Tweets.medias),
+        selectinload(Tweets.user_like),
+    )
+
+
+def render_tweets(tweets: List[Row], compact: bool) -> List[Dict]:
+    """
+    Функция собирающая ответ из строк запроса get_tweets_query
+    :param tweets: Строки запроса
+    :type tweets: List[Row]
+    :param compact: Компактный ответ
+    :type compact: bool
+    :return: Список твитов
+    :rtype: List[Dict]
+    """
     # Список словарей с информацией о твите
     tweets_list: List = list()
 
     # Проходимся циклом по результату, для создания словаря с информацией о твите
-    for i_result in tweets:
+    for i_row in tweets:
+        i_result: Tweets = i_row.Tweets
         tweet: Dict = {
             "id": i_result.id,
             "content": i_result.tweet,
-            "attachments": [i_image.media_path for i_image in i_result.medias],
+            # Картинка для ленты, пока она не готова - исходная картинка
+            "attachments": [
+                i_image.feed_path or i_image.media_path
+                for i_image in i_result.medias
+            ],
             "author": {"id": i_result.author.id, "name": i_result.author.user},
-            "likes": [
+        }
+
+        if compact:
+            tweet["like_count"] = i_result.like_count
+            tweet["liked"] = i_row.liked
+        else:
+            tweet["likes"] = [
                 {"user_id": i_like.id, "name": i_like.user}
                 for i_like in i_result.user_like
-            ],
-        }
+            ]
 
         # Добавляем твит к списку
         tweets_list.append(tweet)
@@ -189,44 +746,340 @@ async def get_all_tweets_from_db() -> List[Dict]:
     return tweets_list
 
 
-async def write_image_to_db(file: bytes, user_api_key: str) -> int:
+async def get_all_tweets_from_db(
+    session: AsyncSession,
+    user_id: int,
+    cursor: int | None = None,
+    limit: int = TWEETS_PAGE_SIZE,
+    following_only: bool = False,
+    compact: bool = False,
+) -> List[Dict]:
+    """
+    Корутин для получения страницы твитов (keyset-пагинация по Tweets.id)
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_id: id пользователя, запрашивающего ленту
+    :type user_id: int
+    :param cursor: id твита, начиная с которого (не включительно) нужно отдать страницу
+    :type cursor: int | None
+    :param limit: Размер страницы
+    :type limit: int
+    :param following_only: Только твиты пользователей из подписок и свои твиты
+    :type following_only: bool
+    :param compact: Вернуть количество лайков и отметку "лайкнул ли пользователь"
+        вместо списка лайкнувших
+    :type compact: bool
+    :return: Список твитов
+    :rtype: List[Dict]
+    """
+    if following_only:
+        # Срез предрассчитанной ленты пользователя
+        inbox_ids: List[int] = await timeline_store.get_page(
+            session, user_id=user_id, cursor=cursor, limit=limit
+        )
+        if len(inbox_ids) < limit:
+            # Курсор дошёл до конца ленты (она хранит только последние
+            # TIMELINE_INBOX_SIZE твитов): страница собирается по всем авторам
+            tweets_filter = Tweets.id.in_(
+                get_following_tweets_query(
+                    user_id=user_id,
+                    cursor=cursor,
+                    limit=limit,
+                    merge_on_read_only=False,
+                )
+            )
+        else:
+            # Твиты авторов, которым твиты не рассылаются при записи
+            merged_ids_query: Select = get_following_tweets_query(
+                user_id=user_id, cursor=cursor, limit=limit
+            )
+            tweets_filter = or_(
+                Tweets.id.in_(inbox_ids), Tweets.id.in_(merged_ids_query)
+            )
+    else:
+        # Общая лента, обратный проход по первичному ключу
+        tweets_filter = Tweets.id < cursor if cursor is not None else true()
+
+    tweets_query: Select = (
+        get_tweets_query(user_id=user_id, compact=compact)
+        .where(tweets_filter)
+        .order_by(Tweets.id.desc())
+        .limit(limit)
+    )
+    tweets_result: ChunkedIteratorResult = await session.execute(tweets_query)
+
+    return render_tweets(tweets_result.all(), compact=compact)
+
+
+async def get_tweets_versions(
+    session: AsyncSession, user_id: int, following_only: bool = False
+) -> List[int]:
+    """
+    Корутин возвращающий версию ленты для ETag и ключа кэша ответов.
+    Новые твиты меняют id последнего твита (общая лента) или счётчик ленты
+    подписок пользователя, поэтому запись твита не увеличивает общий счётчик.
+    Лайки, удаление и картинки твитов меняют счётчики твитов
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_id: id пользователя, запрашивающего ленту
+    :type user_id: int
+    :param following_only: Лента подписок
+    :type following_only: bool
+    :return: id последнего твита, затем значения счётчиков
+    :rtype: List[int]
+    """
+    if following_only:
+        # Твиты авторов merge_on_read не рассылаются и не меняют счётчик ленты
+        newest_query: Select = get_following_tweets_query(
+            user_id=user_id, cursor=None, limit=1
+        )
+        counters: List[str] = [
+            get_timeline_counter(user_id),
+            get_user_counter(user_id),
+            *TWEETS_COUNTERS,
+        ]
+    else:
+        newest_query = select(func.max(Tweets.id))
+        counters = TWEETS_COUNTERS
+
+    newest_id: int | None = await session.scalar(newest_query)
+
+    return [newest_id or 0, *await get_counters(session, counters)]
+
+
+def format_search_cursor(rank: float, tweet_id: int) -> str:
+    """
+    Функция возвращающая курсор следующей страницы поиска
+    :param rank: Релевантность последнего твита страницы
+    :type rank: float
+    :param tweet_id: id последнего твита страницы
+    :type tweet_id: int
+    :return: Курсор вида <релевантность>:<id>
+    :rtype: str
+    """
+    # repr - точное значение, чтобы сравнение в БД не пропустило твиты
+    return "{!r}:{}".format(rank, tweet_id)
+
+
+def parse_search_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Функция разбирающая курсор страницы поиска
+    :param cursor: Курсор из format_search_cursor
+    :type cursor: str
+    :return: Релевантность и id твита
+    :rtype: Tuple[float, int]
+    :raises ValueError: Если курсор некорректный
+    """
+    rank, tweet_id = cursor.split(":")
+
+    if not math.isfinite(float(rank)):
+        raise ValueError("cursor rank must be finite")
+
+    if not 0 < int(tweet_id) <= TWEET_ID_MAX:
+        raise ValueError("cursor tweet id is out of range")
+
+    return float(rank), int(tweet_id)
+
+
+async def search_tweets_in_db(
+    session: AsyncSession,
+    user_id: int,
+    text_query: str,
+    cursor: Tuple[float, int] | None = None,
+    limit: int = TWEETS_PAGE_SIZE,
+    compact: bool = False,
+) -> Tuple[List[Dict], str | None]:
+    """
+    Корутин полнотекстового поиска твитов по индексу tweets.search_vector.
+    Твиты отсортированы по релевантности, при равной - новые первыми
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_id: id пользователя, выполняющего поиск
+    :type user_id: int
+    :param text_query: Поисковый запрос (синтаксис websearch: "фраза", or, -слово)
+    :type text_query: str
+    :param cursor: Релевантность и id последнего твита предыдущей страницы
+    :type cursor: Tuple[float, int] | None
+    :param limit: Размер страницы
+    :type limit: int
+    :param compact: Компактный ответ
+    :type compact: bool
+    :return: Список твитов и курсор следующей страницы (None на последней)
+    :rtype: Tuple[List[Dict], str | None]
+    """
+    ts_query = func.websearch_to_tsquery(
+        cast(SEARCH_CONFIG, REGCONFIG), text_query
+    )
+    matches: Subquery = (
+        select(
+            Tweets.id,
+            func.ts_rank_cd(Tweets.search_vector, ts_query).label("rank"),
+        )
+        .where(Tweets.search_vector.bool_op("@@")(ts_query))
+        .subquery("matches")
+    )
+
+    page_query: Select = select(matches.c.id, matches.c.rank)
+    if cursor is not None:
+        page_query = page_query.where(
+            tuple_(matches.c.rank, matches.c.id)
+            < tuple_(cast(cursor[0], REAL), cursor[1])
+        )
+    page: Subquery = (
+        page_query.order_by(matches.c.rank.desc(), matches.c.id.desc())
+        .limit(limit)
+        .subquery("page")
+    )
+
+    tweets_query: Select = (
+        get_tweets_query(user_id=user_id, compact=compact)
+        .add_columns(page.c.rank)
+        .join(page, page.c.id == Tweets.id)
+        .order_by(page.c.rank.desc(), Tweets.id.desc())
+    )
+    tweets_result: ChunkedIteratorResult = await session.execute(tweets_query)
+    tweets: List[Row] = tweets_result.all()
+
+    next_cursor: str | None = None
+    # Если страница заполнена полностью, то отдаём курсор следующей страницы
+    if len(tweets) == limit:
+        next_cursor = format_search_cursor(tweets[-1].rank, tweets[-1].Tweets.id)
+
+    return render_tweets(tweets, compact=compact), next_cursor
+
+
+async def clean_search_index() -> None:
+    """
+    Корутин переносящий новые твиты из списка ожидания в полнотекстовый индекс.
+    Пока список не перенесён, поиск просматривает его целиком, а при его
+    переполнении перенос выполнил бы запрос, записывающий твит
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(
+                select(
+                    func.gin_clean_pending_list(
+                        cast("ix_tweets_search_vector", REGCLASS)
+                    )
+                )
+            )
+
+
+async def run_search_index_cleaner() -> None:
+    """
+    Корутин периодически выполняющий clean_search_index (фоновая задача)
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_CLEAN_INTERVAL)
+
+        try:
+            await clean_search_index()
+        except Exception:
+            # Повторим через интервал, поиск при этом работает
+            logger.exception("search index cleanup failed")
+
+
+async def process_image_variants(media_path: str) -> None:
+    """
+    Корутин создающий уменьшенные варианты картинки в пуле процессов
+    и записывающий их пути во все записи Media с этим файлом
+    :param media_path: Путь к исходному файлу относительно MEDIA_ROOT
+    :type media_path: str
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+    try:
+        # Обработка картинки нагружает процессор, поэтому выполняется в другом процессе
+        variants: Dict[str, str] = await loop.run_in_executor(
+            get_image_pool(), render_variants, MEDIA_ROOT, media_path
+        )
+
+        async with async_session() as session:
+            async with session.begin():
+                media_result: CursorResult = await session.execute(
+                    update(Media)
+                    .where(Media.media_path == media_path)
+                    .values(
+                        thumbnail_path=variants["thumbnail"],
+                        feed_path=variants["feed"],
+                        large_path=variants["large"],
+                    )
+                    .returning(Media.tweet_id)
+                )
+                # В ленте меняются ссылки на картинки твитов с этим файлом
+                counters: Set[str] = {
+                    get_tweets_counter(i_tweet_id)
+                    for i_tweet_id in media_result.scalars().all()
+                    if i_tweet_id is not None
+                }
+                await bump_counters(session, counters)
+
+        await response_cache.invalidate(counters)
+    except Exception:
+        # Твит остаётся с исходной картинкой
+        logger.exception("image processing failed for %s", media_path)
+
+
+def schedule_image_processing(media_path: str) -> None:
+    """
+    Функция запускающая фоновую обработку картинки, не дожидаясь её окончания
+    :param media_path: Путь к исходному файлу относительно MEDIA_ROOT
+    :type media_path: str
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    if not is_image_processing_enabled():
+        return
+
+    task: asyncio.Task = asyncio.create_task(process_image_variants(media_path))
+    IMAGE_PROCESSING_TASKS.add(task)
+    task.add_done_callback(IMAGE_PROCESSING_TASKS.discard)
+
+
+async def write_image_to_db(session: AsyncSession, file: UploadFile) -> int:
     """
     Корутин для записи пути(местонахождения) файла в БД
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param file: картинка
-    :type file: byte
-    :param user_api_key: Api_Key
-    :type user_api_key: str
+    :type file: UploadFile
     :return: id записи в БД
     :rtype: int
+    :raises FileTooLargeError: Если файл больше MEDIA_MAX_UPLOAD_SIZE
+    :raises UnsupportedMediaTypeError: Если файл не картинка поддерживаемого формата
     """
-    # Генерируем случайное имя файла
-    # (нужно для предотвращения перезаписи файла в случае загрузки разных файлов с одинаковыми именами)
-    file_name = await generate_random_filename()
-    # Записываем файл на диск
-    await write_image_to_disk(
-        file=file, file_name=file_name, user_api_key=user_api_key
-    )
+    # Записываем файл на диск, путь к файлу строится из хэша содержимого
+    content_hash, media_path = await write_image_to_disk(session, file=file)
 
-    # Создаём путь для файла, который запишем в БД
-    media_path: str = "user_post_images/{}/{}".format(user_api_key, file_name)
     # Создаём экземпляр класса Media для записи в БД
-    media: Media = Media(media_path=media_path)
+    media: Media = Media(media_path=media_path, content_hash=content_hash)
 
     # Записываем в БД
-    async with async_session() as sessions:
-        async with sessions.begin():
-            sessions.add(media)
-            await sessions.commit()
+    session.add(media)
+    await session.flush()
 
     # Получаем id новой записи
     media_id: int = media.id
 
+    # Создаём уменьшенные варианты картинки в фоне, когда запись будет сохранена
+    run_after_commit(session, lambda: schedule_image_processing(media_path))
+
     return media_id
 
 
-async def write_post_to_db(tweet_text: str, author_id: int) -> int:
+async def write_post_to_db(
+    session: AsyncSession, tweet_text: str, author_id: int
+) -> int:
     """
     Корутин для записи твита в БД
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param tweet_text: Тест из твита
     :type tweet_text: str
     :param author_id: id автора записи
@@ -238,10 +1091,12 @@ async def write_post_to_db(tweet_text: str, author_id: int) -> int:
     tweet: Tweets = Tweets(tweet=tweet_text, author_id=author_id)
 
     # Записываем в БД
-    async with async_session() as sessions:
-        async with sessions.begin():
-            sessions.add(tweet)
-            await sessions.commit()
+    session.add(tweet)
+    await session.flush()
+
+    # Рассылаем твит по лентам подписчиков в той же транзакции
+    await fan_out_tweet(session, tweet_id=tweet.id, author_id=author_id)
+    publish_event(session, EVENT_TWEET, tweet_id=tweet.id, author_id=author_id)
 
     # Получаем id новой записи
     tweet_id: int = tweet.id
@@ -249,78 +1104,162 @@ async def write_post_to_db(tweet_text: str, author_id: int) -> int:
     return tweet_id
 
 
-async def write_likes_to_db(tweet_id: int, user: Users) -> None:
+async def write_likes_to_db(
+    session: AsyncSession, tweet_id: int, user_id: int
+) -> bool:
     """
-    Корутин для записи лайков в БД
+    Корутин для записи лайков в БД.
+    Лайк и счётчик лайков записываются одним запросом,
+    стоимость не зависит от количества уже поставленных лайков
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param tweet_id: id Твита
     :type tweet_id: str
-    :param user: Экземпляр класса Users
-    :type user: User
-    :return: Ничего не возвращает
-    :rtype: None
+    :param user_id: id пользователя
+    :type user_id: int
+    :return: True, если твит существует
+    :rtype: bool
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем твит из БД
-            tweet_query: Select = (
-                select(Tweets)
-                .filter(Tweets.id == tweet_id)
-                .options(selectinload(Tweets.user_like))
-            )
-            tweet_result: ChunkedIteratorResult = await session.execute(
-                tweet_query
-            )
-            tweet: Tweets | None = tweet_result.scalars().one_or_none()
+    # Твит, который лайкают
+    target: CTE = (
+        select(Tweets.id, Tweets.author_id)
+        .where(Tweets.id == tweet_id)
+        .cte("target")
+    )
+    # Добавляем лайк, если его ещё нет
+    inserted: CTE = (
+        insert(integration_like)
+        .from_select(
+            ["tweet_id", "user_id"], select(target.c.id, literal(user_id))
+        )
+        .on_conflict_do_nothing()
+        .returning(integration_like.c.tweet_id)
+        .cte("inserted")
+    )
+    # Увеличиваем счётчик, только если лайк добавлен
+    updated: CTE = (
+        update(Tweets)
+        .where(Tweets.id.in_(select(inserted.c.tweet_id)))
+        .values(like_count=Tweets.like_count + 1)
+        .cte("updated")
+    )
+    like_query: Select = select(target.c.author_id).add_cte(updated)
+
+    like_result: ChunkedIteratorResult = await session.execute(like_query)
+    author_id: int | None = like_result.scalar_one_or_none()
 
-            # Добавляем пользователя к лайкам в твите
-            tweet.user_like.append(user)
-            await session.commit()
+    if author_id is None:
+        return False
+
+    mark_changed(session, get_tweets_counter(tweet_id))
+    publish_event(
+        session, EVENT_LIKE, tweet_id=tweet_id, user_id=user_id, author_id=author_id
+    )
+
+    return True
 
 
-async def write_following_to_db(user_id: int, following_id: int) -> None:
+async def write_following_to_db(
+    session: AsyncSession, user_id: int, following_id: int
+) -> bool:
     """
-    Корутин для записи подписки в БД
+    Корутин для записи подписки в БД.
+    Подписка и оба счётчика записываются одним запросом,
+    стоимость не зависит от количества подписчиков
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param user_id: id пользователя
     :type user_id: int
     :param following_id: id на кого подписываться
     :type following_id: int
-    :return: Ничего не возвращает
-    :rtype: None
+    :return: True, если пользователь, на которого подписываются, существует
+    :rtype: bool
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем пользователя, который будет подписываться
-            user_query: Select = (
-                select(Users)
-                .filter(Users.id == user_id)
-                .options(selectinload(Users.following))
-            )
-            user_result: ChunkedIteratorResult = await session.execute(
-                user_query
-            )
-            user: Users = user_result.scalars().one_or_none()
-
-            # Получаем пользователя на которого будем подписываться
-            following_query: Select = select(Users).filter(
-                Users.id == following_id
-            )
-            following_result: ChunkedIteratorResult = await session.execute(
-                following_query
-            )
-            following: Users = following_result.scalars().one_or_none()
+    # Пользователь, на которого подписываются
+    target: CTE = (
+        select(Users.id, Users.merge_on_read)
+        .where(Users.id == following_id)
+        .cte("target")
+    )
+    # Добавляем подписку, если её ещё нет
+    inserted: CTE = (
+        insert(integration_followers)
+        .from_select(
+            ["user_id", "following_id"], select(literal(user_id), target.c.id)
+        )
+        .on_conflict_do_nothing()
+        .returning(integration_followers.c.following_id)
+        .cte("inserted")
+    )
+    # Увеличиваем счётчики, только если подписка добавлена
+    updated: CTE = (
+        update(Users)
+        .where(
+            Users.id.in_([user_id, following_id]),
+            exists(select(inserted.c.following_id)),
+        )
+        .values(
+            following_count=Users.following_count
+            + case((Users.id == user_id, 1), else_=0),
+            followers_count=Users.followers_count
+            + case((Users.id == following_id, 1), else_=0),
+        )
+        .cte("updated")
+    )
+    following_query: Select = select(
+        target.c.merge_on_read,
+        exists(select(inserted.c.following_id)).label("is_inserted"),
+    ).add_cte(updated)
 
-            # Добавляем подписку пользователю
-            user.following.append(following)
-            await session.commit()
+    following_result: ChunkedIteratorResult = await session.execute(
+        following_query
+    )
+    following: Row | None = following_result.one_or_none()
+
+    # Пользователь, на которого подписываются, не найден
+    if following is None:
+        return False
+
+    if following.is_inserted:
+        mark_changed(
+            session, get_user_counter(user_id), get_user_counter(following_id)
+        )
+        publish_event(
+            session, EVENT_FOLLOW, user_id=user_id, following_id=following_id
+        )
+
+    # Добавляем последние твиты автора в ленту пользователя (на всю длину ленты,
+    # более старые читаются по автору), если подписка новая
+    # и твиты автора не подмешиваются при чтении
+    if following.is_inserted and not following.merge_on_read:
+        backfill_query: Select = (
+            select(Tweets.id)
+            .where(Tweets.author_id == following_id)
+            .order_by(Tweets.id.desc())
+            .limit(TIMELINE_INBOX_SIZE)
+        )
+        backfill_result: ChunkedIteratorResult = await session.execute(
+            backfill_query
+        )
+        await timeline_store.backfill(
+            session,
+            user_id=user_id,
+            tweet_ids=list(backfill_result.scalars().all()),
+            author_id=following_id,
+        )
+
+    return True
 
 
 async def update_image_tweet_id(
-    image_id_list: List[int], tweet_id: int
+    session: AsyncSession, image_id_list: List[int], tweet_id: int
 ) -> None:
     """
     Корутин для обновления Media, мы добавляем tweet_id
     так как изображения загружаются перед твитом, мы не может знать id твита,
     поэтому id твита к изображениям мы добавляем здесь
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param image_id_list: Список состоящий из id картинок
     :type image_id_list: List[int]
     :param tweet_id: id твита
@@ -328,153 +1267,298 @@ async def update_image_tweet_id(
     :return: Ничего не возвращает
     :rtype: None
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем медиа
-            media_query: Select = select(Media).filter(
-                Media.id.in_(image_id_list)
-            )
-            media_result: ChunkedIteratorResult = await session.execute(
-                media_query
-            )
-            media: Media = media_result.scalars().all()
+    # Получаем медиа
+    media_query: Select = select(Media).filter(Media.id.in_(image_id_list))
+    media_result: ChunkedIteratorResult = await session.execute(media_query)
+    media: Media = media_result.scalars().all()
 
-            # Проходимся по полученному списку медиа, и добавляем к ним id твита
-            for i_media in media:
-                i_media.tweet_id = tweet_id
+    # Проходимся по полученному списку медиа, и добавляем к ним id твита
+    for i_media in media:
+        i_media.tweet_id = tweet_id
 
-            await session.commit()
+    await session.flush()
 
 
-async def delete_likes_from_db(tweet_id: int, user_id: int):
+async def delete_likes_from_db(
+    session: AsyncSession, tweet_id: int, user_id: int
+) -> bool:
     """
-    Корутин для удаления лайка из БД
+    Корутин для удаления лайка из БД.
+    Лайк удаляется и счётчик лайков уменьшается одним запросом
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param tweet_id: id Твита
     :type tweet_id: int
     :param user_id: id пользователя
     :type user_id: int
-    :return: Ничего не возвращает
-    :rtype: None
+    :return: True, если твит существует
+    :rtype: bool
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем пользователя
-            user_query: Select = select(Users).filter(Users.id == user_id)
-            user_result: ChunkedIteratorResult = await session.execute(
-                user_query
-            )
-            user: Users = user_result.scalars().one_or_none()
+    # Удаляем лайк
+    deleted: CTE = (
+        delete(integration_like)
+        .where(
+            integration_like.c.tweet_id == tweet_id,
+            integration_like.c.user_id == user_id,
+        )
+        .returning(integration_like.c.tweet_id)
+        .cte("deleted")
+    )
+    # Уменьшаем счётчик, только если лайк был удалён
+    updated: CTE = (
+        update(Tweets)
+        .where(Tweets.id.in_(select(deleted.c.tweet_id)))
+        .values(like_count=Tweets.like_count - 1)
+        .cte("updated")
+    )
+    unlike_query: Select = (
+        select(Tweets.author_id).where(Tweets.id == tweet_id).add_cte(updated)
+    )
 
-            # Получаем твит
-            tweet_query: Select = (
-                select(Tweets)
-                .filter(Tweets.id == tweet_id)
-                .options(selectinload(Tweets.user_like))
-            )
-            tweet_result: ChunkedIteratorResult = await session.execute(
-                tweet_query
+    unlike_result: ChunkedIteratorResult = await session.execute(unlike_query)
+    author_id: int | None = unlike_result.scalar_one_or_none()
+
+    if author_id is None:
+        return False
+
+    mark_changed(session, get_tweets_counter(tweet_id))
+    publish_event(
+        session, EVENT_UNLIKE, tweet_id=tweet_id, user_id=user_id, author_id=author_id
+    )
+
+    return True
+
+
+async def write_likes_batch_to_db(
+    session: AsyncSession, operations: Dict[Tuple[int, int], bool]
+) -> Dict[int, int]:
+    """
+    Корутин записывающий пачку лайков и отмен лайков одним запросом.
+    Лайки добавляются и удаляются, счётчики лайков меняются на разницу
+    по каждому твиту. Твиты пачки блокируются по возрастанию id,
+    поэтому параллельные пачки не блокируют друг друга взаимно
+    :param session: Сессия транзакции
+    :type session: AsyncSession
+    :param operations: Итоговое состояние лайка (True - поставлен)
+        по id твита и id пользователя
+    :type operations: Dict[Tuple[int, int], bool]
+    :return: id авторов существующих твитов пачки по id твита
+    :rtype: Dict[int, int]
+    """
+    # Операции пачки: одна строка VALUES на пару твит-пользователь
+    ops: CTE = select(
+        values(
+            column("tweet_id", Integer),
+            column("user_id", Integer),
+            column("liked", Boolean),
+            name="ops_values",
+        ).data(
+            [
+                (i_tweet_id, i_user_id, i_liked)
+                for (i_tweet_id, i_user_id), i_liked in sorted(operations.items())
+            ]
+        )
+    ).cte("ops")
+    # Твиты, которые лайкают
+    target: CTE = (
+        select(Tweets.id, Tweets.author_id)
+        .where(Tweets.id.in_(select(ops.c.tweet_id)))
+        .order_by(Tweets.id)
+        .with_for_update()
+        .cte("target")
+    )
+    # Добавляем лайки, которых ещё нет
+    inserted: CTE = (
+        insert(integration_like)
+        .from_select(
+            ["tweet_id", "user_id"],
+            select(ops.c.tweet_id, ops.c.user_id)
+            .join(target, target.c.id == ops.c.tweet_id)
+            .where(ops.c.liked),
+        )
+        .on_conflict_do_nothing()
+        .returning(integration_like.c.tweet_id)
+        .cte("inserted")
+    )
+    # Удаляем отменённые лайки
+    deleted: CTE = (
+        delete(integration_like)
+        .where(
+            integration_like.c.tweet_id == ops.c.tweet_id,
+            integration_like.c.user_id == ops.c.user_id,
+            ops.c.liked.is_(False),
+        )
+        .returning(integration_like.c.tweet_id)
+        .cte("deleted")
+    )
+    # Разница счётчика лайков по каждому твиту
+    changes: Subquery = union_all(
+        select(inserted.c.tweet_id, literal(1).label("delta")),
+        select(deleted.c.tweet_id, literal(-1).label("delta")),
+    ).subquery("changes")
+    deltas: CTE = (
+        select(changes.c.tweet_id, func.sum(changes.c.delta).label("delta"))
+        .group_by(changes.c.tweet_id)
+        .cte("deltas")
+    )
+    updated: CTE = (
+        update(Tweets)
+        .where(Tweets.id == deltas.c.tweet_id)
+        .values(like_count=Tweets.like_count + deltas.c.delta)
+        .cte("updated")
+    )
+    batch_query: Select = select(target.c.id, target.c.author_id).add_cte(updated)
+
+    batch_result: ChunkedIteratorResult = await session.execute(batch_query)
+    authors: Dict[int, int] = dict(batch_result.tuples().all())
+
+    if authors:
+        mark_changed(
+            session, *(get_tweets_counter(i_tweet_id) for i_tweet_id in authors)
+        )
+
+    for (i_tweet_id, i_user_id), i_liked in operations.items():
+        if i_tweet_id in authors:
+            publish_event(
+                session,
+                EVENT_LIKE if i_liked else EVENT_UNLIKE,
+                tweet_id=i_tweet_id,
+                user_id=i_user_id,
+                author_id=authors[i_tweet_id],
             )
-            tweet: Tweets = tweet_result.scalars().one_or_none()
 
-            # Удаляем пользователя из лайков в твите
-            tweet.user_like.remove(user)
-            await session.commit()
+    return authors
 
 
-async def delete_tweet_from_db(tweet_id: int, user_id: int) -> bool:
+async def delete_tweet_from_db(
+    session: AsyncSession, tweet_id: int, user_id: int
+) -> bool | None:
     """
     Корутин для удаления твита из БД
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param tweet_id: id твита
     :type tweet_id: int
     :param user_id: id пользователя, который хочет удалить твит
     :type user_id: int
-    :return: Ничего не возвращает
-    :rtype: None
+    :return: True, если твит удалён, False - если пользователь не автор,
+        None - если твит не найден
+    :rtype: bool | None
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем твит
-            tweet_query: Select = (
-                select(Tweets)
-                .filter(Tweets.id == tweet_id)
-                .options(
-                    selectinload(Tweets.medias), selectinload(Tweets.author)
-                )
-            )
-            tweet_result: ChunkedIteratorResult = await session.execute(
-                tweet_query
-            )
-            tweet: Tweets = tweet_result.scalars().one_or_none()
+    # Получаем твит
+    tweet_query: Select = (
+        select(Tweets)
+        .filter(Tweets.id == tweet_id)
+        .options(selectinload(Tweets.medias), selectinload(Tweets.author))
+    )
+    tweet_result: ChunkedIteratorResult = await session.execute(tweet_query)
+    tweet: Tweets | None = tweet_result.scalars().one_or_none()
 
-            # Если id пользователя и id автора твита совпадают, то удаляем твит, иначе нет
-            if tweet.author.id == user_id:
+    if tweet is None:
+        return None
 
-                # Список содержащий пути к файлам из удаляемого твита (нужен для удаления изображений с диска)
-                media_path_list: List[str] | None = [
-                    media.media_path for media in tweet.medias
-                ]
+    # Если id пользователя и id автора твита совпадают, то удаляем твит, иначе нет
+    if tweet.author.id == user_id:
 
-                # Удаляем твит
-                await session.delete(tweet)
-                await session.commit()
+        # Список содержащий пути к файлам из удаляемого твита (нужен для удаления изображений с диска)
+        media_path_list: List[str] | None = [
+            media.media_path for media in tweet.medias
+        ]
 
-                # Если у поста были медиа фалы, то удаляем их с диска
-                if media_path_list:
-                    await remove_images_from_disk(file_paths=media_path_list)
+        # Удаляем твит из лент и сам твит (вместе с записями Media)
+        await timeline_store.retract_tweet(session, tweet_id=tweet_id)
+        await session.delete(tweet)
+        await session.flush()
+        mark_changed(session, get_tweets_counter(tweet_id))
+        publish_event(
+            session, EVENT_TWEET_DELETED, tweet_id=tweet_id, author_id=user_id
+        )
 
-                return True
+        # Файлы удаляет фоновая задача после сохранения удаления твита
+        # (файлы, на которые ещё ссылаются другие твиты, она не удаляет)
+        await enqueue_media_deletions(session, media_paths=media_path_list)
 
-            return False
+        return True
 
+    return False
 
-async def delete_following(user_id: int, following_id: int) -> None:
+
+async def delete_following(
+    session: AsyncSession, user_id: int, following_id: int
+) -> bool:
     """
-    Корутин для удаления подписки на пользователя
+    Корутин для удаления подписки на пользователя.
+    Подписка удаляется и оба счётчика уменьшаются одним запросом
+    :param session: Сессия запроса
+    :type session: AsyncSession
     :param user_id: id пользователя
     :type user_id: int
     :param following_id: id того, на кого подписан
     :type following_id: int
-    :return: Ничего не возвращает
-    :rtype: None
+    :return: True, если пользователь, от которого отписываются, существует
+    :rtype: bool
     """
-    async with async_session() as session:
-        async with session.begin():
-            # Получаем пользователя, который подписан
-            user_query: Select = (
-                select(Users)
-                .filter(Users.id == user_id)
-                .options(selectinload(Users.following))
-            )
-            user_result: ChunkedIteratorResult = await session.execute(
-                user_query
-            )
-            user: Users = user_result.scalars().one_or_none()
+    # Удаляем подписку
+    deleted: CTE = (
+        delete(integration_followers)
+        .where(
+            integration_followers.c.user_id == user_id,
+            integration_followers.c.following_id == following_id,
+        )
+        .returning(integration_followers.c.following_id)
+        .cte("deleted")
+    )
+    # Уменьшаем счётчики, только если подписка была удалена
+    updated: CTE = (
+        update(Users)
+        .where(
+            Users.id.in_([user_id, following_id]),
+            exists(select(deleted.c.following_id)),
+        )
+        .values(
+            following_count=Users.following_count
+            - case((Users.id == user_id, 1), else_=0),
+            followers_count=Users.followers_count
+            - case((Users.id == following_id, 1), else_=0),
+        )
+        .cte("updated")
+    )
+    unfollow_query: Select = select(
+        exists().where(Users.id == following_id).label("target_exists"),
+        exists(select(deleted.c.following_id)).label("is_deleted"),
+    ).add_cte(updated)
 
-            # Получаем пользователя на которого подписан
-            following_query: Select = select(Users).filter(
-                Users.id == following_id
-            )
-            following_result: ChunkedIteratorResult = await session.execute(
-                following_query
-            )
-            following: Users = following_result.scalars().one_or_none()
+    unfollow_result: ChunkedIteratorResult = await session.execute(
+        unfollow_query
+    )
+    unfollow: Row = unfollow_result.one()
+
+    # Убираем твиты автора из ленты пользователя
+    if unfollow.is_deleted:
+        await timeline_store.retract_author(
+            session, user_id=user_id, author_id=following_id
+        )
+        mark_changed(
+            session, get_user_counter(user_id), get_user_counter(following_id)
+        )
+        publish_event(
+            session, EVENT_UNFOLLOW, user_id=user_id, following_id=following_id
+        )
 
-            # Удаляем подписку у пользователя
-            user.following.remove(following)
-            await session.commit()
+    return unfollow.target_exists
 
 
 # Нужен только для заполнения тестовыми данными (в конечной версии будет удалён)
 async def testing():
     async with async_session() as session:
         async with session.begin():
-            users_query = select(Users)
+            # Достаточно проверить, что есть хотя бы один пользователь
+            users_query = select(Users.id).limit(1)
             users_result: ChunkedIteratorResult = await session.execute(
                 users_query
             )
-            users: Users = users_result.scalars().all()
 
-            if len(users) == 0:
+            if users_result.first() is None:
                 user1 = Users(user="Test", api_key="test")
                 user2 = Users(user="Josh", api_key="fd2f8f56-a060-4bba")
                 user3 = Users(user="Ricardo", api_key="3c0da680-3c2d-4511")
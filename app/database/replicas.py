@@ -0,0 +1,361 @@
+"""
+Чтение из реплик БД.
+Реплики задаются переменной окружения DB_REPLICA_HOSTS (для тестов -
+TEST_DB_REPLICA_HOSTS): список host:port через запятую, пользователь,
+пароль и имя БД те же, что у основной БД.
+
+Сессия запросов GET читает из реплики (по кругу среди исправных),
+остальные запросы работают с основной БД. Реплика считается исправной,
+если к ней есть соединение и её отставание не больше DB_REPLICA_MAX_LAG.
+
+Чтение своих записей: после запроса с изменениями пользователь
+READ_YOUR_WRITES_WINDOW секунд читает из основной БД. Отметки хранятся
+в общем кэше ответов (RESPONSE_CACHE=redis://), иначе - в памяти процесса.
+"""
+import asyncio
+import itertools
+import logging
+import math
+import os
+from typing import Any, AsyncGenerator, Dict, Iterator, List
+
+from fastapi import Request
+from prometheus_client import Counter, Gauge
+from sqlalchemy import text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from database.database import (
+    DATABASE_URL,
+    engine,
+    get_engine_options,
+    run_after_commit,
+    transaction,
+)
+from database.instrumentation import instrument_engine
+from database.response_cache import (
+    RESPONSE_CACHE_TTL,
+    CacheBackend,
+    LocalCacheBackend,
+    RespCacheBackend,
+    response_cache,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Максимальное отставание исправной реплики, в секундах
+DB_REPLICA_MAX_LAG: float = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+# Интервал проверки реплик, в секундах
+DB_REPLICA_HEALTH_INTERVAL: float = float(os.getenv("DB_REPLICA_HEALTH_INTERVAL", 5))
+# Время ожидания ответа реплики при проверке, в секундах
+DB_REPLICA_HEALTH_TIMEOUT: float = float(os.getenv("DB_REPLICA_HEALTH_TIMEOUT", 2))
+# Сколько секунд после записи пользователь читает из основной БД
+READ_YOUR_WRITES_WINDOW: int = math.ceil(
+    float(os.getenv("READ_YOUR_WRITES_WINDOW", 5))
+)
+
+# Ключи в session.info: пользователь запроса, чтение из основной БД, выбранная реплика
+USER_ID_KEY: str = "user_id"
+READ_PRIMARY_KEY: str = "read_primary"
+READ_REPLICA_KEY: str = "read_replica"
+
+# Отставание реплики: 0, если реплика проиграла всё полученное
+# (или сервер не в режиме восстановления), иначе - возраст последней транзакции
+REPLICA_LAG_QUERY: str = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery()
+        OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0
+    )
+END
+"""
+
+# Метрики реплик, отдаются через /metrics
+DB_REPLICA_HEALTHY: Gauge = Gauge(
+    "db_replica_healthy",
+    "Whether a read replica is used for reads",
+    ["replica"],
+    multiprocess_mode="livemin",
+)
+DB_REPLICA_LAG_SECONDS: Gauge = Gauge(
+    "db_replica_lag_seconds",
+    "Replication lag of a read replica",
+    ["replica"],
+    multiprocess_mode="livemax",
+)
+DB_READS_ROUTED: Counter = Counter(
+    "db_reads_routed",
+    "Number of read requests by database they were routed to",
+    ["target"],
+)
+
+
+def get_replica_urls() -> List[str]:
+    """
+    Функция получающая адреса реплик: основной адрес с хостом и портом реплики
+    :return: Адреса реплик
+    :rtype: List[str]
+    """
+    if os.environ.get("ENV") == "test":
+        replica_hosts: str = os.getenv("TEST_DB_REPLICA_HOSTS", "")
+    else:
+        replica_hosts: str = os.getenv("DB_REPLICA_HOSTS", "")
+
+    replica_urls: List[str] = list()
+    for i_host in filter(None, map(str.strip, replica_hosts.split(","))):
+        host, _, port = i_host.partition(":")
+        replica_url = make_url(DATABASE_URL).set(host=host, port=int(port or 5432))
+        replica_urls.append(replica_url.render_as_string(hide_password=False))
+
+    return replica_urls
+
+
+class ReplicaSet:
+    """Реплики для чтения: выбор по кругу среди исправных и проверка состояния"""
+
+    def __init__(self, urls: List[str]) -> None:
+        self.engines: List[AsyncEngine] = list()
+        for i_url in urls:
+            replica_engine: AsyncEngine = create_async_engine(
+                i_url, **get_engine_options()
+            )
+            instrument_engine(replica_engine)
+            self.engines.append(replica_engine)
+
+        # До первой проверки реплики считаются исправными
+        self.healthy: List[bool] = [True] * len(self.engines)
+        self._order: Iterator[int] = itertools.cycle(range(len(self.engines)))
+
+    def pick(self) -> AsyncEngine | None:
+        """
+        Функция выбирающая следующую исправную реплику
+        :return: Движок реплики или None, если исправных нет
+        :rtype: AsyncEngine | None
+        """
+        for _ in range(len(self.engines)):
+            index: int = next(self._order)
+            if self.healthy[index]:
+                return self.engines[index]
+
+        return None
+
+    async def _get_lag(self, replica_engine: AsyncEngine) -> float:
+        """Корутин возвращающий отставание реплики, в секундах"""
+        async with replica_engine.connect() as connection:
+            return float(await connection.scalar(text(REPLICA_LAG_QUERY)))
+
+    async def check(self) -> None:
+        """
+        Корутин проверяющий все реплики одновременно
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        lags: List[float | BaseException] = await asyncio.gather(
+            *(
+                asyncio.wait_for(self._get_lag(i_engine), DB_REPLICA_HEALTH_TIMEOUT)
+                for i_engine in self.engines
+            ),
+            return_exceptions=True,
+        )
+
+        for i_index, i_lag in enumerate(lags):
+            replica: str = self.engines[i_index].url.render_as_string()
+
+            if isinstance(i_lag, BaseException):
+                healthy: bool = False
+                logger.warning("replica %s is unavailable: %r", replica, i_lag)
+            else:
+                healthy = i_lag <= DB_REPLICA_MAX_LAG
+                DB_REPLICA_LAG_SECONDS.labels(replica).set(i_lag)
+                if not healthy:
+                    logger.warning("replica %s lags by %.1fs", replica, i_lag)
+
+            self.healthy[i_index] = healthy
+            DB_REPLICA_HEALTHY.labels(replica).set(int(healthy))
+
+    async def run_health_checks(self) -> None:
+        """Корутин, проверяющий реплики каждые DB_REPLICA_HEALTH_INTERVAL секунд"""
+        while True:
+            await asyncio.sleep(DB_REPLICA_HEALTH_INTERVAL)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("replica health check failed")
+
+    async def close(self) -> None:
+        """Корутин закрывающий соединения с репликами"""
+        for i_engine in self.engines:
+            await i_engine.dispose()
+
+
+class ReadYourWrites:
+    """Отметки пользователей, которые недавно изменяли данные"""
+
+    def __init__(self, backend: CacheBackend, window: int) -> None:
+        self.backend: CacheBackend = backend
+        self.window: int = window
+
+    async def pin(self, user_id: int) -> None:
+        """
+        Корутин отмечающий, что пользователь изменил данные
+        :param user_id: id пользователя
+        :type user_id: int
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        try:
+            await self.backend.set("rw:{}".format(user_id), b"1", self.window)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            logger.warning("failed to pin user %s to primary", user_id, exc_info=True)
+
+    async def is_pinned(self, user_id: int) -> bool:
+        """
+        Корутин проверяющий, должен ли пользователь читать из основной БД
+        :param user_id: id пользователя
+        :type user_id: int
+        :return: True, если пользователь недавно изменял данные
+            (или отметку не удалось проверить)
+        :rtype: bool
+        """
+        try:
+            pinned: List[bytes | None] = await self.backend.get_many(
+                ["rw:{}".format(user_id)]
+            )
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            return True
+
+        return pinned[0] is not None
+
+
+class RoutingSession(Session):
+    """
+    Сессия чтения: запросы идут в выбранную реплику, а если пользователь
+    недавно изменял данные или исправных реплик нет - в основную БД
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs) -> Engine:
+        if self.info.get(READ_PRIMARY_KEY):
+            return engine.sync_engine
+
+        return get_read_replica(self).sync_engine
+
+
+def get_read_replica(session: Session) -> AsyncEngine:
+    """
+    Функция возвращающая движок чтения сессии, выбирается один раз на сессию
+    :param session: Сессия чтения
+    :type session: Session
+    :return: Движок реплики или основной БД
+    :rtype: AsyncEngine
+    """
+    replica_engine: AsyncEngine | None = session.info.get(READ_REPLICA_KEY)
+
+    if replica_engine is None:
+        replica_engine = replica_set.pick()
+        DB_READS_ROUTED.labels("replica" if replica_engine else "primary").inc()
+        replica_engine = session.info[READ_REPLICA_KEY] = replica_engine or engine
+
+    return replica_engine
+
+
+async def route_user_reads(session: AsyncSession, user_id: int) -> None:
+    """
+    Корутин запоминающий пользователя запроса в сессии: после записи
+    он будет отмечен, а в сессии чтения его запросы пойдут в основную БД,
+    если он недавно изменял данные
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :param user_id: id пользователя
+    :type user_id: int
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    session.info[USER_ID_KEY] = user_id
+
+    if not isinstance(session.sync_session, RoutingSession):
+        return
+
+    if await read_your_writes.is_pinned(user_id):
+        DB_READS_ROUTED.labels("pinned").inc()
+        session.info[READ_PRIMARY_KEY] = True
+    else:
+        get_read_replica(session.sync_session)
+
+
+def get_cache_options(session: AsyncSession) -> Dict[str, Any]:
+    """
+    Функция возвращающая параметры кэша ответов для сессии запроса.
+    Ответ из реплики может отставать, поэтому живёт не дольше допустимого
+    отставания, а пользователь после записи обновляет ответ из основной БД
+    :param session: Сессия запроса
+    :type session: AsyncSession
+    :return: Аргументы для response_cache.get_or_load
+    :rtype: Dict[str, Any]
+    """
+    if not isinstance(session.sync_session, RoutingSession):
+        return dict()
+
+    if session.info.get(READ_PRIMARY_KEY):
+        return {"refresh": True}
+
+    return {"ttl": min(RESPONSE_CACHE_TTL, math.ceil(DB_REPLICA_MAX_LAG))}
+
+
+async def get_request_session(
+    request: Request,
+) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Зависимость FastAPI: одна сессия и одна транзакция на запрос.
+    Транзакция сохраняется после обработчика, при ошибке - откатывается.
+    Запросы GET при настроенных репликах читают из реплики, после
+    остальных запросов пользователь отмечается для чтения своих записей
+    :param request: Запрос
+    :type request: Request
+    :return: Сессия запроса
+    :rtype: AsyncGenerator[AsyncSession, None]
+    """
+    if not replica_set.engines:
+        async with transaction() as request_session:
+            yield request_session
+        return
+
+    if request.method in ("GET", "HEAD"):
+        async with transaction(read_session) as request_session:
+            yield request_session
+        return
+
+    async with transaction() as request_session:
+        yield request_session
+
+        user_id: int | None = request_session.info.get(USER_ID_KEY)
+        if user_id is not None:
+            run_after_commit(request_session, lambda: read_your_writes.pin(user_id))
+
+
+def get_pins_backend() -> CacheBackend:
+    """
+    Функция выбирающая хранилище отметок: общий кэш ответов,
+    если он общий для воркеров, иначе - память процесса
+    :return: Хранилище отметок
+    :rtype: CacheBackend
+    """
+    if isinstance(response_cache.backend, RespCacheBackend):
+        return response_cache.backend
+
+    return LocalCacheBackend()
+
+
+# Реплики приложения и отметки чтения своих записей
+replica_set: ReplicaSet = ReplicaSet(get_replica_urls())
+read_your_writes: ReadYourWrites = ReadYourWrites(
+    get_pins_backend(), READ_YOUR_WRITES_WINDOW
+)
+# Сессии запросов GET
+read_session: sessionmaker = sessionmaker(
+    engine,
+    expire_on_commit=False,
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
+)
@@ -0,0 +1,450 @@
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+from urllib.parse import urlparse
+
+import orjson
+from prometheus_client import Counter
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Бэкенд кэша ответов: off - выключен, local - в памяти процесса
+# (только для одного воркера), redis://host:port - общий для всех воркеров
+RESPONSE_CACHE: str = os.getenv("RESPONSE_CACHE", "off")
+# Время жизни записи в секундах (страховка, записи сбрасываются при изменениях)
+RESPONSE_CACHE_TTL: int = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+# Максимальное количество записей в бэкенде local
+RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", 10000))
+# Время ожидания ответа сетевого бэкенда в секундах
+RESPONSE_CACHE_TIMEOUT: float = float(os.getenv("RESPONSE_CACHE_TIMEOUT", 0.1))
+# Количество соединений с сетевым бэкендом
+RESPONSE_CACHE_CONNECTIONS: int = int(os.getenv("RESPONSE_CACHE_CONNECTIONS", 8))
+
+# Метрики кэша по видам ответов
+RESPONSE_CACHE_HITS: Counter = Counter(
+    "response_cache_hits", "Number of responses served from the cache", ["name"]
+)
+RESPONSE_CACHE_MISSES: Counter = Counter(
+    "response_cache_misses", "Number of responses loaded from the database", ["name"]
+)
+RESPONSE_CACHE_ERRORS: Counter = Counter(
+    "response_cache_errors", "Number of failed cache backend calls"
+)
+
+
+class CacheBackend(ABC):
+    """Хранилище кэша: байтовые значения по строковым ключам"""
+
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> List[bytes | None]:
+        """Возвращает значения ключей (None, если ключа нет)"""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        """Записывает значение на ttl секунд"""
+
+    @abstractmethod
+    async def set_if_absent(self, key: str, value: bytes) -> None:
+        """Записывает значение без срока жизни, если ключа ещё нет"""
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """Увеличивает числовое значение ключа на 1"""
+
+    async def close(self) -> None:
+        """Закрывает соединения"""
+
+
+class LocalCacheBackend(CacheBackend):
+    """LRU-кэш в памяти процесса, записи с ограниченным временем жизни"""
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE) -> None:
+        self.maxsize: int = maxsize
+        # ключ -> (время истечения записи или None, значение)
+        self._entries: OrderedDict[str, Tuple[float | None, bytes]] = OrderedDict()
+
+    def _get(self, key: str) -> bytes | None:
+        entry: Tuple[float | None, bytes] | None = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        # Устаревшую запись удаляем
+        if entry[0] is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+
+        return entry[1]
+
+    def _set(self, key: str, value: bytes, ttl: int | None) -> None:
+        expires: float | None = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+
+        # Вытесняем давно не использованные записи
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get_many(self, keys: List[str]) -> List[bytes | None]:
+        return [self._get(i_key) for i_key in keys]
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        self._set(key, value, ttl)
+
+    async def set_if_absent(self, key: str, value: bytes) -> None:
+        if self._get(key) is None:
+            self._set(key, value, None)
+
+    async def incr(self, key: str) -> int:
+        return self.incr_sync(key)
+
+    def incr_sync(self, key: str) -> int:
+        value: int = int(self._get(key) or 0) + 1
+        self._set(key, str(value).encode(), None)
+
+        return value
+
+    def delete(self, key: str) -> int:
+        return 1 if self._entries.pop(key, None) is not None else 0
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+def encode_command(*args: Any) -> bytes:
+    """
+    Функция кодирующая команду в протокол RESP (массив строк)
+    :param args: Команда и аргументы
+    :return: Команда в протоколе RESP
+    :rtype: bytes
+    """
+    parts: List[bytes] = [b"*%d\r\n" % len(args)]
+    for i_arg in args:
+        if not isinstance(i_arg, bytes):
+            i_arg = str(i_arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(i_arg), i_arg))
+
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """
+    Корутин читающий ответ в протоколе RESP
+    :param reader: Поток чтения соединения
+    :type reader: asyncio.StreamReader
+    :return: Строка, число, байты, None или список
+    :raises ConnectionError: Если соединение закрыто или сервер вернул ошибку
+    """
+    line: bytes = await reader.readline()
+
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed")
+
+    prefix, payload = line[:1], line[1:-2]
+
+    if prefix == b"+":
+        return payload.decode()
+    if prefix == b"-":
+        raise ConnectionError(payload.decode())
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length: int = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b"*":
+        return [await read_reply(reader) for _ in range(int(payload))]
+
+    raise ConnectionError("unexpected reply: {!r}".format(line))
+
+
+class RespCacheBackend(CacheBackend):
+    """
+    Сетевой бэкенд по протоколу RESP (Redis и совместимые сервера),
+    общий для всех воркеров
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        connections: int = RESPONSE_CACHE_CONNECTIONS,
+        timeout: float = RESPONSE_CACHE_TIMEOUT,
+    ) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.timeout: float = timeout
+        # Свободные соединения и ограничение их общего количества
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(connections)
+
+    async def _execute(self, *args: Any) -> Any:
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout
+                )
+
+            try:
+                writer.write(encode_command(*args))
+                reply: Any = await asyncio.wait_for(
+                    read_reply(reader), self.timeout
+                )
+            except BaseException:
+                # Состояние соединения неизвестно, закрываем его
+                writer.close()
+                raise
+
+            self._idle.append((reader, writer))
+
+            return reply
+
+    async def get_many(self, keys: List[str]) -> List[bytes | None]:
+        return await self._execute("MGET", *keys)
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        await self._execute("SET", key, value, "EX", ttl)
+
+    async def set_if_absent(self, key: str, value: bytes) -> None:
+        await self._execute("SET", key, value, "NX")
+
+    async def incr(self, key: str) -> int:
+        return await self._execute("INCR", key)
+
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class LocalRespServer:
+    """
+    Сервер RESP поверх LocalCacheBackend, заменяет Redis в тестах и при разработке.
+    Поддерживает команды PING, GET, MGET, SET (EX, NX), INCR, DEL и FLUSHALL
+    """
+
+    def __init__(self) -> None:
+        self.backend: LocalCacheBackend = LocalCacheBackend()
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Метод запускающий сервер
+        :param host: Адрес
+        :type host: str
+        :param port: Порт (0 - любой свободный)
+        :type port: int
+        :return: Порт сервера
+        :rtype: int
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """Метод останавливающий сервер"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _reply(self, command: List[bytes]) -> bytes:
+        name: str = command[0].decode().upper()
+        args: List[str] = [i_arg.decode() for i_arg in command[1:]]
+
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name == "GET":
+            return encode_value(self.backend._get(args[0]))
+        if name == "MGET":
+            return b"*%d\r\n" % len(args) + b"".join(
+                encode_value(self.backend._get(i_key)) for i_key in args
+            )
+        if name == "SET":
+            options: List[str] = [i_option.upper() for i_option in args[2:]]
+            if "NX" in options and self.backend._get(args[0]) is not None:
+                return b"$-1\r\n"
+            ttl: int | None = (
+                int(args[2 + options.index("EX") + 1]) if "EX" in options else None
+            )
+            self.backend._set(args[0], command[2], ttl)
+            return b"+OK\r\n"
+        if name == "INCR":
+            return b":%d\r\n" % self.backend.incr_sync(args[0])
+        if name == "DEL":
+            return b":%d\r\n" % sum(self.backend.delete(i_key) for i_key in args)
+        if name == "FLUSHALL":
+            self.backend.clear()
+            return b"+OK\r\n"
+
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                command: Any = await read_reply(reader)
+                writer.write(self._reply(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def encode_value(value: bytes | None) -> bytes:
+    """Функция кодирующая строку (или её отсутствие) в протокол RESP"""
+    if value is None:
+        return b"$-1\r\n"
+
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class ResponseCache:
+    """
+    Кэш готовых ответов с инвалидацией по тегам.
+    У каждого тега (например, "tweets" или "user:1") есть поколение,
+    поколения тегов входят в ключ записи. Изменение данных увеличивает
+    поколение тега, и старые записи больше не находятся (и истекают по TTL)
+    """
+
+    def __init__(
+        self, backend: CacheBackend | None, ttl: int = RESPONSE_CACHE_TTL
+    ) -> None:
+        self.backend: CacheBackend | None = backend
+        self.ttl: int = ttl
+
+    async def _get_generations(self, tags: List[str]) -> List[bytes]:
+        tag_keys: List[str] = ["gen:{}".format(i_tag) for i_tag in tags]
+        generations: List[bytes | None] = await self.backend.get_many(tag_keys)
+
+        # Поколение, которого ещё нет (или вытесненное), начинается с текущего
+        # времени в микросекундах, чтобы не совпасть с уже использованными
+        for i_index, i_generation in enumerate(generations):
+            if i_generation is None:
+                await self.backend.set_if_absent(
+                    tag_keys[i_index], str(time.time_ns() // 1000).encode()
+                )
+        if None in generations:
+            generations = await self.backend.get_many(tag_keys)
+
+        return generations
+
+    async def get_or_load(
+        self,
+        name: str,
+        tags: List[str],
+        key_parts: Iterable[Any],
+        loader: Callable[[], Awaitable[Any]],
+        refresh: bool = False,
+        ttl: int | None = None,
+    ) -> Any:
+        """
+        Метод возвращающий ответ из кэша, а при промахе - из loader
+        :param name: Вид ответа (для ключа и метрик)
+        :type name: str
+        :param tags: Теги, при изменении которых ответ устаревает
+        :type tags: List[str]
+        :param key_parts: Параметры ответа
+        :type key_parts: Iterable[Any]
+        :param loader: Корутин-функция, собирающая ответ из БД
+        :type loader: Callable[[], Awaitable[Any]]
+        :param refresh: Не читать ответ из кэша, а собрать и записать заново
+        :type refresh: bool
+        :param ttl: Время жизни записи, если оно меньше обычного, в секундах
+        :type ttl: int | None
+        :return: Ответ (None из loader не кэшируется)
+        """
+        if self.backend is None:
+            return await loader()
+
+        try:
+            # Поколения читаются до БД: если данные изменятся во время загрузки,
+            # ответ запишется под старыми поколениями и не будет найден
+            generations: List[bytes] = await self._get_generations(tags)
+            key: str = ":".join(
+                [name, *map(str, key_parts), *(i.decode() for i in generations)]
+            )
+            cached: bytes | None = (
+                None if refresh else (await self.backend.get_many([key]))[0]
+            )
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            RESPONSE_CACHE_ERRORS.inc()
+            logger.warning("response cache is unavailable", exc_info=True)
+
+            return await loader()
+
+        if cached is not None:
+            RESPONSE_CACHE_HITS.labels(name=name).inc()
+            return orjson.loads(cached)
+
+        RESPONSE_CACHE_MISSES.labels(name=name).inc()
+        value: Any = await loader()
+
+        # Отсутствие данных (например, пользователь не найден) не кэшируем
+        if value is None:
+            return value
+
+        try:
+            await self.backend.set(key, orjson.dumps(value), ttl or self.ttl)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            RESPONSE_CACHE_ERRORS.inc()
+            logger.warning("response cache is unavailable", exc_info=True)
+
+        return value
+
+    async def invalidate(self, tags: Iterable[str]) -> None:
+        """
+        Метод сбрасывающий ответы с тегами (вызывается после commit)
+        :param tags: Изменённые теги
+        :type tags: Iterable[str]
+        :return: Ничего не возвращает
+        :rtype: None
+        """
+        if self.backend is None:
+            return
+
+        for i_tag in sorted(set(tags)):
+            try:
+                await self.backend.incr("gen:{}".format(i_tag))
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                # Записи тега устареют по TTL
+                RESPONSE_CACHE_ERRORS.inc()
+                logger.warning("failed to invalidate %s", i_tag, exc_info=True)
+
+    async def close(self) -> None:
+        """Метод закрывающий соединения бэкенда"""
+        if self.backend is not None:
+            await self.backend.close()
+
+
+def get_cache_backend(url: str = RESPONSE_CACHE) -> CacheBackend | None:
+    """
+    Функция создающая бэкенд кэша ответов по настройке RESPONSE_CACHE
+    :param url: off, local или redis://host:port
+    :type url: str
+    :return: Бэкенд или None, если кэш выключен
+    :rtype: CacheBackend | None
+    """
+    if url == "off":
+        return None
+
+    if url == "local":
+        return LocalCacheBackend()
+
+    parsed_url = urlparse(url)
+
+    return RespCacheBackend(parsed_url.hostname, parsed_url.port or 6379)
+
+
+# Кэш ответов приложения
+response_cache: ResponseCache = ResponseCache(get_cache_backend())
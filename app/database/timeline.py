@@ -0,0 +1,388 @@
+import asyncio
+import bisect
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Integer, cast, delete, func, literal, union_all
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine.cursor import CursorResult
+from sqlalchemy.engine.result import ChunkedIteratorResult
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.selectable import CTE, CompoundSelect, Select, Subquery
+
+from database.database import (
+    Timeline,
+    integration_followers,
+    run_after_commit,
+    transaction,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Максимальное количество твитов, хранимых в ленте одного пользователя
+# (в хранилище postgres лишние твиты удаляет фоновая задача)
+TIMELINE_INBOX_SIZE: int = int(os.getenv("TIMELINE_INBOX_SIZE", 1000))
+# Интервал обрезки лент в таблице timeline, в секундах (0 - отключено)
+TIMELINE_PRUNE_INTERVAL: float = float(os.getenv("TIMELINE_PRUNE_INTERVAL", 300))
+# Количество пользователей, ленты которых обрезаются в одной транзакции
+TIMELINE_PRUNE_BATCH_SIZE: int = int(os.getenv("TIMELINE_PRUNE_BATCH_SIZE", 500))
+
+
+class TimelineStore(ABC):
+    """
+    Хранилище предрассчитанных лент пользователей.
+    Лента - это отсортированный список id твитов, разосланных пользователю при записи.
+    Все методы принимают сессию, чтобы изменения ленты попадали в ту же транзакцию,
+    что и изменение твитов или подписок
+    """
+
+    @abstractmethod
+    async def push(
+        self,
+        session: AsyncSession,
+        user_ids: List[int],
+        tweet_id: int,
+        author_id: int,
+    ) -> None:
+        """Добавляет твит в ленты пользователей"""
+
+    @abstractmethod
+    async def push_to_followers(
+        self, session: AsyncSession, tweet_id: int, author_id: int
+    ) -> None:
+        """Добавляет твит в ленты автора и всех его подписчиков"""
+
+    @abstractmethod
+    async def backfill(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        tweet_ids: List[int],
+        author_id: int,
+    ) -> None:
+        """Добавляет твиты автора в ленту пользователя (при подписке)"""
+
+    @abstractmethod
+    async def retract_tweet(self, session: AsyncSession, tweet_id: int) -> None:
+        """Удаляет твит из всех лент"""
+
+    @abstractmethod
+    async def retract_author(
+        self, session: AsyncSession, user_id: int, author_id: int
+    ) -> None:
+        """Удаляет из ленты пользователя все твиты автора"""
+
+    @abstractmethod
+    async def get_page(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        cursor: int | None,
+        limit: int,
+    ) -> List[int]:
+        """
+        Возвращает страницу id твитов из ленты пользователя, новые первыми.
+        Страница берётся только из последних TIMELINE_INBOX_SIZE твитов ленты,
+        неполная страница - лента закончилась, дальше читаются твиты авторов
+        """
+
+    @abstractmethod
+    async def prune(self, session: AsyncSession) -> int:
+        """
+        Обрезает ленты до TIMELINE_INBOX_SIZE твитов,
+        возвращает количество обработанных лент
+        """
+
+
+class InMemoryTimelineStore(TimelineStore):
+    """
+    Хранилище лент в памяти процесса (один воркер, для отладки).
+    Изменения применяются после commit транзакции сессии,
+    при откате транзакции ленты не меняются
+    """
+
+    def __init__(self, inbox_size: int = TIMELINE_INBOX_SIZE) -> None:
+        self.inbox_size: int = inbox_size
+        # Ленты пользователей: отсортированные по возрастанию пары (tweet_id, author_id)
+        self.inboxes: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+
+    async def push(
+        self,
+        session: AsyncSession,
+        user_ids: List[int],
+        tweet_id: int,
+        author_id: int,
+    ) -> None:
+        run_after_commit(
+            session, lambda: self._push(list(user_ids), tweet_id, author_id)
+        )
+
+    def _push(self, user_ids: List[int], tweet_id: int, author_id: int) -> None:
+        for i_user_id in user_ids:
+            inbox: List[Tuple[int, int]] = self.inboxes[i_user_id]
+            index: int = bisect.bisect_left(inbox, (tweet_id, author_id))
+
+            # Твит уже есть в ленте
+            if index < len(inbox) and inbox[index][0] == tweet_id:
+                continue
+
+            inbox.insert(index, (tweet_id, author_id))
+
+            # Обрезаем самые старые твиты, чтобы лента оставалась ограниченной
+            if len(inbox) > self.inbox_size:
+                del inbox[: len(inbox) - self.inbox_size]
+
+    async def push_to_followers(
+        self, session: AsyncSession, tweet_id: int, author_id: int
+    ) -> None:
+        followers_result: ChunkedIteratorResult = await session.execute(
+            select(integration_followers.c.user_id).where(
+                integration_followers.c.following_id == author_id
+            )
+        )
+        await self.push(
+            session,
+            [author_id, *followers_result.scalars().all()],
+            tweet_id,
+            author_id,
+        )
+
+    async def backfill(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        tweet_ids: List[int],
+        author_id: int,
+    ) -> None:
+        for i_tweet_id in tweet_ids:
+            await self.push(session, [user_id], i_tweet_id, author_id)
+
+    async def retract_tweet(self, session: AsyncSession, tweet_id: int) -> None:
+        run_after_commit(session, lambda: self._retract_tweet(tweet_id))
+
+    def _retract_tweet(self, tweet_id: int) -> None:
+        for i_user_id, i_inbox in self.inboxes.items():
+            self.inboxes[i_user_id] = [
+                entry for entry in i_inbox if entry[0] != tweet_id
+            ]
+
+    async def retract_author(
+        self, session: AsyncSession, user_id: int, author_id: int
+    ) -> None:
+        run_after_commit(session, lambda: self._retract_author(user_id, author_id))
+
+    def _retract_author(self, user_id: int, author_id: int) -> None:
+        self.inboxes[user_id] = [
+            entry for entry in self.inboxes[user_id] if entry[1] != author_id
+        ]
+
+    async def get_page(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        cursor: int | None,
+        limit: int,
+    ) -> List[int]:
+        inbox: List[Tuple[int, int]] = self.inboxes.get(user_id, [])
+        # Граница среза: все твиты с id меньше курсора
+        end: int = (
+            bisect.bisect_left(inbox, (cursor,)) if cursor is not None else len(inbox)
+        )
+
+        return [entry[0] for entry in reversed(inbox[max(end - limit, 0):end])]
+
+    async def prune(self, session: AsyncSession) -> int:
+        # Ленты обрезаются при добавлении твитов
+        return 0
+
+
+class PostgresTimelineStore(TimelineStore):
+    """Хранилище лент в таблице timeline"""
+
+    async def push(
+        self,
+        session: AsyncSession,
+        user_ids: List[int],
+        tweet_id: int,
+        author_id: int,
+    ) -> None:
+        if not user_ids:
+            return
+
+        await session.execute(
+            insert(Timeline)
+            .values(
+                [
+                    {"user_id": i_user_id, "tweet_id": tweet_id, "author_id": author_id}
+                    for i_user_id in user_ids
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+
+    async def push_to_followers(
+        self, session: AsyncSession, tweet_id: int, author_id: int
+    ) -> None:
+        # Один запрос INSERT ... SELECT: подписчики не загружаются в приложение,
+        # количество параметров запроса не зависит от количества подписчиков
+        # Типы параметров указываются явно: в UNION их не выводит Postgres
+        tweet_id_column = cast(literal(tweet_id), Integer)
+        author_id_column = cast(literal(author_id), Integer)
+        recipients: CompoundSelect = union_all(
+            select(author_id_column, tweet_id_column, author_id_column),
+            select(
+                integration_followers.c.user_id, tweet_id_column, author_id_column
+            ).where(integration_followers.c.following_id == author_id),
+        )
+        await session.execute(
+            insert(Timeline)
+            .from_select(["user_id", "tweet_id", "author_id"], recipients)
+            .on_conflict_do_nothing()
+        )
+
+    async def backfill(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        tweet_ids: List[int],
+        author_id: int,
+    ) -> None:
+        if not tweet_ids:
+            return
+
+        await session.execute(
+            insert(Timeline)
+            .values(
+                [
+                    {"user_id": user_id, "tweet_id": i_tweet_id, "author_id": author_id}
+                    for i_tweet_id in tweet_ids
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+
+    async def retract_tweet(self, session: AsyncSession, tweet_id: int) -> None:
+        await session.execute(delete(Timeline).where(Timeline.tweet_id == tweet_id))
+
+    async def retract_author(
+        self, session: AsyncSession, user_id: int, author_id: int
+    ) -> None:
+        await session.execute(
+            delete(Timeline).where(
+                Timeline.user_id == user_id, Timeline.author_id == author_id
+            )
+        )
+
+    async def get_page(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        cursor: int | None,
+        limit: int,
+    ) -> List[int]:
+        # Только последние TIMELINE_INBOX_SIZE твитов ленты: ниже них лента
+        # неполная до обрезки (срез по первичному ключу (user_id, tweet_id))
+        inbox: Subquery = (
+            select(Timeline.tweet_id)
+            .where(Timeline.user_id == user_id)
+            .order_by(Timeline.tweet_id.desc())
+            .limit(TIMELINE_INBOX_SIZE)
+            .subquery("inbox")
+        )
+        page_query: Select = select(inbox.c.tweet_id)
+        if cursor is not None:
+            page_query = page_query.where(inbox.c.tweet_id < cursor)
+        page_query = page_query.order_by(inbox.c.tweet_id.desc()).limit(limit)
+
+        page_result: ChunkedIteratorResult = await session.execute(page_query)
+
+        return list(page_result.scalars().all())
+
+    async def prune(self, session: AsyncSession) -> int:
+        # Ленты длиннее TIMELINE_INBOX_SIZE (пачкой)
+        overflowing: CTE = (
+            select(Timeline.user_id)
+            .group_by(Timeline.user_id)
+            .having(func.count() > TIMELINE_INBOX_SIZE)
+            .limit(TIMELINE_PRUNE_BATCH_SIZE)
+            .cte("overflowing")
+        )
+        # Самый новый из лишних твитов каждой ленты (по первичному ключу)
+        boundary_tweet = aliased(Timeline)
+        boundaries: CTE = select(
+            overflowing.c.user_id,
+            select(boundary_tweet.tweet_id)
+            .where(boundary_tweet.user_id == overflowing.c.user_id)
+            .order_by(boundary_tweet.tweet_id.desc())
+            .offset(TIMELINE_INBOX_SIZE)
+            .limit(1)
+            .scalar_subquery()
+            .label("tweet_id"),
+        ).cte("boundaries")
+
+        prune_result: CursorResult = await session.execute(
+            delete(Timeline)
+            .where(
+                Timeline.user_id == boundaries.c.user_id,
+                Timeline.tweet_id <= boundaries.c.tweet_id,
+            )
+            .returning(Timeline.user_id)
+        )
+
+        return len(set(prune_result.scalars().all()))
+
+
+def get_timeline_store() -> TimelineStore:
+    """
+    Функция создающая хранилище лент, выбранное в переменной окружения TIMELINE_STORE
+    :return: Хранилище лент
+    :rtype: TimelineStore
+    """
+    if os.getenv("TIMELINE_STORE", "postgres") == "memory":
+        return InMemoryTimelineStore()
+
+    return PostgresTimelineStore()
+
+
+# Хранилище лент приложения
+timeline_store: TimelineStore = get_timeline_store()
+
+
+async def prune_timelines() -> int:
+    """
+    Корутин обрезающий все ленты до TIMELINE_INBOX_SIZE твитов,
+    пачками по TIMELINE_PRUNE_BATCH_SIZE лент, каждая пачка в своей транзакции
+    :return: Количество обрезанных лент
+    :rtype: int
+    """
+    pruned: int = 0
+
+    while True:
+        async with transaction() as prune_session:
+            batch: int = await timeline_store.prune(prune_session)
+
+        pruned += batch
+
+        if batch < TIMELINE_PRUNE_BATCH_SIZE:
+            return pruned
+
+
+async def run_timeline_pruner() -> None:
+    """
+    Корутин периодически выполняющий prune_timelines (фоновая задача)
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(TIMELINE_PRUNE_INTERVAL)
+
+        try:
+            await prune_timelines()
+        except Exception:
+            # Повторим через интервал, ленты при этом работают
+            logger.exception("timeline pruning failed")
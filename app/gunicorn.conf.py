@@ -0,0 +1,95 @@
+"""
+Настройки gunicorn: приложение в нескольких процессах uvicorn.
+gunicorn читает этот файл сам при запуске из папки app:
+    gunicorn main:app
+
+Приложение загружается один раз в главном процессе (preload_app),
+воркеры получают его при fork. Воркеры перезапускаются без потери
+запросов: по сигналу HUP, после APP_MAX_REQUESTS запросов
+и при зависании дольше APP_WORKER_TIMEOUT.
+
+Метрики Prometheus воркеров собираются через файлы в PROMETHEUS_MULTIPROC_DIR,
+переменная задаётся до загрузки приложения (prometheus_client читает её
+при импорте), /metrics отдаёт сумму по всем воркерам.
+
+При нескольких воркерах хранилища в памяти процесса (события, кэш ответов,
+ленты) у каждого воркера свои, поэтому с ними gunicorn не запускается.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+from typing import List
+
+from dotenv import load_dotenv
+
+# Настройки читаются до загрузки приложения, поэтому .env загружаем здесь
+load_dotenv()
+
+# Папка для метрик воркеров, очищается при запуске
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus")
+)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+bind: str = "0.0.0.0:{}".format(os.getenv("APP_PORT", 8000))
+# Количество воркеров (по умолчанию - по числу ядер)
+workers: int = int(os.getenv("APP_WORKERS", multiprocessing.cpu_count()))
+worker_class: str = "uvicorn.workers.UvicornWorker"
+preload_app: bool = True
+# Время без ответа воркера, после которого он перезапускается, в секундах
+timeout: int = int(os.getenv("APP_WORKER_TIMEOUT", 60))
+# Время на завершение текущих запросов при остановке и перезапуске, в секундах
+graceful_timeout: int = int(os.getenv("APP_GRACEFUL_TIMEOUT", 30))
+# Перезапуск воркера после указанного количества запросов (0 - отключено),
+# разброс, чтобы воркеры не перезапускались одновременно
+max_requests: int = int(os.getenv("APP_MAX_REQUESTS", 0))
+max_requests_jitter: int = int(os.getenv("APP_MAX_REQUESTS_JITTER", 0))
+accesslog: str = "-"
+
+
+def check_shared_backends() -> None:
+    """
+    Функция проверяющая, что при нескольких воркерах не выбраны хранилища
+    в памяти процесса: события и сбросы кэша одного воркера не видны другим
+    :raises RuntimeError: Если выбрано хранилище в памяти процесса
+    """
+    if workers <= 1:
+        return
+
+    in_process: List[str] = [
+        "{}={}".format(i_name, i_value)
+        for i_name, i_value, i_in_process in (
+            ("EVENTS_BROKER", os.getenv("EVENTS_BROKER", "memory"), "memory"),
+            ("RESPONSE_CACHE", os.getenv("RESPONSE_CACHE", "off"), "local"),
+            ("TIMELINE_STORE", os.getenv("TIMELINE_STORE", "postgres"), "memory"),
+        )
+        if i_value == i_in_process
+    ]
+
+    if in_process:
+        raise RuntimeError(
+            "{} keep state inside one process and cannot be used with "
+            "APP_WORKERS={}: set EVENTS_BROKER=postgres, "
+            "RESPONSE_CACHE=redis://... or off, TIMELINE_STORE=postgres, "
+            "or run a single worker".format(", ".join(in_process), workers)
+        )
+
+
+def on_starting(server) -> None:
+    """
+    Проверяет настройки хранилищ и удаляет файлы метрик предыдущего запуска
+    """
+    check_shared_backends()
+
+    for i_path in glob.glob(
+        os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")
+    ):
+        os.remove(i_path)
+
+
+def child_exit(server, worker) -> None:
+    """Убирает из метрик живых воркеров (live*) завершившийся воркер"""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,18 +1,72 @@
+import asyncio
+import os
 from contextlib import asynccontextmanager
-from typing import Annotated, Dict, List
-
-from fastapi import FastAPI, Header, Request, UploadFile, status
-from fastapi.responses import JSONResponse
+from typing import Annotated, Awaitable, Callable, Dict, List, Tuple, Type, Union
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from prometheus_fastapi_instrumentator import Instrumentator
-
-from database.database import Base, Users, engine, session
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.auth_cache import UserIdentity
+from database.change_counters import (
+    TWEETS_COUNTERS,
+    get_counters,
+    get_user_counter,
+    is_not_modified,
+    make_etag,
+)
+from database.database import engine, release_connection, session
+from database.events import (
+    EVENTS_MAX_SUBSCRIBERS,
+    event_broker,
+    event_hub,
+    stream_events,
+)
+from database.images import shutdown_image_pool
+from database.instrumentation import (
+    REQUEST_QUERY_STATS,
+    QueryStats,
+    get_statement_fingerprint,
+    observe_request_stats,
+)
+from database.leader import run_as_leader, startup_lock
+from database.like_buffer import like_buffer
+from database.media_gc import MEDIA_GC_INTERVAL, run_media_gc
+from database.media_io import shutdown_media_io_pool
+from database.migrations import migrate
 from database.models import (
+    IMAGE_PROCESSING_TASKS,
+    MEDIA_MAX_UPLOAD_SIZE,
+    SEARCH_INDEX_CLEAN_INTERVAL,
+    TWEET_ID_MAX,
+    TWEETS_PAGE_SIZE,
+    TWEETS_PAGE_SIZE_MAX,
+    USERS_BATCH_SIZE_MAX,
+    FileTooLargeError,
+    UnsupportedMediaTypeError,
     delete_following,
     delete_likes_from_db,
     delete_tweet_from_db,
     get_all_tweets_from_db,
+    get_following_ids,
+    get_tweets_versions,
     get_user_from_api_key,
     get_user_from_id,
+    get_users_from_ids,
+    parse_search_cursor,
+    run_search_index_cleaner,
+    search_tweets_in_db,
     testing,
     update_image_tweet_id,
     write_following_to_db,
@@ -20,13 +74,20 @@ from database.models import (
     write_likes_to_db,
     write_post_to_db,
 )
+from database.replicas import get_cache_options, get_request_session, replica_set
+from database.response_cache import response_cache
+from database.timeline import TIMELINE_PRUNE_INTERVAL, run_timeline_pruner
 from shemas import (
     BaseMediaOut,
     BaseOperationResultOut,
+    BaseTweetsGetCompactOut,
     BaseTweetsGetOut,
     BaseTweetsPostIn,
     BaseTweetsPostOut,
+    BaseUserInfoCompactOut,
     BaseUserInfoOut,
+    BaseUsersCompactOut,
+    BaseUsersOut,
 )
 
 # Сообщение в случае ошибки авторизации (пользователь не найден)
@@ -37,22 +98,185 @@ ERROR_AUTHENTICATION: Dict = {
 }
 
 
+# Сообщение в случае, если твит не найден
+ERROR_TWEET_NOT_FOUND: Dict = {
+    "result": False,
+    "error_type": "NotFound",
+    "error_message": "Tweet not found",
+}
+
+# Сообщение в случае, если пользователь не найден
+ERROR_USER_NOT_FOUND: Dict = {
+    "result": False,
+    "error_type": "NotFound",
+    "error_message": "User not found",
+}
+
+
+# Сообщение в случае, если загружаемый файл слишком большой
+ERROR_FILE_TOO_LARGE: Dict = {
+    "result": False,
+    "error_type": "FileTooLarge",
+    "error_message": "File is larger than {} bytes".format(MEDIA_MAX_UPLOAD_SIZE),
+}
+
+# Сообщение в случае, если загружаемый файл не картинка
+ERROR_UNSUPPORTED_MEDIA_TYPE: Dict = {
+    "result": False,
+    "error_type": "UnsupportedMediaType",
+    "error_message": "Only jpeg, png, gif and webp images are supported",
+}
+
+# Сообщение в случае некорректного курсора страницы поиска
+ERROR_INVALID_CURSOR: Dict = {
+    "result": False,
+    "error_type": "InvalidCursor",
+    "error_message": "Cursor must be taken from the X-Next-Cursor header",
+}
+
+# Сообщение, если в запросе нескольких пользователей слишком много id
+ERROR_TOO_MANY_IDS: Dict = {
+    "result": False,
+    "error_type": "TooManyIds",
+    "error_message": "No more than {} ids per request".format(USERS_BATCH_SIZE_MAX),
+}
+
+# Максимальный id пользователя (колонка INTEGER)
+USER_ID_MAX: int = 2**31 - 1
+# Сообщение, если в запросе нескольких пользователей id вне диапазона INTEGER
+ERROR_INVALID_IDS: Dict = {
+    "result": False,
+    "error_type": "InvalidIds",
+    "error_message": "ids must not be greater than {}".format(USER_ID_MAX),
+}
+# Максимальная длина списка id: USERS_BATCH_SIZE_MAX id по 10 цифр через запятую
+USERS_IDS_MAX_LENGTH: int = USERS_BATCH_SIZE_MAX * 11 - 1
+
+# Сообщение, если в воркере открыто слишком много потоков событий
+ERROR_TOO_MANY_STREAMS: Dict = {
+    "result": False,
+    "error_type": "TooManyStreams",
+    "error_message": "Too many open event streams, retry later",
+}
+
+# Запас на заголовки multipart-формы при проверке Content-Length
+MULTIPART_OVERHEAD: int = 16 * 1024
+
+# Отдавать статистику SQL-запросов в заголовках ответа (для отладки)
+DB_DEBUG_HEADERS: bool = os.getenv("DB_DEBUG_HEADERS", "false").lower() == "true"
+
+# Проверять ответы по схемам pydantic. В рабочем окружении проверка выключена:
+# ответы собираются в models.py и сразу сериализуются orjson, в тестах включена
+VALIDATE_RESPONSES: bool = (
+    os.getenv("VALIDATE_RESPONSES", "false").lower() == "true"
+)
+
+# Сессия запроса: авторизация и все запросы обработчика выполняются в ней
+RequestSession = Annotated[AsyncSession, Depends(get_request_session)]
+
+
+def get_etag_headers(etag: str) -> Dict[str, str]:
+    """Заголовки ответа с ETag: ответ кэшируется, но всегда перепроверяется"""
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def fast_response(
+    model: Type[BaseModel], content: Dict, etag: str | None = None
+) -> ORJSONResponse:
+    """
+    Функция собирающая ответ без проверки response_model в FastAPI:
+    ответ-Response отдаётся как есть, поэтому словарь сериализуется один раз
+    :param model: Схема ответа (проверяется, только если VALIDATE_RESPONSES)
+    :type model: Type[BaseModel]
+    :param content: Ответ
+    :type content: Dict
+    :param etag: ETag ответа
+    :type etag: str | None
+    :return: JSON-ответ
+    :rtype: ORJSONResponse
+    """
+    if VALIDATE_RESPONSES:
+        content = model.parse_obj(content).dict()
+
+    return ORJSONResponse(
+        content=content, headers=get_etag_headers(etag) if etag else None
+    )
+
+
+def not_modified_response(etag: str) -> Response:
+    """Ответ 304: у клиента актуальная версия ресурса"""
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED, headers=get_etag_headers(etag)
+    )
+
+
 # Контекстный менеджер для выполнения действий
 # до запуска приложения и после завершения работы
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Создаём таблицы в БД, если они не созданы
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-
-    # Нужен только для заполнения тестовыми данными
-    # (в конечной версии будет удалён)
-    await testing()
+    # Однократная работа при старте: воркеры выполняют её по очереди,
+    # первый делает, остальные только проверяют
+    async with startup_lock():
+        # Применяем недостающие миграции схемы БД
+        # (если схема актуальна - только проверка версии)
+        await migrate()
+
+        # Нужен только для заполнения тестовыми данными
+        # (в конечной версии будет удалён)
+        await testing()
+
+    # Фоновые задачи, которые выполняет один (ведущий) воркер:
+    # перенос новых твитов в полнотекстовый индекс
+    # и удаление файлов медиа из очереди и неприкреплённых загрузок
+    leader_tasks: List[Callable[[], Awaitable[None]]] = []
+    if SEARCH_INDEX_CLEAN_INTERVAL > 0:
+        leader_tasks.append(run_search_index_cleaner)
+    if MEDIA_GC_INTERVAL > 0:
+        leader_tasks.append(run_media_gc)
+    if TIMELINE_PRUNE_INTERVAL > 0:
+        leader_tasks.append(run_timeline_pruner)
+
+    leader_election: asyncio.Task | None = None
+    if leader_tasks:
+        leader_election = asyncio.create_task(run_as_leader(leader_tasks))
+
+    # Получение событий для потоков GET /api/events
+    await event_broker.start()
+
+    # Проверяем реплики до приёма запросов, затем - периодически
+    replica_checker: asyncio.Task | None = None
+    if replica_set.engines:
+        await replica_set.check()
+        replica_checker = asyncio.create_task(replica_set.run_health_checks())
 
     yield
 
+    if replica_checker is not None:
+        replica_checker.cancel()
+    # Ведущий воркер останавливает задачи и освобождает блокировку
+    if leader_election is not None:
+        leader_election.cancel()
+        await asyncio.gather(leader_election, return_exceptions=True)
+
+    # Записываем лайки, оставшиеся в буфере
+    await like_buffer.close()
+
+    # Закрываем потоки событий
+    event_hub.close()
+    await event_broker.close()
+
+    # Дожидаемся фоновой обработки картинок и завершаем пул процессов
+    await asyncio.gather(*IMAGE_PROCESSING_TASKS, return_exceptions=True)
+    shutdown_image_pool()
+    # Пул потоков для файлов медиа завершаем после остановки фоновых задач
+    shutdown_media_io_pool()
+
+    # Закрываем соединения с кэшем ответов
+    await response_cache.close()
+
     # Завершаем сессию
     await session.close()
+    await replica_set.close()
     await engine.dispose()
 
 
@@ -61,21 +285,101 @@ app = FastAPI(lifespan=lifespan)
 Instrumentator().instrument(app).expose(app, include_in_schema=False)
 
 
-@app.get("/api/users/me", response_model=BaseUserInfoOut)
-async def get_users_me(api_key: Annotated[str | None, Header()] = None):
-    """Returns information about the current user"""
+@app.middleware("http")
+async def track_db_queries(request: Request, call_next):
+    """Records the number of SQL statements and DB time of every request"""
+    # Статистику заполняют события движка, выполняемые в контексте запроса
+    stats: QueryStats = QueryStats()
+    token = REQUEST_QUERY_STATS.set(stats)
+
+    try:
+        response: Response = await call_next(request)
+    finally:
+        REQUEST_QUERY_STATS.reset(token)
+
+    # Метрики пишем по шаблону пути, как и HTTP-метрики (/api/tweets/{id})
+    route = request.scope.get("route")
+    if route is not None:
+        observe_request_stats(stats, method=request.method, handler=route.path)
+
+    if DB_DEBUG_HEADERS:
+        response.headers["X-DB-Queries"] = str(stats.count)
+        response.headers["X-DB-Time"] = "{:.2f}".format(stats.seconds * 1000)
+        if stats.slowest_statement is not None:
+            response.headers["X-DB-Slowest"] = get_statement_fingerprint(
+                stats.slowest_statement
+            ).encode("ascii", "replace").decode()
+
+    return response
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Rejects oversized uploads by Content-Length before the body is read"""
+    if request.url.path == "/api/medias":
+        content_length: str = request.headers.get("content-length", "")
+
+        # Размер файла дополнительно проверяется при записи на диск,
+        # здесь отсекаем заведомо слишком большие запросы, не читая тело
+        if (
+            content_length.isdigit()
+            and int(content_length) > MEDIA_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD
+        ):
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content=ERROR_FILE_TOO_LARGE,
+            )
+
+    return await call_next(request)
+
+
+@app.get(
+    "/api/users/me",
+    response_model=Union[BaseUserInfoOut, BaseUserInfoCompactOut],
+)
+async def get_users_me(
+        db: RequestSession,
+        api_key: Annotated[str | None, Header()] = None,
+        if_none_match: Annotated[str | None, Header()] = None,
+        compact: bool = False,
+):
+    """
+    Returns information about the current user,
+    `compact=true` returns follower and following counts instead of lists.
+    Supports ETag / If-None-Match (304 when the profile has not changed)
+    """
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден, то возвращаем информацию по нему
     if user:
-        # Собираем информацию о профиле пользователя из БД
-        user_dict: Dict = await get_user_from_id(user_id=user.id)
+        # Версия профиля по счётчику изменений, профиль из БД не читаем
+        etag: str = make_etag(
+            "user",
+            user.id,
+            compact,
+            *await get_counters(db, [get_user_counter(user.id)]),
+        )
+        if is_not_modified(if_none_match, etag):
+            return not_modified_response(etag)
+
+        # Собираем информацию о профиле пользователя (из кэша или БД)
+        user_dict: Dict = await response_cache.get_or_load(
+            "user",
+            [get_user_counter(user.id)],
+            (user.id, compact),
+            lambda: get_user_from_id(db, user_id=user.id, compact=compact),
+            **get_cache_options(db),
+        )
 
         # Собираем ответ
         user_data: Dict = {"result": True, "user": user_dict}
 
-        return user_data
+        return fast_response(
+            BaseUserInfoCompactOut if compact else BaseUserInfoOut,
+            user_data,
+            etag=etag,
+        )
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -83,20 +387,86 @@ async def get_users_me(api_key: Annotated[str | None, Header()] = None):
     )
 
 
-@app.get("/api/tweets", response_model=BaseTweetsGetOut)
-async def get_all_tweets(api_key: Annotated[str | None, Header()] = None):
-    """Returns a list of all tweets"""
+@app.get(
+    "/api/tweets",
+    response_model=Union[BaseTweetsGetOut, BaseTweetsGetCompactOut],
+)
+async def get_all_tweets(
+        db: RequestSession,
+        api_key: Annotated[str | None, Header()] = None,
+        cursor: Annotated[int | None, Query(gt=0, le=TWEET_ID_MAX)] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=TWEETS_PAGE_SIZE_MAX)
+        ] = TWEETS_PAGE_SIZE,
+        following: bool = False,
+        compact: bool = False,
+        if_none_match: Annotated[str | None, Header()] = None,
+):
+    """
+    Returns a page of tweets, newest first.
+    Pass the X-Next-Cursor response header as `cursor` to get the next page,
+    `following=true` returns only tweets of followed users and your own,
+    `compact=true` returns like counts and a "liked by me" flag instead of likers.
+    Supports ETag / If-None-Match (304 when the page has not changed)
+    """
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден, то возвращаем твиты
     if user:
-        # Получаем список твитов
-        tweets_list: List = await get_all_tweets_from_db()
+        # Версия страницы: последний твит и счётчики твитов, для ленты
+        # подписок - ещё счётчики ленты и подписок пользователя,
+        # плюс параметры страницы
+        versions: List[int] = await get_tweets_versions(
+            db, user_id=user.id, following_only=following
+        )
+        etag: str = make_etag(
+            "tweets", user.id, cursor, limit, following, compact, *versions
+        )
+        if is_not_modified(if_none_match, etag):
+            return not_modified_response(etag)
+
+        # Получаем страницу твитов (из кэша или БД). Полная общая лента
+        # одинакова для всех пользователей, поэтому кэшируется одна на всех,
+        # лента подписок зависит ещё и от подписок пользователя.
+        # Версия входит в ключ: новые твиты не сбрасывают кэш остальных лент
+        tweets_list: List = await response_cache.get_or_load(
+            "tweets",
+            [*TWEETS_COUNTERS, get_user_counter(user.id)]
+            if following
+            else TWEETS_COUNTERS,
+            (
+                user.id if following or compact else "all",
+                cursor,
+                limit,
+                following,
+                compact,
+                *versions,
+            ),
+            lambda: get_all_tweets_from_db(
+                db,
+                user_id=user.id,
+                cursor=cursor,
+                limit=limit,
+                following_only=following,
+                compact=compact,
+            ),
+            **get_cache_options(db),
+        )
+
         # Готовим ответ
         tweets: Dict = {"result": True, "tweets": tweets_list}
+        response: ORJSONResponse = fast_response(
+            BaseTweetsGetCompactOut if compact else BaseTweetsGetOut,
+            tweets,
+            etag=etag,
+        )
 
-        return tweets
+        # Если страница заполнена полностью, то отдаём курсор следующей страницы
+        if len(tweets_list) == limit:
+            response.headers["X-Next-Cursor"] = str(tweets_list[-1]["id"])
+
+        return response
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -104,38 +474,188 @@ async def get_all_tweets(api_key: Annotated[str | None, Header()] = None):
     )
 
 
-@app.get("/api/users/{id}", response_model=BaseUserInfoOut)
-async def get_user_by_id(id: int):
-    """Returns information about any user by his ID"""
-    # Получаем информацию о пользователе по id
-    user_info: Dict | None = await get_user_from_id(user_id=id)
+@app.get(
+    "/api/tweets/search",
+    response_model=Union[BaseTweetsGetOut, BaseTweetsGetCompactOut],
+)
+async def search_tweets(
+        db: RequestSession,
+        q: Annotated[str, Query(min_length=1, max_length=200)],
+        api_key: Annotated[str | None, Header()] = None,
+        cursor: Annotated[
+            str | None, Query(pattern=r"^[0-9.e+-]+:[0-9]+$")
+        ] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=TWEETS_PAGE_SIZE_MAX)
+        ] = TWEETS_PAGE_SIZE,
+        compact: bool = False,
+):
+    """
+    Full-text search over tweets, most relevant first.
+    `q` supports "quoted phrases", `or` and `-excluded` words.
+    Pass the X-Next-Cursor response header as `cursor` to get the next page,
+    `compact=true` returns like counts and a "liked by me" flag instead of likers
+    """
+    # Проверяем наличие пользователя
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
+
+    # Если пользователь найден, то ищем твиты
+    if user:
+        try:
+            search_cursor: Tuple[float, int] | None = (
+                parse_search_cursor(cursor) if cursor else None
+            )
+        except ValueError:
+            return JSONResponse(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                content=ERROR_INVALID_CURSOR,
+            )
+
+        tweets_list, next_cursor = await search_tweets_in_db(
+            db,
+            user_id=user.id,
+            text_query=q,
+            cursor=search_cursor,
+            limit=limit,
+            compact=compact,
+        )
+
+        # Готовим ответ
+        tweets: Dict = {"result": True, "tweets": tweets_list}
+        response: ORJSONResponse = fast_response(
+            BaseTweetsGetCompactOut if compact else BaseTweetsGetOut, tweets
+        )
+
+        # Если есть следующая страница, то отдаём её курсор
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+
+        return response
+
+    # Ответ в случае ошибки аутентификации (пользователь не найден)
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED, content=ERROR_AUTHENTICATION
+    )
+
+
+@app.get(
+    "/api/users",
+    response_model=Union[BaseUsersOut, BaseUsersCompactOut],
+)
+async def get_users_by_ids(
+        ids: Annotated[
+            str,
+            Query(
+                pattern=r"^[0-9]{1,10}(,[0-9]{1,10})*$",
+                max_length=USERS_IDS_MAX_LENGTH,
+            ),
+        ],
+        db: RequestSession,
+        compact: bool = False,
+        if_none_match: Annotated[str | None, Header()] = None,
+):
+    """
+    Returns information about several users by comma-separated `ids`
+    in the order of `ids` (unknown ids are skipped),
+    `compact=true` returns follower and following counts instead of lists.
+    Supports ETag / If-None-Match (304 when none of the profiles has changed)
+    """
+    # Повторяющиеся id отдаём один раз, порядок - как в запросе
+    user_ids: List[int] = list(dict.fromkeys(map(int, ids.split(","))))
+
+    if len(user_ids) > USERS_BATCH_SIZE_MAX:
+        return JSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content=ERROR_TOO_MANY_IDS,
+        )
+
+    # id вне диапазона колонки отклоняем до запроса к БД
+    if max(user_ids) > USER_ID_MAX:
+        return JSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content=ERROR_INVALID_IDS,
+        )
+
+    # Версия ответа по счётчикам изменений профилей, профили из БД не читаем
+    counters: List[str] = [get_user_counter(i_id) for i_id in user_ids]
+    etag: str = make_etag(
+        "users", *user_ids, compact, *await get_counters(db, counters)
+    )
+    if is_not_modified(if_none_match, etag):
+        return not_modified_response(etag)
+
+    # Получаем информацию о пользователях одним запросом (из кэша или БД)
+    users_list: List[Dict] = await response_cache.get_or_load(
+        "users",
+        counters,
+        (",".join(map(str, user_ids)), compact),
+        lambda: get_users_from_ids(db, user_ids=user_ids, compact=compact),
+        **get_cache_options(db),
+    )
+
+    users: Dict = {"result": True, "users": users_list}
+
+    return fast_response(
+        BaseUsersCompactOut if compact else BaseUsersOut, users, etag=etag
+    )
+
+
+@app.get(
+    "/api/users/{id}",
+    response_model=Union[BaseUserInfoOut, BaseUserInfoCompactOut],
+)
+async def get_user_by_id(
+        id: int,
+        db: RequestSession,
+        compact: bool = False,
+        if_none_match: Annotated[str | None, Header()] = None,
+):
+    """
+    Returns information about any user by his ID,
+    `compact=true` returns follower and following counts instead of lists.
+    Supports ETag / If-None-Match (304 when the profile has not changed)
+    """
+    # Версия профиля по счётчику изменений, профиль из БД не читаем
+    etag: str = make_etag(
+        "user", id, compact, *await get_counters(db, [get_user_counter(id)])
+    )
+    if is_not_modified(if_none_match, etag):
+        return not_modified_response(etag)
+
+    # Получаем информацию о пользователе по id (из кэша или БД)
+    user_info: Dict | None = await response_cache.get_or_load(
+        "user",
+        [get_user_counter(id)],
+        (id, compact),
+        lambda: get_user_from_id(db, user_id=id, compact=compact),
+        **get_cache_options(db),
+    )
 
     # Если пользователь найден, то возвращаем информацию по нему
     if user_info:
         user: Dict = {"result": True, "user": user_info}
 
-        return user
+        return fast_response(
+            BaseUserInfoCompactOut if compact else BaseUserInfoOut,
+            user,
+            etag=etag,
+        )
 
     # Ответ в случае, если пользователь не найден
-    error_response: Dict = {
-        "result": False,
-        "error_type": "NotFound",
-        "error_message": "User not found",
-    }
-
     return JSONResponse(
-        status_code=status.HTTP_404_NOT_FOUND,
-        content=error_response
+        status_code=status.HTTP_404_NOT_FOUND, content=ERROR_USER_NOT_FOUND
     )
 
 
 @app.post("/api/tweets", response_model=BaseTweetsPostOut)
 async def post_tweets(
-        tweet: BaseTweetsPostIn, api_key: Annotated[str | None, Header()] = None
+        tweet: BaseTweetsPostIn,
+        db: RequestSession,
+        api_key: Annotated[str | None, Header()] = None,
 ):
     """Loads a user's tweet"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден, то возвращаем твиты
     if user:
@@ -146,13 +666,14 @@ async def post_tweets(
 
         # Записываем твит в БД, и получаем его id
         tweet_id: int = await write_post_to_db(
-            tweet_text=tweet_text, author_id=user.id
+            db, tweet_text=tweet_text, author_id=user.id
         )
 
         # Если есть медиа, то обновляем id твита у медиа
+        # (в той же транзакции, твит и медиа сохраняются вместе)
         if media_list:
             await update_image_tweet_id(
-                image_id_list=media_list, tweet_id=tweet_id
+                db, image_id_list=media_list, tweet_id=tweet_id
             )
 
         return {"result": True, "tweet_id": tweet_id}
@@ -165,21 +686,30 @@ async def post_tweets(
 
 @app.post("/api/medias", response_model=BaseMediaOut)
 async def post_medias(
-        file: UploadFile, api_key: Annotated[str | None, Header()] = None
+        file: UploadFile,
+        db: RequestSession,
+        api_key: Annotated[str | None, Header()] = None,
 ):
     """Loads a user's media"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден,
     # то записываем медиа, а затем возвращаем id медиа
     if user:
-        # Читаем файлы в байты
-        file_byte: bytes = await file.read()
-        # Записываем медиа в БД и на диск, получаем его id
-        media_id: int = await write_image_to_db(
-            file=file_byte, user_api_key=api_key
-        )
+        try:
+            # Записываем медиа на диск (потоково, блоками) и в БД, получаем его id
+            media_id: int = await write_image_to_db(db, file=file)
+        except FileTooLargeError:
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content=ERROR_FILE_TOO_LARGE,
+            )
+        except UnsupportedMediaTypeError:
+            return JSONResponse(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                content=ERROR_UNSUPPORTED_MEDIA_TYPE,
+            )
 
         return {"result": True, "media_id": media_id}
 
@@ -190,17 +720,25 @@ async def post_medias(
 
 
 @app.post("/api/users/{id}/follow", response_model=BaseOperationResultOut)
-async def following(id: int, api_key: Annotated[str | None, Header()] = None):
+async def following(
+        id: int, db: RequestSession, api_key: Annotated[str | None, Header()] = None
+):
     """Subscribe to any user"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден
     if user:
         # Записываем подписку в БД
-        await write_following_to_db(user_id=user.id, following_id=id)
+        if await write_following_to_db(
+            db, user_id=user.id, following_id=id
+        ):
+            return {"result": True}
 
-        return {"result": True}
+        # Ответ в случае, если пользователь не найден
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND, content=ERROR_USER_NOT_FOUND
+        )
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -209,17 +747,33 @@ async def following(id: int, api_key: Annotated[str | None, Header()] = None):
 
 
 @app.post("/api/tweets/{id}/likes", response_model=BaseOperationResultOut)
-async def like(id: int, api_key: Annotated[str | None, Header()] = None):
+async def like(
+        id: int, db: RequestSession, api_key: Annotated[str | None, Header()] = None
+):
     """Like any post"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден
     if user:
-        # Записываем лайк в БД
-        await write_likes_to_db(tweet_id=id, user=user)
+        # Записываем лайк в БД (через буфер лайков, если он включён)
+        if like_buffer.enabled:
+            # Пачку пишет другая транзакция: соединение запроса возвращаем
+            # в пул, иначе при всплеске лайков пачке не хватит соединений
+            await release_connection(db)
+            tweet_exists: bool = await like_buffer.submit(
+                tweet_id=id, user_id=user.id, liked=True
+            )
+        else:
+            tweet_exists = await write_likes_to_db(db, tweet_id=id, user_id=user.id)
+
+        if tweet_exists:
+            return {"result": True}
 
-        return {"result": True}
+        # Ответ в случае, если твит не найден
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND, content=ERROR_TWEET_NOT_FOUND
+        )
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -228,19 +782,29 @@ async def like(id: int, api_key: Annotated[str | None, Header()] = None):
 
 
 @app.delete("/api/tweets/{id}", response_model=BaseOperationResultOut)
-async def remove_tweets(id: int, api_key: Annotated[str | None, Header()] = None):
+async def remove_tweets(
+        id: int, db: RequestSession, api_key: Annotated[str | None, Header()] = None
+):
     """Allows you to delete your tweet"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден
     if user:
         # Удаляем твит
-        result: bool = await delete_tweet_from_db(tweet_id=id, user_id=user.id)
+        result: bool | None = await delete_tweet_from_db(
+            db, tweet_id=id, user_id=user.id
+        )
 
         if result:
             return {"result": True}
 
+        # Ответ в случае, если твит не найден
+        if result is None:
+            return JSONResponse(
+                status_code=status.HTTP_404_NOT_FOUND, content=ERROR_TWEET_NOT_FOUND
+            )
+
         # Ответ в случае, если пользователь не являет автором твита
         error_response: Dict = {
             "result": False,
@@ -259,17 +823,25 @@ async def remove_tweets(id: int, api_key: Annotated[str | None, Header()] = None
 
 
 @app.delete("/api/users/{id}/follow", response_model=BaseOperationResultOut)
-async def unfollowing(id: int, api_key: Annotated[str | None, Header()] = None):
+async def unfollowing(
+        id: int, db: RequestSession, api_key: Annotated[str | None, Header()] = None
+):
     """Allows you to unfollow another user"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден
     if user:
         # Удалям подписку у пользователя
-        await delete_following(user_id=user.id, following_id=id)
+        if await delete_following(
+            db, user_id=user.id, following_id=id
+        ):
+            return {"result": True}
 
-        return {"result": True}
+        # Ответ в случае, если пользователь не найден
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND, content=ERROR_USER_NOT_FOUND
+        )
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -278,17 +850,74 @@ async def unfollowing(id: int, api_key: Annotated[str | None, Header()] = None):
 
 
 @app.delete("/api/tweets/{id}/likes", response_model=BaseOperationResultOut)
-async def remove_like(id: int, api_key: Annotated[str | None, Header()] = None):
+async def remove_like(
+        id: int, db: RequestSession, api_key: Annotated[str | None, Header()] = None
+):
     """Allows you to remove a like from a tweet"""
     # Проверяем наличие пользователя
-    user: Users | None = await get_user_from_api_key(api_key)
+    user: UserIdentity | None = await get_user_from_api_key(db, api_key)
 
     # Если пользователь найден
     if user:
-        # удаляем лайк пользователя
-        await delete_likes_from_db(tweet_id=id, user_id=user.id)
+        # удаляем лайк пользователя (через буфер лайков, если он включён)
+        if like_buffer.enabled:
+            await release_connection(db)
+            tweet_exists: bool = await like_buffer.submit(
+                tweet_id=id, user_id=user.id, liked=False
+            )
+        else:
+            tweet_exists = await delete_likes_from_db(
+                db, tweet_id=id, user_id=user.id
+            )
+
+        if tweet_exists:
+            return {"result": True}
+
+        # Ответ в случае, если твит не найден
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND, content=ERROR_TWEET_NOT_FOUND
+        )
+
+    # Ответ в случае ошибки аутентификации (пользователь не найден)
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED, content=ERROR_AUTHENTICATION
+    )
+
+
+@app.get("/api/events", response_class=StreamingResponse)
+async def events(
+        db: RequestSession,
+        api_key: Annotated[str | None, Header()] = None,
+        api_key_query: Annotated[str | None, Query(alias="api_key")] = None,
+):
+    """
+    Server-sent events stream: new and deleted tweets and likes of the users
+    you follow and of your own tweets (`tweet`, `tweet_deleted`, `like`, `unlike`),
+    your follows (`follow`, `unfollow`). `reset` means events were lost
+    and the feed should be reloaded. EventSource cannot send headers,
+    so the key may also be passed as the `api_key` query parameter
+    """
+    # Проверяем наличие пользователя
+    user: UserIdentity | None = await get_user_from_api_key(
+        db, api_key or api_key_query
+    )
+
+    # Если пользователь найден, то открываем поток
+    if user:
+        if event_hub.subscribers >= EVENTS_MAX_SUBSCRIBERS:
+            return JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content=ERROR_TOO_MANY_STREAMS,
+            )
 
-        return {"result": True}
+        following_ids: List[int] = await get_following_ids(db, user_id=user.id)
+
+        return StreamingResponse(
+            stream_events(user.id, following_ids),
+            media_type="text/event-stream",
+            # Прокси не должен буферизовать поток
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     # Ответ в случае ошибки аутентификации (пользователь не найден)
     return JSONResponse(
@@ -42,6 +42,28 @@ class BaseUserInfoOut(BaseModel):
     user: BaseUser
 
 
+class BaseUserCompact(BaseModel):
+    id: int
+    name: str
+    followers_count: int
+    following_count: int
+
+
+class BaseUserInfoCompactOut(BaseModel):
+    result: bool
+    user: BaseUserCompact
+
+
+class BaseUsersOut(BaseModel):
+    result: bool
+    users: List[BaseUser]
+
+
+class BaseUsersCompactOut(BaseModel):
+    result: bool
+    users: List[BaseUserCompact]
+
+
 class BaseLikes(BaseModel):
     user_id: int
     name: str
@@ -65,6 +87,20 @@ class BaseTweetsGetOut(BaseModel):
     tweets: List[BaseTweetsGet]
 
 
+class BaseTweetsGetCompact(BaseModel):
+    id: int
+    content: str
+    attachments: List[str | None]
+    author: BaseAuthor
+    like_count: int
+    liked: bool
+
+
+class BaseTweetsGetCompactOut(BaseModel):
+    result: bool
+    tweets: List[BaseTweetsGetCompact]
+
+
 class BaseMediaOut(BaseModel):
     result: bool
     media_id: int
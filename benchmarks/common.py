@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+from typing import Dict, NamedTuple
+
+# Бенчмарки работают с тестовой БД (переменные TEST_DB_* из .env),
+# переменные окружения задаются до подключения модулей приложения
+os.environ["ENV"] = "test"
+# Ленты хранятся в таблице timeline, как в рабочем окружении
+os.environ.setdefault("TIMELINE_STORE", "postgres")
+# Фоновая обработка картинок на замеры не влияет
+os.environ.setdefault("IMAGE_WORKERS", "0")
+
+ROOT_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Приложение импортирует модули как database.*, поэтому добавляем папку app
+sys.path.insert(0, os.path.join(ROOT_DIR, "app"))
+
+# Папка с результатами замеров
+RESULTS_DIR: str = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+
+class Scale(NamedTuple):
+    """Размер синтетического набора данных"""
+
+    users: int
+    tweets_per_user: int
+    follows_per_user: int
+    likes_per_tweet: int
+    # Доля твитов с картинками
+    media_ratio: float
+
+
+# Наборы данных разного размера
+SCALES: Dict[str, Scale] = {
+    "small": Scale(
+        users=100,
+        tweets_per_user=10,
+        follows_per_user=10,
+        likes_per_tweet=3,
+        media_ratio=0.2,
+    ),
+    "medium": Scale(
+        users=1000,
+        tweets_per_user=20,
+        follows_per_user=30,
+        likes_per_tweet=5,
+        media_ratio=0.2,
+    ),
+    "large": Scale(
+        users=10000,
+        tweets_per_user=20,
+        follows_per_user=50,
+        likes_per_tweet=10,
+        media_ratio=0.2,
+    ),
+}
+
+
+def get_api_key(user_id: int) -> str:
+    """Функция возвращающая Api-Key синтетического пользователя"""
+    return "bench-{}".format(user_id)
+
+
+def get_commit() -> str:
+    """Функция возвращающая текущий коммит (для сравнения результатов)"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,105 @@
+"""
+Сравнение двух результатов бенчмарка (например, до и после изменения).
+Код возврата 1, если p95 какого-либо сценария вырос больше порога.
+
+Запуск из корня проекта:
+    python -m benchmarks.compare benchmarks/results/abc1234-small.json \\
+        benchmarks/results/def5678-small.json --threshold 10
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+# Сравниваемые метрики
+METRICS: Tuple[str, ...] = (
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "rps",
+    "queries_per_request",
+)
+
+
+def get_change(before: float | None, after: float | None) -> str:
+    """Функция форматирующая изменение метрики в процентах"""
+    if before is None or after is None:
+        return "n/a"
+    if before == 0:
+        return "0%" if after == 0 else "new"
+
+    return "{:+.1f}%".format((after - before) / before * 100)
+
+
+def compare(before: Dict, after: Dict, threshold: float) -> List[str]:
+    """
+    Функция печатающая таблицу изменений и возвращающая сценарии с регрессией
+    :param before: Результат до изменения
+    :type before: Dict
+    :param after: Результат после изменения
+    :type after: Dict
+    :param threshold: Допустимый рост p95, в процентах
+    :type threshold: float
+    :return: Сценарии, у которых p95 вырос больше порога
+    :rtype: List[str]
+    """
+    if before["scale"] != after["scale"]:
+        print(
+            "warning: different datasets ({} vs {})".format(
+                before["scale"], after["scale"]
+            )
+        )
+
+    print("{} -> {}".format(before["commit"], after["commit"]))
+    regressions: List[str] = list()
+
+    for i_name, i_after in after["results"].items():
+        i_before: Dict | None = before["results"].get(i_name)
+        if i_before is None:
+            print("{:<18} new scenario".format(i_name))
+            continue
+
+        print(
+            "{:<18} ".format(i_name)
+            + "  ".join(
+                "{} {} -> {} ({})".format(
+                    i_metric,
+                    i_before.get(i_metric),
+                    i_after.get(i_metric),
+                    get_change(i_before.get(i_metric), i_after.get(i_metric)),
+                )
+                for i_metric in METRICS
+            )
+        )
+
+        if i_after["p95_ms"] > i_before["p95_ms"] * (1 + threshold / 100):
+            regressions.append(i_name)
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("before", help="baseline result file")
+    parser.add_argument("after", help="new result file")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="allowed p95 growth, %%"
+    )
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before: Dict = json.load(f)
+    with open(args.after) as f:
+        after: Dict = json.load(f)
+
+    regressions: List[str] = compare(before, after, args.threshold)
+
+    if regressions:
+        print("p95 regression: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Нагрузочный бенчмарк эндпоинтов API.
+Приложение запускается в этом же процессе (или указывается --url работающего сервера),
+запросы отправляются конкурентно, для каждого сценария считаются
+p50/p95/p99 задержки, запросы в секунду и количество SQL-запросов на запрос.
+Результат сохраняется в benchmarks/results/<коммит>-<набор данных>.json
+
+Запуск из корня проекта (после python -m benchmarks.seed --scale small):
+    python -m benchmarks.run --scale small --requests 1000 --concurrency 20
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import httpx
+from sqlalchemy import event
+
+# Настраивает окружение, поэтому подключается до модулей приложения
+from benchmarks.common import (
+    RESULTS_DIR,
+    SCALES,
+    Scale,
+    get_api_key,
+    get_commit,
+)
+from database.database import engine
+from main import app
+
+# Счётчик SQL-запросов текущего HTTP-запроса
+QUERY_COUNTER: contextvars.ContextVar = contextvars.ContextVar(
+    "bench_query_counter", default=None
+)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Считает SQL-запросы, выполненные в рамках HTTP-запроса бенчмарка"""
+    counter: List[int] | None = QUERY_COUNTER.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+class Request(NamedTuple):
+    """HTTP-запрос сценария"""
+
+    method: str
+    url: str
+    params: Dict
+    headers: Dict
+    json: Dict | None = None
+
+
+# Сценарий получает генератор случайных чисел и набор данных, возвращает запрос
+Scenario = Callable[[random.Random, Scale], Request]
+
+
+def auth(rng: random.Random, scale: Scale) -> Dict:
+    """Заголовок авторизации случайного пользователя"""
+    return {"Api-Key": get_api_key(rng.randint(1, scale.users))}
+
+
+def random_tweet_id(rng: random.Random, scale: Scale) -> int:
+    """id случайного твита из синтетического набора"""
+    return rng.randint(1, scale.users * scale.tweets_per_user)
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "users_me": lambda rng, scale: Request(
+        "GET", "/api/users/me", {}, auth(rng, scale)
+    ),
+    "users_me_compact": lambda rng, scale: Request(
+        "GET", "/api/users/me", {"compact": True}, auth(rng, scale)
+    ),
+    "user_by_id": lambda rng, scale: Request(
+        "GET", "/api/users/{}".format(rng.randint(1, scale.users)), {}, {}
+    ),
+    "tweets": lambda rng, scale: Request(
+        "GET", "/api/tweets", {}, auth(rng, scale)
+    ),
+    "tweets_compact": lambda rng, scale: Request(
+        "GET", "/api/tweets", {"compact": True}, auth(rng, scale)
+    ),
+    "tweets_deep_page": lambda rng, scale: Request(
+        "GET",
+        "/api/tweets",
+        {"cursor": random_tweet_id(rng, scale)},
+        auth(rng, scale),
+    ),
+    "tweets_following": lambda rng, scale: Request(
+        "GET", "/api/tweets", {"following": True}, auth(rng, scale)
+    ),
+    "like": lambda rng, scale: Request(
+        "POST",
+        "/api/tweets/{}/likes".format(random_tweet_id(rng, scale)),
+        {},
+        auth(rng, scale),
+    ),
+    "unlike": lambda rng, scale: Request(
+        "DELETE",
+        "/api/tweets/{}/likes".format(random_tweet_id(rng, scale)),
+        {},
+        auth(rng, scale),
+    ),
+    "follow": lambda rng, scale: Request(
+        "POST",
+        "/api/users/{}/follow".format(rng.randint(1, scale.users)),
+        {},
+        auth(rng, scale),
+    ),
+    "post_tweet": lambda rng, scale: Request(
+        "POST",
+        "/api/tweets",
+        {},
+        auth(rng, scale),
+        {"tweet_data": "Benchmark tweet", "tweet_media_ids": []},
+    ),
+}
+
+
+async def send(
+    client: httpx.AsyncClient, request: Request
+) -> Tuple[float, int, bool]:
+    """
+    Корутин отправляющий запрос
+    :return: Время ответа в секундах, количество SQL-запросов, успешен ли ответ
+    :rtype: Tuple[float, int, bool]
+    """
+    counter: List[int] = [0]
+    token: contextvars.Token = QUERY_COUNTER.set(counter)
+    start: float = time.perf_counter()
+
+    try:
+        response: httpx.Response = await client.request(
+            request.method,
+            request.url,
+            params=request.params,
+            headers=request.headers,
+            json=request.json,
+        )
+        is_ok: bool = response.status_code < 400
+    except httpx.HTTPError:
+        is_ok = False
+    finally:
+        elapsed: float = time.perf_counter() - start
+        QUERY_COUNTER.reset(token)
+
+    return elapsed, counter[0], is_ok
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    scale: Scale,
+    requests: int,
+    concurrency: int,
+    warmup: int,
+    random_seed: int,
+    count_queries: bool,
+) -> Dict:
+    """
+    Корутин выполняющий сценарий несколькими конкурентными клиентами
+    :return: Метрики сценария
+    :rtype: Dict
+    """
+    rng: random.Random = random.Random(random_seed)
+
+    # Прогрев: соединения пула, кэши авторизации и планов запросов
+    for _ in range(warmup):
+        await send(client, scenario(rng, scale))
+
+    pending: List[Request] = [scenario(rng, scale) for _ in range(requests)]
+    latencies: List[float] = list()
+    queries: List[int] = list()
+    errors: int = 0
+
+    async def worker() -> None:
+        nonlocal errors
+        while pending:
+            elapsed, query_count, is_ok = await send(client, pending.pop())
+            latencies.append(elapsed)
+            queries.append(query_count)
+            if not is_ok:
+                errors += 1
+
+    start: float = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration: float = time.perf_counter() - start
+
+    # Перцентили 1..99
+    percentiles: List[float] = statistics.quantiles(latencies, n=100)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "p50_ms": round(percentiles[49] * 1000, 2),
+        "p95_ms": round(percentiles[94] * 1000, 2),
+        "p99_ms": round(percentiles[98] * 1000, 2),
+        # Для сервера по --url запросы к БД не видны
+        "queries_per_request": (
+            round(statistics.fmean(queries), 2) if count_queries else None
+        ),
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    """Корутин выполняющий выбранные сценарии и собирающий результат"""
+    scale: Scale = SCALES[args.scale]
+
+    if args.url:
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=args.concurrency)
+        )
+        base_url: str = args.url
+    else:
+        # Ошибки приложения считаются ошибочными ответами, а не прерывают замер
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        base_url = "http://bench"
+
+    results: Dict[str, Dict] = dict()
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url=base_url, timeout=60
+    ) as client:
+        for i_name in args.scenarios:
+            results[i_name] = await run_scenario(
+                client,
+                SCENARIOS[i_name],
+                scale,
+                requests=args.requests,
+                concurrency=args.concurrency,
+                warmup=args.warmup,
+                random_seed=args.seed,
+                count_queries=not args.url,
+            )
+            print(
+                "{:<18} p50 {p50_ms:>8} ms  p95 {p95_ms:>8} ms  "
+                "p99 {p99_ms:>8} ms  {rps:>8} rps  "
+                "{queries_per_request} queries/req  {errors} errors".format(
+                    i_name, **results[i_name]
+                )
+            )
+
+    await engine.dispose()
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "target": args.url or "in-process",
+        "scale": args.scale,
+        "dataset": SCALES[args.scale]._asdict(),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=SCENARIOS,
+        default=list(SCENARIOS),
+        metavar="SCENARIO",
+        help="scenarios to run: {}".format(", ".join(SCENARIOS)),
+    )
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--output", help="result file (JSON)")
+    args = parser.parse_args()
+
+    result: Dict = asyncio.run(run(args))
+
+    output: str = args.output or os.path.join(
+        RESULTS_DIR, "{}-{}.json".format(result["commit"], args.scale)
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print("saved {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Замер задержки полнотекстового поиска твитов на корпусах разного размера.
+Для каждого размера таблицы тестовой БД пересоздаются и заполняются
+твитами из синтетического словаря (частоты слов убывают как в естественном
+тексте), затем каждый запрос выполняется через search_tweets_in_db
+и считаются p50/p95/p99.
+ВНИМАНИЕ: все таблицы тестовой БД (TEST_DB_* из .env) пересоздаются.
+
+Запуск из корня проекта:
+    python -m benchmarks.search --sizes 10000 100000 1000000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+# Настраивает окружение, поэтому подключается до модулей приложения
+from benchmarks.common import RESULTS_DIR, get_commit
+from database.database import Base, Users, async_session, engine
+from database.models import TWEETS_PAGE_SIZE, search_tweets_in_db
+
+# Размер словаря и количество слов в твите
+VOCABULARY_SIZE: int = 20000
+WORDS_PER_TWEET: int = 12
+# Номер страницы для сценария глубокой страницы
+DEEP_PAGE: int = 5
+
+# Твиты из случайных слов словаря: чем меньше номер слова, тем оно чаще
+# (степень случайного числа смещает выбор к началу словаря)
+GENERATE_TWEETS_QUERY: str = """
+INSERT INTO tweets (tweet, author_id)
+SELECT (
+    SELECT string_agg(
+        (CAST(:words AS text[]))[1 + floor(power(random(), 3) * :vocabulary)::int],
+        ' '
+    )
+    FROM generate_series(1, :words_per_tweet)
+    WHERE g.i > 0
+), 1
+FROM generate_series(1, :count) AS g(i)
+"""
+
+
+def build_vocabulary(random_seed: int) -> List[str]:
+    """Функция создающая словарь из неповторяющихся псевдослов"""
+    rng: random.Random = random.Random(random_seed)
+    syllables: List[str] = [
+        i_consonant + i_vowel for i_consonant in "bdfgklmnprstvz" for i_vowel in "aeiou"
+    ]
+    words: Dict[str, None] = dict()
+
+    while len(words) < VOCABULARY_SIZE:
+        words["".join(rng.choices(syllables, k=rng.randint(2, 4)))] = None
+
+    return list(words)
+
+
+def get_queries(words: List[str]) -> Dict[str, str]:
+    """Функция возвращающая поисковые запросы сценариев"""
+    return {
+        "common_term": words[0],
+        "medium_term": words[200],
+        "rare_term": words[-1],
+        "two_terms": "{} {}".format(words[50], words[300]),
+        "phrase": '"{} {}"'.format(words[1], words[2]),
+        "excluded_term": "{} -{}".format(words[10], words[0]),
+    }
+
+
+async def fill_corpus(size: int, words: List[str]) -> float:
+    """
+    Корутин пересоздающий таблицы и заполняющий их твитами
+    :param size: Количество твитов
+    :type size: int
+    :param words: Словарь
+    :type words: List[str]
+    :return: Время заполнения, в секундах
+    :rtype: float
+    """
+    start: float = time.perf_counter()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            Users.__table__.insert().values(id=1, user="search", api_key="search")
+        )
+        await conn.execute(text("SELECT setseed(0.42)"))
+        await conn.execute(
+            text(GENERATE_TWEETS_QUERY),
+            {
+                "words": words,
+                "vocabulary": len(words),
+                "words_per_tweet": WORDS_PER_TWEET,
+                "count": size,
+            },
+        )
+
+    # Переносим список ожидания в индекс и обновляем статистику
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM ANALYZE tweets"))
+
+    return time.perf_counter() - start
+
+
+async def measure(
+    query: str, cursor: Tuple[float, int] | None, repeat: int
+) -> Tuple[List[float], int]:
+    """
+    Корутин выполняющий поиск repeat раз
+    :return: Время каждого поиска в секундах и количество твитов на странице
+    :rtype: Tuple[List[float], int]
+    """
+    latencies: List[float] = list()
+    found: int = 0
+
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        async with async_session() as session:
+            tweets, _ = await search_tweets_in_db(
+                session, user_id=1, text_query=query, cursor=cursor
+            )
+        latencies.append(time.perf_counter() - start)
+        found = len(tweets)
+
+    return latencies, found
+
+
+async def get_deep_cursor(query: str) -> Tuple[float, int] | None:
+    """Корутин возвращающий курсор страницы DEEP_PAGE"""
+    cursor: Tuple[float, int] | None = None
+
+    for _ in range(DEEP_PAGE - 1):
+        async with async_session() as session:
+            _, next_cursor = await search_tweets_in_db(
+                session, user_id=1, text_query=query, cursor=cursor
+            )
+        if next_cursor is None:
+            return cursor
+
+        rank, tweet_id = next_cursor.split(":")
+        cursor = (float(rank), int(tweet_id))
+
+    return cursor
+
+
+async def count_matches(query: str) -> int:
+    """Корутин считающий все твиты, подходящие под запрос"""
+    async with engine.connect() as conn:
+        return await conn.scalar(
+            text(
+                "SELECT count(*) FROM tweets "
+                "WHERE search_vector @@ websearch_to_tsquery('simple', :query)"
+            ),
+            {"query": query},
+        )
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    """Корутин выполняющий замеры для всех размеров корпуса"""
+    words: List[str] = build_vocabulary(args.seed)
+    queries: Dict[str, str] = get_queries(words)
+    results: Dict[str, Dict] = dict()
+
+    for i_size in args.sizes:
+        fill_seconds: float = await fill_corpus(i_size, words)
+        print("corpus {}: filled in {:.1f}s".format(i_size, fill_seconds))
+        size_results: Dict[str, Dict] = dict()
+
+        scenarios: List[Tuple[str, str, Tuple[float, int] | None]] = [
+            (i_name, i_query, None) for i_name, i_query in queries.items()
+        ]
+        scenarios.append(
+            (
+                "common_term_page_{}".format(DEEP_PAGE),
+                queries["common_term"],
+                await get_deep_cursor(queries["common_term"]),
+            )
+        )
+
+        for i_name, i_query, i_cursor in scenarios:
+            # Прогрев: кэш страниц индекса и планов запросов
+            await measure(i_query, i_cursor, args.warmup)
+            latencies, found = await measure(i_query, i_cursor, args.repeat)
+            percentiles: List[float] = statistics.quantiles(latencies, n=100)
+
+            size_results[i_name] = {
+                "query": i_query,
+                "matches": await count_matches(i_query),
+                "page_size": found,
+                "p50_ms": round(percentiles[49] * 1000, 2),
+                "p95_ms": round(percentiles[94] * 1000, 2),
+                "p99_ms": round(percentiles[98] * 1000, 2),
+            }
+            print(
+                "  {:<22} {matches:>9} matches  p50 {p50_ms:>8} ms  "
+                "p95 {p95_ms:>8} ms  p99 {p99_ms:>8} ms".format(
+                    i_name, **size_results[i_name]
+                )
+            )
+
+        results[str(i_size)] = {
+            "fill_seconds": round(fill_seconds, 1),
+            "queries": size_results,
+        }
+
+    await engine.dispose()
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "vocabulary": VOCABULARY_SIZE,
+        "words_per_tweet": WORDS_PER_TWEET,
+        "page_size": TWEETS_PAGE_SIZE,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000], help="corpus sizes"
+    )
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--output", help="result file (JSON)")
+    args = parser.parse_args()
+
+    result: Dict = asyncio.run(run(args))
+
+    output: str = args.output or os.path.join(
+        RESULTS_DIR, "{}-search.json".format(result["commit"])
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print("saved {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Заполнение тестовой БД синтетическими данными для бенчмарков.
+ВНИМАНИЕ: все таблицы тестовой БД (TEST_DB_* из .env) пересоздаются.
+
+Запуск из корня проекта:
+    python -m benchmarks.seed --scale small
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import random
+import time
+from typing import Dict, Iterable, Iterator, List, Set
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# Настраивает окружение, поэтому подключается до модулей приложения
+from benchmarks.common import SCALES, Scale, get_api_key
+from database.database import (
+    Base,
+    Media,
+    Tweets,
+    Users,
+    engine,
+    integration_followers,
+    integration_like,
+)
+from database.models import FANOUT_MAX_FOLLOWERS, get_media_path
+
+# Количество строк в одном INSERT
+BATCH_SIZE: int = 5000
+
+
+def batched(
+    rows: Iterable[Dict], size: int = BATCH_SIZE
+) -> Iterator[List[Dict]]:
+    """Функция разбивающая строки на пачки по size штук"""
+    iterator: Iterator[Dict] = iter(rows)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+async def insert_rows(
+    conn: AsyncConnection, table, rows: Iterable[Dict]
+) -> int:
+    """
+    Корутин записывающий строки в таблицу пачками
+    :param conn: Соединение с БД
+    :type conn: AsyncConnection
+    :param table: Таблица или модель
+    :param rows: Строки таблицы
+    :type rows: Iterable[Dict]
+    :return: Количество записанных строк
+    :rtype: int
+    """
+    count: int = 0
+    for i_batch in batched(rows):
+        await conn.execute(insert(table), i_batch)
+        count += len(i_batch)
+
+    return count
+
+
+def get_media_row(media_id: int, tweet_id: int) -> Dict:
+    """Функция возвращающая запись Media (файла на диске нет, для чтения не нужен)"""
+    content_hash: str = hashlib.sha256(str(tweet_id).encode()).hexdigest()
+
+    return {
+        "id": media_id,
+        "media_path": get_media_path(content_hash, "jpg"),
+        "content_hash": content_hash,
+        "tweet_id": tweet_id,
+    }
+
+
+def generate_follows(scale: Scale, rng: random.Random) -> Dict[int, Set[int]]:
+    """
+    Функция генерирующая подписки: популярность авторов распределена по Ципфу,
+    чтобы у нескольких пользователей было очень много подписчиков
+    :return: id пользователя -> id тех, на кого он подписан
+    :rtype: Dict[int, Set[int]]
+    """
+    user_ids: List[int] = list(range(1, scale.users + 1))
+    weights: List[float] = [1 / i_rank for i_rank in user_ids]
+    follows_per_user: int = min(scale.follows_per_user, scale.users - 1)
+
+    follows: Dict[int, Set[int]] = dict()
+    for i_user_id in user_ids:
+        following: Set[int] = set()
+        while len(following) < follows_per_user:
+            author_id: int = rng.choices(user_ids, weights=weights)[0]
+            if author_id != i_user_id:
+                following.add(author_id)
+        follows[i_user_id] = following
+
+    return follows
+
+
+async def seed(scale_name: str, random_seed: int) -> None:
+    """
+    Корутин пересоздающий таблицы и заполняющий их синтетическими данными
+    :param scale_name: Название набора данных из SCALES
+    :type scale_name: str
+    :param random_seed: Зерно генератора, одинаковое зерно - одинаковые данные
+    :type random_seed: int
+    :return: Ничего не возвращает
+    :rtype: None
+    """
+    scale: Scale = SCALES[scale_name]
+    rng: random.Random = random.Random(random_seed)
+    start: float = time.perf_counter()
+
+    follows: Dict[int, Set[int]] = generate_follows(scale, rng)
+    followers_count: Dict[int, int] = dict.fromkeys(follows, 0)
+    for i_following in follows.values():
+        for i_author_id in i_following:
+            followers_count[i_author_id] += 1
+
+    # Твиты пользователей перемешаны по времени: id растут по кругу
+    tweets_count: int = scale.users * scale.tweets_per_user
+    likes_per_tweet: int = min(scale.likes_per_tweet, scale.users)
+    like_users: Dict[int, List[int]] = {
+        i_tweet_id: rng.sample(range(1, scale.users + 1), likes_per_tweet)
+        for i_tweet_id in range(1, tweets_count + 1)
+    }
+    media_tweet_ids: List[int] = [
+        i_tweet_id
+        for i_tweet_id in range(1, tweets_count + 1)
+        if rng.random() < scale.media_ratio
+    ]
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+        await insert_rows(
+            conn,
+            Users,
+            (
+                {
+                    "id": i_user_id,
+                    "user": "user_{}".format(i_user_id),
+                    "api_key": get_api_key(i_user_id),
+                    "merge_on_read": followers_count[i_user_id]
+                    > FANOUT_MAX_FOLLOWERS,
+                    "followers_count": followers_count[i_user_id],
+                    "following_count": len(follows[i_user_id]),
+                }
+                for i_user_id in follows
+            ),
+        )
+        await insert_rows(
+            conn,
+            Tweets,
+            (
+                {
+                    "id": i_tweet_id,
+                    "tweet": "Synthetic tweet number {}".format(i_tweet_id),
+                    "author_id": (i_tweet_id - 1) % scale.users + 1,
+                    "like_count": likes_per_tweet,
+                }
+                for i_tweet_id in range(1, tweets_count + 1)
+            ),
+        )
+        await insert_rows(
+            conn,
+            integration_followers,
+            (
+                {"user_id": i_user_id, "following_id": i_author_id}
+                for i_user_id, i_following in follows.items()
+                for i_author_id in i_following
+            ),
+        )
+        await insert_rows(
+            conn,
+            integration_like,
+            (
+                {"tweet_id": i_tweet_id, "user_id": i_user_id}
+                for i_tweet_id, i_user_ids in like_users.items()
+                for i_user_id in i_user_ids
+            ),
+        )
+        await insert_rows(
+            conn,
+            Media,
+            (
+                get_media_row(i_media_id, i_tweet_id)
+                for i_media_id, i_tweet_id in enumerate(media_tweet_ids, start=1)
+            ),
+        )
+
+        # Ленты: свои твиты и твиты авторов, которым твиты рассылаются при записи
+        await conn.execute(
+            text(
+                "INSERT INTO timeline (user_id, tweet_id, author_id) "
+                "SELECT author_id, id, author_id FROM tweets"
+            )
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO timeline (user_id, tweet_id, author_id) "
+                "SELECT f.user_id, t.id, t.author_id FROM followers f "
+                "JOIN users u ON u.id = f.following_id AND NOT u.merge_on_read "
+                "JOIN tweets t ON t.author_id = f.following_id"
+            )
+        )
+
+        # Id заданы явно, поэтому сдвигаем последовательности
+        for i_table in ("users", "tweets", "media"):
+            await conn.execute(
+                text(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "(SELECT coalesce(max(id), 0) + 1 FROM {0}), false)".format(
+                        i_table
+                    )
+                )
+            )
+
+    # Обновляем статистику планировщика
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE"))
+
+    await engine.dispose()
+
+    print(
+        "seeded {}: {} users, {} tweets, {} follows, {} likes, {} media "
+        "in {:.1f}s".format(
+            scale_name,
+            scale.users,
+            tweets_count,
+            sum(len(i_following) for i_following in follows.values()),
+            tweets_count * likes_per_tweet,
+            len(media_tweet_ids),
+            time.perf_counter() - start,
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    asyncio.run(seed(args.scale, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Замер процессорного времени на сериализацию страницы ленты.
+Сравнивается путь FastAPI по умолчанию (проверка response_model в pydantic,
+jsonable_encoder и json.dumps в JSONResponse) с ответом fast_response
+(orjson без проверки и с проверкой схемы, как в тестах).
+БД не нужна: страница ленты собирается из синтетических данных.
+
+Запуск из корня проекта:
+    python -m benchmarks.serialization --tweets 50 --likes 20
+"""
+import argparse
+import json
+import time
+from typing import Callable, Dict
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+# Настраивает окружение, поэтому подключается до модулей приложения
+from benchmarks import common
+from shemas import BaseTweetsGetOut
+
+
+def build_page(tweets: int, likes: int, attachments: int) -> Dict:
+    """Функция собирающая ответ GET /api/tweets так же, как models.py"""
+    return {
+        "result": True,
+        "tweets": [
+            {
+                "id": i_tweet_id,
+                "content": "Synthetic tweet number {}".format(i_tweet_id),
+                "attachments": [
+                    "user_post_images/ab/cd/{:064x}.jpg".format(i_tweet_id + i)
+                    for i in range(attachments)
+                ],
+                "author": {"id": 1, "name": "user_1"},
+                "likes": [
+                    {"user_id": i_user_id, "name": "user_{}".format(i_user_id)}
+                    for i_user_id in range(likes)
+                ],
+            }
+            for i_tweet_id in range(tweets, 0, -1)
+        ],
+    }
+
+
+def default_path(content: Dict) -> bytes:
+    """Ответ по умолчанию: проверка response_model и стандартный JSON"""
+    validated = BaseTweetsGetOut.parse_obj(content)
+    return JSONResponse(content=jsonable_encoder(validated)).body
+
+
+def fast_path(content: Dict) -> bytes:
+    """fast_response без проверки схемы (рабочее окружение)"""
+    return ORJSONResponse(content=content).body
+
+
+def fast_validated_path(content: Dict) -> bytes:
+    """fast_response с проверкой схемы (тесты)"""
+    validated = BaseTweetsGetOut.parse_obj(content)
+    return ORJSONResponse(content=validated.dict()).body
+
+
+def measure(func: Callable[[Dict], bytes], content: Dict, repeat: int) -> float:
+    """
+    Функция замеряющая процессорное время одного вызова
+    :return: Время в миллисекундах
+    :rtype: float
+    """
+    # Прогрев
+    for _ in range(min(repeat, 10)):
+        func(content)
+
+    start: float = time.process_time()
+    for _ in range(repeat):
+        func(content)
+
+    return (time.process_time() - start) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tweets", type=int, default=50, help="tweets per page")
+    parser.add_argument("--likes", type=int, default=20, help="likes per tweet")
+    parser.add_argument("--attachments", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output", help="result file (JSON)")
+    args = parser.parse_args()
+
+    content: Dict = build_page(args.tweets, args.likes, args.attachments)
+    # Все пути должны отдавать один и тот же JSON
+    assert json.loads(default_path(content)) == json.loads(fast_path(content))
+
+    results: Dict[str, float] = {
+        i_name: round(measure(i_func, content, args.repeat), 3)
+        for i_name, i_func in (
+            ("default", default_path),
+            ("fast", fast_path),
+            ("fast_validated", fast_validated_path),
+        )
+    }
+
+    for i_name, i_ms in results.items():
+        print(
+            "{:<15} {:>8} ms CPU per response  (x{:.1f})".format(
+                i_name, i_ms, results["default"] / i_ms
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": common.get_commit(),
+                    "page": vars(args),
+                    "cpu_ms_per_response": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
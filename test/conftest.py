@@ -4,6 +4,7 @@ from typing import AsyncGenerator
 
 import pytest
 import pytest_asyncio
+from dotenv import load_dotenv
 from httpx import AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
@@ -11,6 +12,21 @@ from sqlalchemy.pool import NullPool
 
 # Тесты работают только если отправить переменную окружения, до подключения модулей
 os.environ["ENV"] = "test"
+# Фоновая обработка картинок в тестах отключена
+os.environ["IMAGE_WORKERS"] = "0"
+# Статистика SQL-запросов в заголовках ответа
+os.environ["DB_DEBUG_HEADERS"] = "true"
+# Ответы проверяются по схемам pydantic
+os.environ["VALIDATE_RESPONSES"] = "true"
+# Кэш ответов в памяти процесса: все тесты проверяют сброс ответов при изменениях
+os.environ["RESPONSE_CACHE"] = "local"
+# Реплика для чтения - та же тестовая БД (другой пул соединений), так проверяется
+# маршрутизация запросов. Для проверки с настоящей репликой адрес задаётся в .env
+load_dotenv()
+os.environ.setdefault(
+    "TEST_DB_REPLICA_HOSTS",
+    "{}:{}".format(os.getenv("TEST_DB_HOST"), os.getenv("TEST_DB_PORT")),
+)
 
 from app.database.database import Base
 from app.main import app
@@ -1,9 +1,50 @@
+import asyncio
+import hashlib
+import io
+import os
+import uuid
+
 import pytest
-from app.database.database import Users
+from app.database.database import Media, Tweets, Users, integration_followers
+from app.main import MULTIPART_OVERHEAD
+from database.bulk import export_file, import_file
+from database.database import get_engine_options, transaction
+from database.events import EventHub, event_hub
+from database.images import get_variant_path, shutdown_image_pool
+from database.leader import run_as_leader, startup_lock
+from database.like_buffer import like_buffer
+from database.media_gc import collect_media_garbage
+from database.migrations import (
+    MIGRATIONS,
+    SCHEMA_VERSION,
+    backfill_timelines,
+    get_schema_version,
+    migrate,
+)
+from database.models import (
+    MEDIA_MAX_UPLOAD_SIZE,
+    MEDIA_ROOT,
+    TWEET_ID_MAX,
+    UPLOADS_TMP_DIR_PATH,
+    USERS_BATCH_SIZE_MAX,
+    detect_image_extension,
+    get_media_path,
+    lock_media_path,
+    process_image_variants,
+    update_image_tweet_id,
+)
+from database.response_cache import (
+    LocalRespServer,
+    RespCacheBackend,
+    response_cache,
+)
+from database.timeline import InMemoryTimelineStore, PostgresTimelineStore
 from httpx import AsyncClient
+from prometheus_client import REGISTRY
+from sqlalchemy import insert, text
 from sqlalchemy.future import select
 
-from conftest import ac, async_session_maker_test
+from conftest import ac, async_session_maker_test, engine_test
 
 
 async def test_add_user_to_db():
@@ -26,21 +67,37 @@ async def test_add_user_to_db():
         result_json = [i.to_json() for i in results]
 
         users_json = [
-            {"id": 1, "user": "Pytest", "api_key": "pytest"},
+            {
+                "id": 1,
+                "user": "Pytest",
+                "api_key": "pytest",
+                "merge_on_read": False,
+                "followers_count": 0,
+                "following_count": 0,
+            },
             {
                 "id": 2,
                 "user": "Josh",
                 "api_key": "a5c69a74-00e6-4f9b-8ba9-ee5e51f1aef1",
+                "merge_on_read": False,
+                "followers_count": 0,
+                "following_count": 0,
             },
             {
                 "id": 3,
                 "user": "Ricardo",
                 "api_key": "0f977897-5efc-4d16-8648-d50722ac988b",
+                "merge_on_read": False,
+                "followers_count": 0,
+                "following_count": 0,
             },
             {
                 "id": 4,
                 "user": "Comedian",
                 "api_key": "a41efa05-303b-486d-bec7-3fe50533035b",
+                "merge_on_read": False,
+                "followers_count": 0,
+                "following_count": 0,
             },
         ]
 
@@ -232,6 +289,16 @@ async def test_tweet_delete(ac: AsyncClient):
     assert response_tweet_delete.json() == expected_response_tweet_delete
 
 
+async def test_tweet_delete_not_found(ac: AsyncClient):
+    """Тест на удаление несуществующего (уже удалённого) твита"""
+    response_tweet_delete = await ac.delete(
+        "/api/tweets/1", headers={"Api-Key": "pytest"}
+    )
+
+    assert response_tweet_delete.status_code == 404
+    assert response_tweet_delete.json()["error_type"] == "NotFound"
+
+
 async def test_user_like_post(ac: AsyncClient):
     """Тест на добавление лайка"""
     tweet = {
@@ -295,3 +362,1258 @@ async def test_user_like_delete(ac: AsyncClient):
 
     assert response_tweet.status_code == 200
     assert response_tweet.json() == expected_response_tweet
+
+
+async def test_tweets_get_pagination(ac: AsyncClient):
+    """Тест на постраничное получение твитов по курсору"""
+    tweet = {"tweet_data": "Pagination", "tweet_media_ids": []}
+
+    for _ in range(2):
+        await ac.post("/api/tweets", headers={"Api-Key": "pytest"}, json=tweet)
+
+    response_first_page = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest"}, params={"limit": 2}
+    )
+    response_second_page = await ac.get(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        params={"limit": 2, "cursor": response_first_page.headers["X-Next-Cursor"]},
+    )
+
+    assert response_first_page.status_code == 200
+    assert [i["id"] for i in response_first_page.json()["tweets"]] == [4, 3]
+    assert response_first_page.headers["X-Next-Cursor"] == "3"
+
+    assert response_second_page.status_code == 200
+    assert [i["id"] for i in response_second_page.json()["tweets"]] == [2]
+    assert "X-Next-Cursor" not in response_second_page.headers
+
+
+async def test_tweets_get_following(ac: AsyncClient):
+    """Тест на получение ленты только из подписок и своих твитов"""
+    tweet = {"tweet_data": "Following", "tweet_media_ids": []}
+
+    # Твит пользователя, на которого Pytest не подписан
+    await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "a41efa05-303b-486d-bec7-3fe50533035b"},
+        json=tweet,
+    )
+    # Твит пользователя, на которого Pytest подписан
+    await ac.post("/api/users/3/follow", headers={"Api-Key": "pytest"})
+    await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "0f977897-5efc-4d16-8648-d50722ac988b"},
+        json=tweet,
+    )
+
+    response_following = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest"}, params={"following": True}
+    )
+    response_all = await ac.get("/api/tweets", headers={"Api-Key": "pytest"})
+
+    # После отписки твиты автора убираются из ленты
+    await ac.delete("/api/users/3/follow", headers={"Api-Key": "pytest"})
+    response_unfollowed = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest"}, params={"following": True}
+    )
+
+    assert response_following.status_code == 200
+    assert [i["id"] for i in response_following.json()["tweets"]] == [6, 4, 3, 2]
+
+    assert response_unfollowed.status_code == 200
+    assert [i["id"] for i in response_unfollowed.json()["tweets"]] == [4, 3, 2]
+
+    assert response_all.status_code == 200
+    assert [i["id"] for i in response_all.json()["tweets"]] == [6, 5, 4, 3, 2]
+
+
+async def test_tweets_get_limit_validation(ac: AsyncClient):
+    """Тест на ограничение размера страницы"""
+    response = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest"}, params={"limit": 0}
+    )
+
+    assert response.status_code == 422
+
+
+async def test_auth_cache_metrics(ac: AsyncClient):
+    """Тест на кэширование авторизации и метрики кэша"""
+    await ac.get("/api/users/me", headers={"Api-Key": "pytest"})
+    await ac.get("/api/users/me", headers={"Api-Key": "pytest"})
+
+    response_metrics = await ac.get("/metrics")
+
+    assert response_metrics.status_code == 200
+    assert "auth_cache_hits_total" in response_metrics.text
+    assert "auth_cache_misses_total" in response_metrics.text
+
+
+async def test_compact_responses(ac: AsyncClient):
+    """Тест на компактные ответы со счётчиками вместо списков"""
+    await ac.post(
+        "/api/tweets/4/likes",
+        headers={"Api-Key": "0f977897-5efc-4d16-8648-d50722ac988b"},
+    )
+    await ac.post("/api/users/2/follow", headers={"Api-Key": "pytest"})
+
+    response_tweets = await ac.get(
+        "/api/tweets",
+        headers={"Api-Key": "0f977897-5efc-4d16-8648-d50722ac988b"},
+        params={"compact": True, "cursor": 5, "limit": 1},
+    )
+    expected_response_tweets = {
+        "result": True,
+        "tweets": [
+            {
+                "id": 4,
+                "content": "Pagination",
+                "attachments": [],
+                "author": {"id": 1, "name": "Pytest"},
+                "like_count": 1,
+                "liked": True,
+            }
+        ],
+    }
+
+    response_profile = await ac.get(
+        "/api/users/me", headers={"Api-Key": "pytest"}, params={"compact": True}
+    )
+    expected_response_profile = {
+        "result": True,
+        "user": {
+            "id": 1,
+            "name": "Pytest",
+            "followers_count": 0,
+            "following_count": 1,
+        },
+    }
+
+    # Повторная подписка не меняет счётчики
+    await ac.post("/api/users/2/follow", headers={"Api-Key": "pytest"})
+    response_following = await ac.get("/api/users/2", params={"compact": True})
+
+    await ac.delete(
+        "/api/tweets/4/likes",
+        headers={"Api-Key": "0f977897-5efc-4d16-8648-d50722ac988b"},
+    )
+    await ac.delete("/api/users/2/follow", headers={"Api-Key": "pytest"})
+    response_unfollowed = await ac.get("/api/users/2", params={"compact": True})
+
+    assert response_tweets.status_code == 200
+    assert response_tweets.json() == expected_response_tweets
+
+    assert response_profile.status_code == 200
+    assert response_profile.json() == expected_response_profile
+
+    assert response_following.json()["user"]["followers_count"] == 1
+    assert response_unfollowed.json()["user"]["followers_count"] == 0
+
+
+@pytest.mark.parametrize("method", ["POST", "DELETE"])
+async def test_like_not_found(ac: AsyncClient, method: str):
+    """Тест на лайк несуществующего твита"""
+    response = await ac.request(
+        method, "/api/tweets/222/likes", headers={"Api-Key": "pytest"}
+    )
+    expected_response = {
+        "result": False,
+        "error_type": "NotFound",
+        "error_message": "Tweet not found",
+    }
+
+    assert response.status_code == 404
+    assert response.json() == expected_response
+
+
+@pytest.mark.parametrize("method", ["POST", "DELETE"])
+async def test_following_not_found(ac: AsyncClient, method: str):
+    """Тест на подписку на несуществующего пользователя"""
+    response = await ac.request(
+        method, "/api/users/222/follow", headers={"Api-Key": "pytest"}
+    )
+    expected_response = {
+        "result": False,
+        "error_type": "NotFound",
+        "error_message": "User not found",
+    }
+
+    assert response.status_code == 404
+    assert response.json() == expected_response
+
+
+async def test_media_post_too_large(ac: AsyncClient):
+    """Тест на отказ в загрузке слишком большого файла"""
+    response = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.jpg", b"0" * (MEDIA_MAX_UPLOAD_SIZE + 64 * 1024))},
+    )
+    expected_response = {
+        "result": False,
+        "error_type": "FileTooLarge",
+        "error_message": "File is larger than {} bytes".format(
+            MEDIA_MAX_UPLOAD_SIZE
+        ),
+    }
+
+    assert response.status_code == 413
+    assert response.json() == expected_response
+
+
+async def test_media_post_too_large_streamed(ac: AsyncClient):
+    """
+    Тест на отказ в загрузке файла, который больше лимита, когда Content-Length
+    запроса проходит проверку middleware: запись прерывается по ходу загрузки
+    """
+    os.makedirs(UPLOADS_TMP_DIR_PATH, exist_ok=True)
+    tmp_files_before = set(os.listdir(UPLOADS_TMP_DIR_PATH))
+    content: bytes = b"\x89PNG\r\n\x1a\n" + b"0" * MEDIA_MAX_UPLOAD_SIZE
+
+    response = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+
+    assert int(response.request.headers["content-length"]) <= (
+        MEDIA_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD
+    )
+    assert response.status_code == 413
+    assert response.json()["error_type"] == "FileTooLarge"
+    # Недописанный временный файл удалён
+    assert set(os.listdir(UPLOADS_TMP_DIR_PATH)) == tmp_files_before
+
+
+async def test_db_pool_metrics(ac: AsyncClient):
+    """Тест на метрики пула соединений с БД"""
+    await ac.get("/api/tweets", headers={"Api-Key": "pytest"})
+
+    response_metrics = await ac.get("/metrics")
+
+    assert response_metrics.status_code == 200
+    assert "db_pool_checked_out" in response_metrics.text
+    assert "db_pool_acquire_seconds_count" in response_metrics.text
+
+
+async def test_db_request_metrics(ac: AsyncClient):
+    """Тест на статистику SQL-запросов по маршрутам"""
+    response = await ac.get("/api/users/2")
+
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Queries"]) >= 1
+    assert "X-DB-Time" in response.headers
+    assert "FROM users" in response.headers["X-DB-Slowest"]
+
+    response_metrics = await ac.get("/metrics")
+    metric: str = 'db_request_queries_count{handler="/api/users/{id}",method="GET"}'
+
+    assert metric in response_metrics.text
+
+
+async def test_user_etag(ac: AsyncClient):
+    """Тест на условный GET профиля: 304 без чтения профиля, пока нет изменений"""
+    response = await ac.get("/api/users/2")
+    etag: str = response.headers["ETag"]
+
+    response_not_modified = await ac.get(
+        "/api/users/2", headers={"If-None-Match": etag}
+    )
+
+    assert response_not_modified.status_code == 304
+    assert response_not_modified.headers["ETag"] == etag
+    # Только запрос счётчика изменений
+    assert response_not_modified.headers["X-DB-Queries"] == "1"
+
+    # Подписка меняет профиль
+    await ac.post("/api/users/2/follow", headers={"Api-Key": "pytest"})
+    response_modified = await ac.get(
+        "/api/users/2", headers={"If-None-Match": etag}
+    )
+
+    assert response_modified.status_code == 200
+    assert response_modified.headers["ETag"] != etag
+
+    await ac.delete("/api/users/2/follow", headers={"Api-Key": "pytest"})
+
+
+async def test_tweets_etag(ac: AsyncClient):
+    """Тест на условный GET ленты: лайк меняет версию ленты"""
+    response = await ac.get("/api/tweets", headers={"Api-Key": "pytest"})
+    etag: str = response.headers["ETag"]
+
+    response_not_modified = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest", "If-None-Match": etag}
+    )
+
+    assert response_not_modified.status_code == 304
+
+    # Другие параметры страницы - другая версия
+    response_compact = await ac.get(
+        "/api/tweets",
+        headers={"Api-Key": "pytest", "If-None-Match": etag},
+        params={"compact": True},
+    )
+
+    assert response_compact.status_code == 200
+
+    await ac.post("/api/tweets/4/likes", headers={"Api-Key": "pytest"})
+    response_modified = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest", "If-None-Match": etag}
+    )
+
+    assert response_modified.status_code == 200
+
+    await ac.delete("/api/tweets/4/likes", headers={"Api-Key": "pytest"})
+
+
+async def test_shared_response_cache(ac: AsyncClient):
+    """Тест на общий кэш ответов через сервер RESP: изменения сбрасывают ответы"""
+    server: LocalRespServer = LocalRespServer()
+    port: int = await server.start()
+    local_backend = response_cache.backend
+    response_cache.backend = RespCacheBackend("127.0.0.1", port)
+
+    try:
+        response_first = await ac.get("/api/users/3")
+        response_cached = await ac.get("/api/users/3")
+
+        await ac.post("/api/users/3/follow", headers={"Api-Key": "pytest"})
+        response_followed = await ac.get("/api/users/3")
+
+        await ac.delete("/api/users/3/follow", headers={"Api-Key": "pytest"})
+        response_unfollowed = await ac.get("/api/users/3")
+    finally:
+        await response_cache.close()
+        response_cache.backend = local_backend
+        await server.close()
+
+    assert response_cached.json() == response_first.json()
+    # Профиль из кэша: только запрос счётчика изменений для ETag
+    assert response_cached.headers["X-DB-Queries"] == "1"
+
+    assert response_followed.json()["user"]["followers"] == [
+        {"id": 1, "name": "Pytest"}
+    ]
+    assert response_unfollowed.json() == response_first.json()
+
+
+async def test_schema_migrations():
+    """Тест на миграции: применяются один раз, повторный запуск только проверяет версию"""
+    applied: int = await migrate(engine_test)
+    applied_again: int = await migrate(engine_test)
+
+    async with engine_test.connect() as connection:
+        version: int = await get_schema_version(connection)
+        api_key_index: str | None = await connection.scalar(
+            text("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_users_api_key'")
+        )
+
+    assert applied == len(MIGRATIONS)
+    assert applied_again == 0
+    assert version == SCHEMA_VERSION
+    assert api_key_index.startswith("CREATE UNIQUE INDEX")
+
+
+async def test_bulk_import_export(ac: AsyncClient, tmp_path):
+    """Тест на массовый импорт и экспорт: счётчики, повторный импорт и экспорт"""
+    users_path = tmp_path / "users.ndjson"
+    users_path.write_text(
+        '{"id": 100, "name": "Bulk", "api_key": "bulk-100"}\n'
+        '{"id": 101, "name": "Import", "api_key": "bulk-101"}\n'
+    )
+    follows_path = tmp_path / "follows.csv"
+    follows_path.write_text("user_id,following_id\n100,101\n101,100\n100,101\n")
+
+    users_result = await import_file("users", str(users_path), batch_size=1)
+    follows_result = await import_file("follows", str(follows_path))
+    # Повторный импорт ничего не добавляет
+    follows_again_result = await import_file("follows", str(follows_path))
+
+    response = await ac.get("/api/users/100", params={"compact": True})
+
+    export_path = tmp_path / "follows.ndjson"
+    exported: int = await export_file("follows", str(export_path))
+
+    assert users_result == (2, 2)
+    assert follows_result == (3, 2)
+    assert follows_again_result == (3, 0)
+    # Контрольные точки удаляются после завершения
+    assert not (tmp_path / "users.ndjson.checkpoint").exists()
+
+    assert response.json()["user"] == {
+        "id": 100,
+        "name": "Bulk",
+        "followers_count": 1,
+        "following_count": 1,
+    }
+
+    assert exported == 2
+    assert export_path.read_text().splitlines() == [
+        '{"user_id":100,"following_id":101}',
+        '{"user_id":101,"following_id":100}',
+    ]
+
+
+async def test_tweets_search(ac: AsyncClient):
+    """Тест на полнотекстовый поиск: порядок по релевантности и страницы по курсору"""
+    tweets = [
+        "Searchable quokka",
+        "Searchable quokka meets another quokka",
+        "Nothing to find here",
+    ]
+    for i_tweet in tweets:
+        await ac.post(
+            "/api/tweets",
+            headers={"Api-Key": "pytest"},
+            json={"tweet_data": i_tweet, "tweet_media_ids": []},
+        )
+
+    response_first = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "pytest"},
+        params={"q": "quokka", "limit": 1},
+    )
+    response_second = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "pytest"},
+        params={
+            "q": "quokka",
+            "limit": 1,
+            "cursor": response_first.headers["X-Next-Cursor"],
+        },
+    )
+    response_phrase = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "pytest"},
+        params={"q": '"meets another" -nothing'},
+    )
+    response_bad_cursor = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "pytest"},
+        params={"q": "quokka", "cursor": "1e999:1"},
+    )
+    response_big_cursor = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "pytest"},
+        params={"q": "quokka", "cursor": "1.0:{}".format(TWEET_ID_MAX + 1)},
+    )
+    response_unauthorized = await ac.get(
+        "/api/tweets/search",
+        headers={"Api-Key": "no_such_key_exists"},
+        params={"q": "quokka"},
+    )
+
+    # Твит с двумя вхождениями слова релевантнее
+    assert response_first.status_code == 200
+    assert [i_tweet["content"] for i_tweet in response_first.json()["tweets"]] == [
+        tweets[1]
+    ]
+
+    assert [i_tweet["content"] for i_tweet in response_second.json()["tweets"]] == [
+        tweets[0]
+    ]
+    assert "X-Next-Cursor" not in response_second.headers
+
+    assert [i_tweet["content"] for i_tweet in response_phrase.json()["tweets"]] == [
+        tweets[1]
+    ]
+
+    assert response_bad_cursor.status_code == 422
+    assert response_bad_cursor.json()["error_type"] == "InvalidCursor"
+    assert response_big_cursor.status_code == 422
+    assert response_big_cursor.json()["error_type"] == "InvalidCursor"
+
+    assert response_unauthorized.status_code == 401
+
+
+async def test_tweets_cursor_out_of_range(ac: AsyncClient):
+    """Тест на курсор ленты больше максимального id твита"""
+    response_tweets = await ac.get(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        params={"cursor": TWEET_ID_MAX + 1},
+    )
+
+    assert response_tweets.status_code == 422
+
+
+async def test_like_buffer(ac: AsyncClient):
+    """Тест на буфер лайков: параллельные лайки одной пачкой и сворачивание операций"""
+    api_keys = [
+        "pytest",
+        "a5c69a74-00e6-4f9b-8ba9-ee5e51f1aef1",
+        "0f977897-5efc-4d16-8648-d50722ac988b",
+        "a41efa05-303b-486d-bec7-3fe50533035b",
+    ]
+    response_tweet_post = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={"tweet_data": "Like buffer", "tweet_media_ids": []},
+    )
+    tweet_id: int = response_tweet_post.json()["tweet_id"]
+
+    responses_like = await asyncio.gather(
+        *(
+            ac.post("/api/tweets/{}/likes".format(tweet_id), headers={"Api-Key": i_key})
+            for i_key in api_keys
+        ),
+        ac.post("/api/tweets/100000/likes", headers={"Api-Key": "pytest"}),
+    )
+    # Лайк и его отмена в одном окне: записывается только отмена
+    liked_results = await asyncio.gather(
+        like_buffer.submit(tweet_id=tweet_id, user_id=1, liked=False),
+        like_buffer.submit(tweet_id=tweet_id, user_id=2, liked=False),
+        like_buffer.submit(tweet_id=tweet_id, user_id=2, liked=True),
+        like_buffer.submit(tweet_id=tweet_id, user_id=2, liked=False),
+    )
+
+    response_tweets = await ac.get(
+        "/api/tweets", headers={"Api-Key": "pytest"}, params={"compact": True}
+    )
+    tweet = [
+        i_tweet
+        for i_tweet in response_tweets.json()["tweets"]
+        if i_tweet["id"] == tweet_id
+    ][0]
+
+    assert [i_response.status_code for i_response in responses_like] == [
+        200,
+        200,
+        200,
+        200,
+        404,
+    ]
+    assert liked_results == [True, True, True, True]
+    assert tweet["like_count"] == 2
+    assert tweet["liked"] is False
+
+
+async def test_like_buffer_pool(ac: AsyncClient):
+    """
+    Тест на буфер лайков: параллельных лайков от пользователей не из кэша больше,
+    чем соединений в пуле, пачке лайков хватает соединения
+    """
+    engine_options = get_engine_options()
+    likes_count: int = engine_options["pool_size"] + engine_options["max_overflow"] + 5
+    api_keys = ["pool-like-{}".format(i) for i in range(likes_count)]
+    async with async_session_maker_test() as session:
+        session.add_all(
+            [Users(user="Pool {}".format(i), api_key=i_key) for i, i_key in enumerate(api_keys)]
+        )
+        await session.commit()
+
+    response_tweet_post = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={"tweet_data": "Like buffer pool", "tweet_media_ids": []},
+    )
+    tweet_id: int = response_tweet_post.json()["tweet_id"]
+
+    responses_like = await asyncio.gather(
+        *(
+            ac.post("/api/tweets/{}/likes".format(tweet_id), headers={"Api-Key": i_key})
+            for i_key in api_keys
+        )
+    )
+    responses_unlike = await asyncio.gather(
+        *(
+            ac.delete("/api/tweets/{}/likes".format(tweet_id), headers={"Api-Key": i_key})
+            for i_key in api_keys
+        )
+    )
+
+    assert [i_response.status_code for i_response in responses_like] == [200] * likes_count
+    assert [i_response.status_code for i_response in responses_unlike] == [200] * likes_count
+
+
+async def test_events(ac: AsyncClient):
+    """Тест на события потока: доставка после commit подписчикам автора и reset при переполнении"""
+    subscription = event_hub.subscribe(user_id=2, following_ids=[1])
+    other_subscription = event_hub.subscribe(user_id=3, following_ids=[])
+
+    response_tweet_post = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={"tweet_data": "Streamed", "tweet_media_ids": []},
+    )
+    tweet_id: int = response_tweet_post.json()["tweet_id"]
+    await ac.post(
+        "/api/tweets/{}/likes".format(tweet_id),
+        headers={"Api-Key": "0f977897-5efc-4d16-8648-d50722ac988b"},
+    )
+    await ac.delete("/api/tweets/{}".format(tweet_id), headers={"Api-Key": "pytest"})
+
+    events = [
+        subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())
+    ]
+    other_events_count: int = other_subscription.queue.qsize()
+    event_hub.unsubscribe(subscription)
+    event_hub.unsubscribe(other_subscription)
+
+    # Медленный клиент: вместо отброшенных событий приходит reset
+    small_hub = EventHub(queue_size=2)
+    slow_subscription = small_hub.subscribe(user_id=2, following_ids=[1])
+    small_hub.dispatch(
+        [{"type": "tweet", "tweet_id": i, "author_id": 1} for i in range(3)]
+    )
+
+    response_unauthorized = await ac.get(
+        "/api/events", params={"api_key": "no_such_key_exists"}
+    )
+
+    assert events == [
+        {"type": "tweet", "tweet_id": tweet_id, "author_id": 1},
+        {"type": "like", "tweet_id": tweet_id, "user_id": 3, "author_id": 1},
+        {"type": "tweet_deleted", "tweet_id": tweet_id, "author_id": 1},
+    ]
+    assert other_events_count == 0
+
+    assert slow_subscription.queue.qsize() == 1
+    assert slow_subscription.queue.get_nowait() == {"type": "reset"}
+
+    assert response_unauthorized.status_code == 401
+
+
+async def test_read_replicas(ac: AsyncClient):
+    """Тест на чтение из реплики: после записи пользователь читает из основной БД"""
+
+    def get_routed(target: str) -> float:
+        return REGISTRY.get_sample_value(
+            "db_reads_routed_total", {"target": target}
+        ) or 0
+
+    replica_before: float = get_routed("replica")
+    pinned_before: float = get_routed("pinned")
+
+    response_replica = await ac.get("/api/users/me", headers={"Api-Key": "bulk-101"})
+    replica_after: float = get_routed("replica")
+
+    await ac.post("/api/users/1/follow", headers={"Api-Key": "bulk-101"})
+    response_pinned = await ac.get(
+        "/api/users/me", headers={"Api-Key": "bulk-101"}, params={"compact": True}
+    )
+
+    assert response_replica.status_code == 200
+    assert replica_after == replica_before + 1
+
+    # Подписка видна сразу: запрос после записи читает из основной БД
+    assert get_routed("pinned") == pinned_before + 1
+    assert response_pinned.json()["user"]["following_count"] == 2
+
+
+async def test_media_disk_io(ac: AsyncClient):
+    """Тест на запись и удаление файла медиа в пуле потоков"""
+    # Уникальное содержимое, чтобы файл не совпал с уже загруженными
+    content: bytes = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    media_path: str = get_media_path(hashlib.sha256(content).hexdigest(), "png")
+    file_path: str = os.path.join(MEDIA_ROOT, media_path)
+
+    response_media = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+
+    assert response_media.status_code == 200
+    assert os.path.exists(file_path)
+
+    response_tweet = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={
+            "tweet_data": "media disk io",
+            "tweet_media_ids": [response_media.json()["media_id"]],
+        },
+    )
+    response_delete = await ac.delete(
+        "/api/tweets/{}".format(response_tweet.json()["tweet_id"]),
+        headers={"Api-Key": "pytest"},
+    )
+
+    assert response_delete.status_code == 200
+
+    # Файл удаляется фоновой задачей из очереди на удаление
+    assert os.path.exists(file_path)
+    assert await collect_media_garbage() >= 1
+    assert not os.path.exists(file_path)
+
+    response_metrics = await ac.get("/metrics")
+
+    assert 'media_io_seconds_count{operation="store"}' in response_metrics.text
+    assert 'media_io_seconds_count{operation="remove"}' in response_metrics.text
+
+
+async def test_media_orphan_sweep(ac: AsyncClient):
+    """Тест на удаление загрузки, которую так и не прикрепили к твиту"""
+    content: bytes = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    file_path: str = os.path.join(
+        MEDIA_ROOT, get_media_path(hashlib.sha256(content).hexdigest(), "png")
+    )
+
+    response_media = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+    media_id: int = response_media.json()["media_id"]
+
+    # Свежая загрузка не удаляется
+    await collect_media_garbage()
+
+    assert os.path.exists(file_path)
+
+    # Загрузка старше MEDIA_ORPHAN_GRACE
+    async with async_session_maker_test() as session:
+        await session.execute(
+            text(
+                "UPDATE media SET created_at = created_at - interval '30 days'"
+                " WHERE id = :media_id"
+            ),
+            {"media_id": media_id},
+        )
+        await session.commit()
+
+    await collect_media_garbage()
+
+    assert not os.path.exists(file_path)
+
+    async with async_session_maker_test() as session:
+        media_count: int = await session.scalar(
+            text("SELECT count(*) FROM media WHERE id = :media_id"),
+            {"media_id": media_id},
+        )
+
+    assert media_count == 0
+
+
+async def test_leader_election():
+    """Тест на запуск фоновых задач только в одном (ведущем) процессе"""
+    started = []
+
+    async def leader_task() -> None:
+        started.append(1)
+        await asyncio.Event().wait()
+
+    # Два "воркера" с отдельными соединениями к БД
+    workers = [asyncio.create_task(run_as_leader([leader_task])) for _ in range(2)]
+    await asyncio.sleep(1)
+
+    assert len(started) == 1
+    assert REGISTRY.get_sample_value("app_leader") == 1
+
+    for i_worker in workers:
+        i_worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    # Блокировка освобождена: её получает следующий процесс
+    worker = asyncio.create_task(run_as_leader([leader_task]))
+    await asyncio.sleep(1)
+
+    assert len(started) == 2
+
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+
+
+async def test_startup_lock():
+    """Тест на выполнение однократной работы при старте по очереди"""
+    running = []
+    overlaps = []
+
+    async def startup() -> None:
+        async with startup_lock():
+            if running:
+                overlaps.append(1)
+            running.append(1)
+            await asyncio.sleep(0.1)
+            running.pop()
+
+    await asyncio.gather(*[startup() for _ in range(3)])
+
+    assert overlaps == []
+
+
+async def test_users_batch(ac: AsyncClient):
+    """Тест на получение нескольких пользователей одним запросом"""
+    response = await ac.get("/api/users?ids=3,2,222,3")
+
+    assert response.status_code == 200
+    assert "ETag" in response.headers
+    # Порядок как в запросе, повторы - один раз, ненайденные пропущены
+    assert [i_user["id"] for i_user in response.json()["users"]] == [3, 2]
+
+    # Профили совпадают с ответами /api/users/<id>
+    for i_user in response.json()["users"]:
+        response_user = await ac.get("/api/users/{}".format(i_user["id"]))
+        user = response_user.json()["user"]
+
+        assert i_user["name"] == user["name"]
+        assert sorted(i_user["followers"], key=lambda x: x["id"]) == sorted(
+            user["followers"], key=lambda x: x["id"]
+        )
+        assert sorted(i_user["following"], key=lambda x: x["id"]) == sorted(
+            user["following"], key=lambda x: x["id"]
+        )
+
+    response_compact = await ac.get("/api/users?ids=2&compact=true")
+
+    assert response_compact.json()["users"][0].keys() == {
+        "id",
+        "name",
+        "followers_count",
+        "following_count",
+    }
+
+    response_not_modified = await ac.get(
+        "/api/users?ids=3,2,222,3",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+
+    assert response_not_modified.status_code == 304
+
+
+async def test_users_batch_limit(ac: AsyncClient):
+    """Тест на ограничение количества id в запросе нескольких пользователей"""
+    ids: str = ",".join(str(i_id) for i_id in range(1, USERS_BATCH_SIZE_MAX + 2))
+    response = await ac.get("/api/users?ids={}".format(ids))
+
+    assert response.status_code == 422
+    assert response.json()["error_type"] == "TooManyIds"
+
+
+async def test_users_batch_invalid_ids(ac: AsyncClient):
+    """Тест на отказ для id вне диапазона INTEGER и слишком длинного списка id"""
+    response_out_of_range = await ac.get("/api/users?ids=1,2147483648")
+    response_too_long = await ac.get(
+        "/api/users?ids={}".format(",".join(["1"] * USERS_BATCH_SIZE_MAX * 6))
+    )
+    response_too_many_digits = await ac.get("/api/users?ids=12345678901")
+
+    assert response_out_of_range.status_code == 422
+    assert response_out_of_range.json()["error_type"] == "InvalidIds"
+    assert response_too_long.status_code == 422
+    assert response_too_many_digits.status_code == 422
+
+
+async def test_timeline_postgres_store(monkeypatch):
+    """Тест на хранилище лент postgres: заполнение лент миграцией, рассылка и обрезка"""
+    store = PostgresTimelineStore()
+
+    # Всё в одной транзакции, которая откатывается: остальные ленты не меняются
+    async with async_session_maker_test() as session:
+        author = Users(user="Timeline author", api_key="timeline-author")
+        follower = Users(user="Timeline follower", api_key="timeline-follower")
+        session.add_all([author, follower])
+        await session.flush()
+        await session.execute(
+            insert(integration_followers).values(
+                user_id=follower.id, following_id=author.id
+            )
+        )
+        old_tweets = [
+            Tweets(tweet="Timeline {}".format(i), author_id=author.id)
+            for i in range(3)
+        ]
+        session.add_all(old_tweets)
+        await session.flush()
+
+        # Подписка, сделанная до таблицы timeline, заполняется миграцией
+        await backfill_timelines(await session.connection())
+        backfilled_page = await store.get_page(session, follower.id, None, 10)
+
+        new_tweets = [
+            Tweets(tweet="Timeline new {}".format(i), author_id=author.id)
+            for i in range(2)
+        ]
+        session.add_all(new_tweets)
+        await session.flush()
+        for i_tweet in new_tweets:
+            await store.push_to_followers(
+                session, tweet_id=i_tweet.id, author_id=author.id
+            )
+
+        author_page = await store.get_page(session, author.id, None, 10)
+        follower_page = await store.get_page(session, follower.id, None, 10)
+
+        monkeypatch.setattr("database.timeline.TIMELINE_INBOX_SIZE", 3)
+        pruned: int = await store.prune(session)
+        pruned_page = await store.get_page(session, follower.id, None, 10)
+
+        await session.rollback()
+
+    tweet_ids = [i_tweet.id for i_tweet in old_tweets + new_tweets]
+
+    assert backfilled_page == tweet_ids[2::-1]
+    assert author_page == tweet_ids[::-1]
+    assert follower_page == tweet_ids[::-1]
+    assert pruned >= 2
+    # Остаются самые новые твиты
+    assert pruned_page == tweet_ids[:1:-1]
+
+
+async def test_timeline_memory_store_rollback():
+    """Тест на хранилище лент в памяти: изменения откатанной транзакции не применяются"""
+    store = InMemoryTimelineStore()
+
+    with pytest.raises(RuntimeError):
+        async with transaction(async_session_maker_test) as session:
+            await store.push(session, user_ids=[1, 2], tweet_id=10, author_id=1)
+            raise RuntimeError
+
+    async with transaction(async_session_maker_test) as session:
+        await store.push(session, user_ids=[1], tweet_id=11, author_id=1)
+        # До commit лента не меняется
+        page_before_commit = await store.get_page(session, 1, None, 10)
+
+    async with transaction(async_session_maker_test) as session:
+        page = await store.get_page(session, 1, None, 10)
+        other_page = await store.get_page(session, 2, None, 10)
+
+    assert page_before_commit == []
+    assert page == [11]
+    assert other_page == []
+
+
+@pytest.mark.parametrize(
+    "header, extension",
+    [
+        (b"\xff\xd8\xff\xe0", "jpg"),
+        (b"\x89PNG\r\n\x1a\n", "png"),
+        (b"GIF89a", "gif"),
+        (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "webp"),
+        (b"RIFF\x00\x00\x00\x00WAVE", None),
+        (b"plain text", None),
+    ],
+)
+async def test_media_format_detection(header: bytes, extension: str | None):
+    """Тест на определение формата картинки по первым байтам"""
+    assert detect_image_extension(header) == extension
+
+
+async def test_media_unsupported_type(ac: AsyncClient):
+    """Тест на отказ в загрузке файла, который не является картинкой"""
+    response = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.jpg", b"not an image")},
+    )
+
+    assert response.status_code == 415
+    assert response.json()["error_type"] == "UnsupportedMediaType"
+
+
+async def test_media_deduplication(ac: AsyncClient):
+    """
+    Тест на хранение одинаковых загрузок одним файлом: записей Media две,
+    файл удаляется только после удаления последнего твита, который на него ссылается
+    """
+    content: bytes = b"\xff\xd8\xff\xe0" + uuid.uuid4().bytes
+    media_path: str = get_media_path(hashlib.sha256(content).hexdigest(), "jpg")
+    file_path: str = os.path.join(MEDIA_ROOT, media_path)
+    os.makedirs(UPLOADS_TMP_DIR_PATH, exist_ok=True)
+    tmp_files_before = set(os.listdir(UPLOADS_TMP_DIR_PATH))
+
+    tweet_ids = []
+    for i_number in range(2):
+        response_media = await ac.post(
+            "/api/medias",
+            headers={"Api-Key": "pytest"},
+            files={"file": ("image.jpg", content)},
+        )
+        response_tweet = await ac.post(
+            "/api/tweets",
+            headers={"Api-Key": "pytest"},
+            json={
+                "tweet_data": "media deduplication {}".format(i_number),
+                "tweet_media_ids": [response_media.json()["media_id"]],
+            },
+        )
+        tweet_ids.append(response_tweet.json()["tweet_id"])
+
+    async with async_session_maker_test() as session:
+        media_count: int = await session.scalar(
+            text("SELECT count(*) FROM media WHERE media_path = :media_path"),
+            {"media_path": media_path},
+        )
+
+    assert media_count == 2
+    # Вторая загрузка не сохранила копию: её временный файл удалён
+    assert os.path.exists(file_path)
+    assert set(os.listdir(UPLOADS_TMP_DIR_PATH)) == tmp_files_before
+
+    # На файл ещё ссылается второй твит
+    await ac.delete("/api/tweets/{}".format(tweet_ids[0]), headers={"Api-Key": "pytest"})
+    await collect_media_garbage()
+
+    assert os.path.exists(file_path)
+
+    await ac.delete("/api/tweets/{}".format(tweet_ids[1]), headers={"Api-Key": "pytest"})
+    await collect_media_garbage()
+
+    assert not os.path.exists(file_path)
+
+
+async def test_image_variants(ac: AsyncClient, monkeypatch):
+    """
+    Тест на создание вариантов картинки в пуле процессов: лента отдаёт
+    вариант для ленты, варианты удаляются вместе с исходным файлом
+    """
+    image_module = pytest.importorskip("PIL.Image")
+    # В тестах фоновая обработка отключена, пул создаём на время теста
+    monkeypatch.setattr("database.images.IMAGE_WORKERS", 1)
+
+    buffer = io.BytesIO()
+    image_module.new("RGB", (1600, 800), color=tuple(uuid.uuid4().bytes[:3])).save(
+        buffer, format="PNG"
+    )
+    content: bytes = buffer.getvalue()
+    media_path: str = get_media_path(hashlib.sha256(content).hexdigest(), "png")
+
+    response_media = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+    response_tweet = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={
+            "tweet_data": "image variants",
+            "tweet_media_ids": [response_media.json()["media_id"]],
+        },
+    )
+    tweet_id: int = response_tweet.json()["tweet_id"]
+
+    try:
+        await process_image_variants(media_path)
+    finally:
+        shutdown_image_pool()
+
+    response_tweets = await ac.get("/api/tweets", headers={"Api-Key": "pytest"})
+    tweet = [
+        i_tweet
+        for i_tweet in response_tweets.json()["tweets"]
+        if i_tweet["id"] == tweet_id
+    ][0]
+    variant_paths = {
+        i_variant: os.path.join(MEDIA_ROOT, get_variant_path(media_path, i_variant))
+        for i_variant in ("thumbnail", "feed", "large")
+    }
+
+    assert tweet["attachments"] == [get_variant_path(media_path, "feed")]
+
+    with image_module.open(variant_paths["thumbnail"]) as thumbnail:
+        assert thumbnail.format == "WEBP"
+        assert thumbnail.size == (320, 160)
+
+    with image_module.open(variant_paths["feed"]) as feed:
+        assert feed.size == (1080, 540)
+
+    # Исходная картинка меньше предела варианта large и не увеличивается
+    with image_module.open(variant_paths["large"]) as large:
+        assert large.size == (1600, 800)
+
+    await ac.delete("/api/tweets/{}".format(tweet_id), headers={"Api-Key": "pytest"})
+    await collect_media_garbage()
+
+    assert not any(os.path.exists(i_path) for i_path in variant_paths.values())
+
+
+async def test_request_transaction_rollback(ac: AsyncClient, monkeypatch):
+    """
+    Тест на одну транзакцию запроса: при ошибке после записи твита
+    не сохраняются ни твит, ни привязка к нему картинки
+    """
+    content: bytes = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    response_media = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+    media_id: int = response_media.json()["media_id"]
+
+    async def update_image_tweet_id_and_fail(session, image_id_list, tweet_id):
+        await update_image_tweet_id(
+            session, image_id_list=image_id_list, tweet_id=tweet_id
+        )
+        raise RuntimeError("forced failure")
+
+    monkeypatch.setattr(
+        "app.main.update_image_tweet_id", update_image_tweet_id_and_fail
+    )
+
+    with pytest.raises(RuntimeError):
+        await ac.post(
+            "/api/tweets",
+            headers={"Api-Key": "pytest"},
+            json={"tweet_data": "rolled back", "tweet_media_ids": [media_id]},
+        )
+
+    async with async_session_maker_test() as session:
+        tweets_count: int = await session.scalar(
+            text("SELECT count(*) FROM tweets WHERE tweet = 'rolled back'")
+        )
+        media_tweet_id: int | None = await session.scalar(
+            text("SELECT tweet_id FROM media WHERE id = :media_id"),
+            {"media_id": media_id},
+        )
+
+    assert tweets_count == 0
+    assert media_tweet_id is None
+
+
+async def test_tweets_etag_following(ac: AsyncClient):
+    """
+    Тест на версию ленты подписок: новый твит автора, на которого пользователь
+    не подписан, меняет общую ленту, но не ленту подписок
+    """
+    async with async_session_maker_test() as session:
+        session.add(Users(user="Etag", api_key="etag-user"))
+        await session.commit()
+
+    headers = {"Api-Key": "etag-user"}
+    response_following = await ac.get(
+        "/api/tweets", headers=headers, params={"following": True}
+    )
+    response_all = await ac.get("/api/tweets", headers=headers)
+
+    await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "a5c69a74-00e6-4f9b-8ba9-ee5e51f1aef1"},
+        json={"tweet_data": "Not followed", "tweet_media_ids": []},
+    )
+
+    response_following_not_modified = await ac.get(
+        "/api/tweets",
+        headers={**headers, "If-None-Match": response_following.headers["ETag"]},
+        params={"following": True},
+    )
+    response_all_modified = await ac.get(
+        "/api/tweets",
+        headers={**headers, "If-None-Match": response_all.headers["ETag"]},
+    )
+
+    assert response_following_not_modified.status_code == 304
+    assert response_all_modified.status_code == 200
+
+    # Свой твит попадает в ленту подписок и меняет её версию
+    await ac.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "Own tweet", "tweet_media_ids": []},
+    )
+    response_following_modified = await ac.get(
+        "/api/tweets",
+        headers={**headers, "If-None-Match": response_following.headers["ETag"]},
+        params={"following": True},
+    )
+
+    assert response_following_modified.status_code == 200
+    assert [
+        i_tweet["content"] for i_tweet in response_following_modified.json()["tweets"]
+    ] == ["Own tweet"]
+
+
+async def test_tweets_following_pagination(ac: AsyncClient, monkeypatch):
+    """
+    Тест на ленту подписок глубже ленты пользователя: подписка на автора,
+    у которого твитов больше, чем в ленте, страницы идут без пропусков
+    """
+    monkeypatch.setattr("database.timeline.TIMELINE_INBOX_SIZE", 3)
+    monkeypatch.setattr("database.models.TIMELINE_INBOX_SIZE", 3)
+
+    async with async_session_maker_test() as session:
+        author: Users = Users(user="Deep author", api_key="deep-author")
+        follower: Users = Users(user="Deep follower", api_key="deep-follower")
+        session.add_all([author, follower])
+        await session.flush()
+        old_tweets = [
+            Tweets(tweet="Deep {}".format(i), author_id=author.id) for i in range(7)
+        ]
+        session.add_all(old_tweets)
+        await session.commit()
+
+    headers = {"Api-Key": "deep-follower"}
+    await ac.post("/api/users/{}/follow".format(author.id), headers=headers)
+    response_own = await ac.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "Deep own", "tweet_media_ids": []},
+    )
+    response_new = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "deep-author"},
+        json={"tweet_data": "Deep new", "tweet_media_ids": []},
+    )
+
+    tweet_ids = []
+    params = {"following": True, "compact": True, "limit": 2}
+    while True:
+        response_tweets = await ac.get("/api/tweets", headers=headers, params=params)
+        assert response_tweets.status_code == 200
+        tweet_ids.extend(i_tweet["id"] for i_tweet in response_tweets.json()["tweets"])
+
+        if "X-Next-Cursor" not in response_tweets.headers:
+            break
+        params["cursor"] = response_tweets.headers["X-Next-Cursor"]
+
+    assert tweet_ids == sorted(
+        [
+            *(i_tweet.id for i_tweet in old_tweets),
+            response_own.json()["tweet_id"],
+            response_new.json()["tweet_id"],
+        ],
+        reverse=True,
+    )
+
+
+async def test_media_gc_upload_race(ac: AsyncClient):
+    """
+    Тест на удаление файла, который в это время загружают заново:
+    фоновая задача пропускает заблокированный путь, а после сохранения
+    новой записи Media файл не удаляет
+    """
+    content: bytes = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    media_path: str = get_media_path(hashlib.sha256(content).hexdigest(), "png")
+    file_path: str = os.path.join(MEDIA_ROOT, media_path)
+
+    response_media = await ac.post(
+        "/api/medias",
+        headers={"Api-Key": "pytest"},
+        files={"file": ("image.png", content)},
+    )
+    response_tweet = await ac.post(
+        "/api/tweets",
+        headers={"Api-Key": "pytest"},
+        json={
+            "tweet_data": "media gc race",
+            "tweet_media_ids": [response_media.json()["media_id"]],
+        },
+    )
+    await ac.delete(
+        "/api/tweets/{}".format(response_tweet.json()["tweet_id"]),
+        headers={"Api-Key": "pytest"},
+    )
+
+    # Повторная загрузка тех же байт: путь заблокирован, запись ещё не сохранена
+    async with async_session_maker_test() as session:
+        await lock_media_path(session, media_path)
+        await collect_media_garbage()
+
+        assert os.path.exists(file_path)
+
+        session.add(Media(media_path=media_path))
+        await session.commit()
+
+    await collect_media_garbage()
+
+    async with async_session_maker_test() as session:
+        pending_count: int = await session.scalar(
+            text("SELECT count(*) FROM media_deletions WHERE media_path = :path"),
+            {"path": media_path},
+        )
+
+    # Строка очереди обработана, на файл ссылается новая запись
+    assert pending_count == 0
+    assert os.path.exists(file_path)